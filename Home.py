@@ -1,4 +1,8 @@
 import streamlit as st
+import utils
+
+# 既定ティッカーの市場データを裏で先読み（プロセス内で1回だけ）
+utils.start_background_prefetch()
 
 # キャッシュをクリアして実行
 st.cache_data.clear()  # Streamlit >=1.18
@@ -38,3 +42,20 @@ st.markdown("""
 - 戦略の選択肢に対しては是非ご意見をお寄せください。（アプリ実装の参考にさせていただきます）
 """)
 
+st.write("")
+
+st.markdown("""
+**「ポートフォリオシミュレーション」**
+- 複数のインデックス（例: VOO+QQQ+VT）を組み合わせたポートフォリオの資産形成をシミュレーションします。
+- 銘柄間の相関を推定し、相関を保ったまま全銘柄のリターンを同時に生成します。
+- 目標配分とリバランスの間隔を設定して、分散投資の効果を確認してみてください。
+""")
+
+st.write("")
+
+st.markdown("""
+**「ライフサイクルシミュレーション」**
+- 積立（資産形成）から取り崩しまでを、1本のつながったリターンの推移でシミュレーションします。
+- 退職時資産を手で引き継ぐのではなく、試行ごとの積立結果がそのまま取り崩しの初期資産になります。
+- 今の積立計画で「最後まで資産が尽きない確率」と、退職時資産の多寡による違いを確認してみてください。
+""")
@@ -0,0 +1,171 @@
+# シミュレーション結果を HTTP で返すローカル API（ASGI）
+#
+# 起動:
+#   pip install -r requirements-extra.txt   # starlette / uvicorn（Arrow 形式の応答には pyarrow）
+#   python api_server.py --port 8000 --workers 4
+#   （uvicorn api_server:app でも起動できる。ワーカー数は API_WORKERS で指定）
+#
+# エンドポイント:
+#   GET  /health        稼働確認（ワーカー数・実行中のジョブ数）
+#   POST /fit           リターンモデルの推定結果と統計量
+#   POST /bands         対数株価のパーセンタイル帯
+#   POST /accumulation  積立シミュレーションの要約
+#   POST /withdrawal    取り崩しシミュレーションの要約
+#   POST /portfolio     ポートフォリオ積立シミュレーションの要約
+#   POST /lifecycle     積立から取り崩しまでを同じリターン列で続けたシミュレーションの要約
+# 本文は batch_runner.py のシナリオ1件と同じ形式の JSON（省略した項目は utils.SCENARIO_DEFAULTS、金額は万円）。
+#   例: curl -X POST localhost:8000/withdrawal -d '{"ticker": "VOO", "n_sims": 2000, "seed": 0}'
+# Accept: application/vnd.apache.arrow.stream を指定すると、1行の Arrow IPC ストリームで返す。
+#
+# 計算はプロセスプールで実行し、同時に届いた同一入力のリクエストは1回の計算にまとめる。
+# 結果は utils の結果キャッシュ（ディスク共有）にも保存されるので、同じシナリオは再計算しない。
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+
+import numpy as np
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+import utils
+
+
+API_WORKERS = int(os.getenv("API_WORKERS", os.cpu_count() or 1))  # 計算用プロセス数
+API_MAX_PENDING = int(os.getenv("API_MAX_PENDING", "64"))          # 実行中・待機中のジョブの上限（超えたら 503）
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+LOGGER = logging.getLogger("api_server")
+
+_POOL = None
+_INFLIGHT = {}  # シナリオのキー -> 実行中の計算（Future）
+
+
+# ワーカープロセスで実行：シナリオを計算し、numpy 配列とスカラーだけの辞書で返す
+def compute_scenario(scenario):
+    summary = utils.run_scenario_summary(scenario)
+    return {k: np.asarray(v) if isinstance(v, (np.ndarray, list)) else v for k, v in summary.items()}
+
+
+# numpy の値を JSON にできる形へ（NaN は null）
+def _jsonable(value):
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind == "f":
+            return np.where(np.isnan(value), None, value.round(6)).tolist()
+        return value.tolist()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return None if np.isnan(value) else round(value, 6)
+    return value
+
+
+# 要約を1行の Arrow テーブル（配列は list 列）に変換して IPC ストリームで返す
+def _arrow_bytes(summary):
+    import pyarrow as pa  # Arrow 形式を要求された場合のみ必要
+    columns = {}
+    for k, v in summary.items():
+        v = np.asarray(v)
+        columns[k] = pa.array([v.tolist()]) if v.ndim else pa.array([v.item()])
+    table = pa.table(columns)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _error(status, message):
+    return JSONResponse({"error": message}, status_code=status)
+
+
+async def health(request):
+    return JSONResponse({"status": "ok", "workers": API_WORKERS, "inflight": len(_INFLIGHT)})
+
+
+async def simulate(request):
+    kind = request.path_params["kind"]
+    if kind not in utils.SCENARIO_TYPES:
+        return _error(404, f"未知のエンドポイントです: /{kind}")
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        return _error(400, "本文が JSON ではありません")
+    if not isinstance(body, dict):
+        return _error(400, "本文は JSON オブジェクトで指定してください")
+    try:
+        scenario = utils.resolve_scenario({**body, "type": kind})
+    except ValueError as e:
+        return _error(400, str(e))
+
+    start = time.perf_counter()
+    # 同一入力の計算が実行中ならその結果を待つ（リクエストの合流）
+    key = utils.scenario_key("api", **scenario)
+    future = _INFLIGHT.get(key)
+    coalesced = future is not None
+    if future is None:
+        if len(_INFLIGHT) >= API_MAX_PENDING:
+            return _error(503, "実行待ちのジョブが多すぎます。しばらくしてから再試行してください")
+        future = asyncio.get_running_loop().run_in_executor(_POOL, compute_scenario, scenario)
+        _INFLIGHT[key] = future
+        future.add_done_callback(lambda _: _INFLIGHT.pop(key, None))
+    try:
+        # クライアントが切断しても、合流している他のリクエストのために計算は止めない
+        summary = await asyncio.shield(future)
+    except (ValueError, KeyError, TypeError) as e:
+        return _error(400, f"{type(e).__name__}: {e}")
+    except Exception as e:
+        # 入力は resolve_scenario で検査済みなので、ここに来るのは計算側の不具合。トレースバックはログにだけ残す
+        LOGGER.exception("シナリオの計算に失敗しました: %s", key)
+        return _error(500, f"計算に失敗しました（{type(e).__name__}）")
+
+    headers = {
+        "X-Scenario-Key": key,
+        "X-Coalesced": "1" if coalesced else "0",
+        "X-Elapsed-Seconds": f"{time.perf_counter() - start:.3f}",
+    }
+    if ARROW_MEDIA_TYPE in request.headers.get("accept", ""):
+        return Response(_arrow_bytes(summary), media_type=ARROW_MEDIA_TYPE, headers=headers)
+    payload = {k: _jsonable(v) for k, v in summary.items()}
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global _POOL
+    _POOL = ProcessPoolExecutor(max_workers=API_WORKERS)
+    try:
+        yield
+    finally:
+        _POOL.shutdown(cancel_futures=True)
+
+
+app = Starlette(
+    routes=[
+        Route("/health", health, methods=["GET"]),
+        Route("/{kind}", simulate, methods=["POST"]),
+    ],
+    lifespan=lifespan,
+)
+
+
+def main():
+    global API_WORKERS
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="シミュレーション API を起動する")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=API_WORKERS, help="計算用プロセス数")
+    args = parser.parse_args()
+
+    API_WORKERS = args.workers
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
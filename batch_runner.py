@@ -0,0 +1,258 @@
+# シナリオファイル（YAML / JSON）を読み込み、ブラウザなしで一括シミュレーションするコマンドラインツール
+#
+# 例:
+#   python batch_runner.py scenarios.yaml --out results --workers 4
+#   （YAML の読み込みと parquet での保存には requirements-extra.txt の pyyaml / pyarrow が必要）
+#
+# シナリオファイルの形式（JSON も同じ構造、既定値は utils.SCENARIO_DEFAULTS）:
+#   defaults:                      # 全シナリオ共通の既定値（各シナリオで上書き可）
+#     ticker: VOO
+#     start_date: "2009-09-01"     # STEP.1 のデータ期間
+#     end_date: "2025-01-01"
+#     return_model: skewnorm       # skewnorm / normal / bootstrap / regime（portfolio は mvnormal / joint_bootstrap）
+#     parameter_uncertainty: false # true ならパラメータの推定誤差を反映（skewnorm / normal / regime のみ）
+#     n_sims: 5000
+#     seed: 0
+#   scenarios:
+#     - name: accumulation_30y
+#       type: accumulation         # accumulation / withdrawal / portfolio / lifecycle / bands / fit
+#       years: 30
+#       initial_investment: 100    # 万円
+#       monthly_contribution: 5    # 万円（schedule を指定すればそちらを優先）
+#       target_amount: 3000        # 万円
+#     - name: withdrawal_4000
+#       type: withdrawal
+#       years: 30
+#       initial_assets: 4000       # 万円
+#       initial_savings: 400
+#       monthly_need: 20
+#       withdrawal_rate: 1.0       # 月次, %
+#       options: {option1_1: "1-1-1", option1_2: "1-2-2", option2_1: "2-1-2", option2_2: "2-2-1"}
+#     - name: voo_qqq_vt
+#       type: portfolio
+#       tickers: [VOO, QQQ, VT]
+#       weights: [50, 30, 20]       # tickers と同じ数（省略すると均等配分）
+#       rebalance_months: 12
+#     - name: lifecycle_20y_30y      # 積立に続けて、同じリターン列で取り崩す（退職時資産を手で引き継がない）
+#       type: lifecycle
+#       years: 20                    # 積立期間
+#       retirement_years: 30         # 取り崩し期間
+#       monthly_contribution: 5
+#       monthly_need: 20             # 現在の金額（積立期間のインフレも反映して取り崩しを始める）
+#
+# 出力:
+#   <out>/summary.parquet  1シナリオ1行の要約（成功率・最終資産のパーセンタイル・所要時間など）
+#   <out>/bands.parquet    月別パーセンタイル帯（縦持ち: scenario, series, month, p2_5, p50, p97_5）
+#
+# 共通乱数: リターンモデル・データ期間・期間・試行回数・seed が同じシナリオ（戦略や積立額・配分だけが違う）は同じリターン列を使う。
+# そうしたシナリオが複数あれば、リターン行列を親プロセスで1回だけ生成して共有メモリに置き、各ワーカーはコピーせずに参照する。
+# シナリオ間の差がサンプリングのばらつきではなく戦略の違いだけになる（--no-common-returns で無効、結果は同じ）。
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import shared_arrays
+import utils
+
+
+# シナリオファイルを読み込み、既定値を補完したシナリオのリストを返す
+def load_scenarios(path):
+    with open(path, encoding="utf-8") as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml  # YAML を使う場合のみ必要
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    if isinstance(spec, list):
+        spec = {"scenarios": spec}
+    scenarios = []
+    for i, scenario in enumerate(spec.get("scenarios", [])):
+        name = scenario.get("name", f"scenario_{i+1}")
+        try:
+            scenario = utils.resolve_scenario(scenario, spec.get("defaults"))
+        except ValueError as e:
+            raise ValueError(f"シナリオ {name}: {e}") from None
+        scenario["name"] = name
+        scenarios.append(scenario)
+    return scenarios
+
+
+# パーセンタイル帯 (3, n_months) を縦持ちの DataFrame に変換
+def _bands_frame(name, series, bands, scale=1.0):
+    return pd.DataFrame({
+        "scenario": name,
+        "series": series,
+        "month": np.arange(bands.shape[1]),
+        "p2_5": bands[0] / scale,
+        "p50": bands[1] / scale,
+        "p97_5": bands[2] / scale,
+    })
+
+
+# リスク指標（最大ドローダウンなど）の中央値を summary の列に
+def _risk_columns(summary):
+    return {f"{name}_p50": float(summary[f"{name}_percentiles"][1]) for name in utils.RISK_METRICS}
+
+
+# 要約を summary の1行（スカラー値）と bands の縦持ち DataFrame に変換
+def _tabulate(scenario, summary):
+    name = scenario["name"]
+    if scenario["type"] == "withdrawal":
+        final_total = summary["Total"][:, -1]
+        row = {
+            "success_rate": float(summary["success_rate"]),
+            "final_p2_5": final_total[0],
+            "final_p50": final_total[1],
+            "final_p97_5": final_total[2],
+            **_risk_columns(summary),
+        }
+        # Total_survivors は最後まで総資産が尽きなかった試行だけの帯
+        return row, [_bands_frame(name, k, summary[k]) for k in utils.WITHDRAWAL_KEYS + ["Total_survivors"]]
+    if scenario["type"] == "lifecycle":
+        retirement = summary["retirement_percentiles"]
+        row = {
+            "success_rate": float(summary["success_rate"]),
+            "retirement_p2_5": retirement[0],
+            "retirement_p50": retirement[1],
+            "retirement_p97_5": retirement[2],
+        }
+        # Total は積立期間から取り崩し期間まで通した帯、Used は取り崩し期間の消費額
+        return row, [_bands_frame(name, "Total", summary["percentiles"]), _bands_frame(name, "Used", summary["Used"])]
+    if scenario["type"] in ("accumulation", "portfolio"):
+        final = summary["final_percentiles"] / 1e4
+        row = {
+            "hit_rate": float(summary["hit_rate"]),
+            "final_p2_5": final[0],
+            "final_p50": final[1],
+            "final_p97_5": final[2],
+            "years_to_target_p50": float(summary["percentiles_time"][1]),
+            **_risk_columns(summary),
+        }
+        return row, [_bands_frame(name, "Total", summary["percentiles"], 1e4)]
+    if scenario["type"] == "bands":
+        return _risk_columns(summary), [_bands_frame(name, "LogPrice", summary["percentiles_log"])]
+    return dict(summary), []
+
+
+# 共通乱数：リターン列が同じシナリオ（戦略・積立額・配分だけが違う）が複数あれば、リターン行列を1回だけ生成して
+# 共有メモリに置く。戻り値はシナリオ名 -> {リターン列のキー: ハンドル}
+def share_common_returns(scenarios, pool):
+    groups = {}
+    for scenario in scenarios:
+        try:
+            spec = utils.scenario_returns(scenario)
+        except Exception:
+            continue  # 実行時にエラーとして記録する
+        if spec is not None:
+            groups.setdefault(spec["key"], []).append((scenario["name"], spec))
+    shared = {}
+    for key, members in groups.items():
+        if len(members) < 2:
+            continue
+        spec = max((spec for _, spec in members), key=lambda spec: spec["n_paths"])
+        returns = utils.stream_returns(key, spec["model"], spec["n_paths"], spec["n_months"], spec["dtype"], spec["block_size"])
+        handle = pool.put(key, returns)
+        for name, _ in members:
+            shared[name] = {key: handle}
+        print(f"共通乱数: {len(members)} シナリオで {returns.nbytes / 2**20:,.0f}MB のリターン行列を共有します", file=sys.stderr)
+    return shared
+
+
+# 1シナリオを実行（ワーカープロセスで呼ばれる）。失敗しても例外は投げず status に記録する
+def run_scenario(scenario, shared=None):
+    start = time.perf_counter()
+    row = {"scenario": scenario["name"], "type": scenario["type"], "n_sims": scenario["n_sims"], "seed": scenario["seed"]}
+    frames = []
+    try:
+        # 共有メモリのリターン行列があれば、生成せずにそれを使う（コピーしない）
+        with shared_arrays.shared_returns(shared or {}):
+            summary = utils.run_scenario_summary(scenario)
+        metrics, frames = _tabulate(scenario, summary)
+        row.update(metrics)
+        row["status"] = "ok"
+        row["error"] = ""
+    except Exception as e:
+        row["status"] = "error"
+        row["error"] = f"{type(e).__name__}: {e}"
+    row["elapsed_sec"] = time.perf_counter() - start
+    return row, frames
+
+
+# DataFrame を parquet で保存（parquet エンジンがなければ csv）
+def _write_table(df, out_dir, name):
+    if utils.parquet_available():
+        path = os.path.join(out_dir, f"{name}.parquet")
+        df.to_parquet(path, index=False)
+    else:
+        path = os.path.join(out_dir, f"{name}.csv")
+        df.to_csv(path, index=False)
+        print(f"parquet エンジン（pyarrow）がないため CSV で保存しました: {path}", file=sys.stderr)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="シナリオファイルを一括シミュレーションして結果を parquet に保存する")
+    parser.add_argument("scenario_file", help="シナリオファイル（.yaml / .yml / .json）")
+    parser.add_argument("--out", default="batch_results", help="出力ディレクトリ")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="ワーカープロセス数（1 なら逐次実行）")
+    parser.add_argument("--no-common-returns", action="store_true", help="リターン行列を共有せず、シナリオごとに生成する")
+    args = parser.parse_args()
+
+    try:
+        scenarios = load_scenarios(args.scenario_file)
+    except ValueError as e:
+        print(f"シナリオファイルが不正です: {e}", file=sys.stderr)
+        return 2
+    os.makedirs(args.out, exist_ok=True)
+    print(f"{len(scenarios)} シナリオを {args.workers} ワーカーで実行します", file=sys.stderr)
+
+    rows, frames = [], []
+    start = time.perf_counter()
+
+    def report(row):
+        rows.append(row)
+        print(
+            f"[{len(rows):>{len(str(len(scenarios)))}}/{len(scenarios)}] {row['scenario']}: "
+            f"{row['status']} {row['elapsed_sec']:.2f}s {row['error']}",
+            file=sys.stderr,
+        )
+
+    with shared_arrays.SharedArrayPool() as pool:
+        shared = {} if args.no_common_returns else share_common_returns(scenarios, pool)
+        if args.workers <= 1:
+            for scenario in scenarios:
+                row, scenario_frames = run_scenario(scenario, shared.get(scenario["name"]))
+                frames.extend(scenario_frames)
+                report(row)
+        else:
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                futures = [executor.submit(run_scenario, scenario, shared.get(scenario["name"])) for scenario in scenarios]
+                for future in as_completed(futures):
+                    row, scenario_frames = future.result()
+                    frames.extend(scenario_frames)
+                    report(row)
+
+    elapsed = time.perf_counter() - start
+    # 入力ファイルの順に並べ直して保存
+    order = {s["name"]: i for i, s in enumerate(scenarios)}
+    summary = pd.DataFrame(rows).sort_values("scenario", key=lambda s: s.map(order)).reset_index(drop=True)
+    summary_path = _write_table(summary, args.out, "summary")
+    bands_path = _write_table(pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(), args.out, "bands")
+
+    n_failed = int((summary["status"] != "ok").sum())
+    print(
+        f"完了: {len(scenarios)} シナリオ（失敗 {n_failed}）, {elapsed:.1f}s, "
+        f"{len(scenarios) / elapsed:.2f} シナリオ/秒 -> {summary_path}, {bands_path}",
+        file=sys.stderr,
+    )
+    return 1 if n_failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,360 @@
+# utils とシミュレーションエンジンのベンチマーク（回帰検知付き）
+#
+# 例:
+#   python benchmark.py                     # 全ベンチマークを実行し、履歴に追記して前回までと比較
+#   python benchmark.py --quick             # 小さいサイズだけ（動作確認用）
+#   python benchmark.py -k withdrawal       # 名前に withdrawal を含むものだけ
+#   python benchmark.py --threshold 0.1     # 10% を超える悪化で失敗（既定 20%）
+#   python benchmark.py --calibrate         # 実行前の見積もり（utils.estimate_run）の係数を測定して cost_model.json に保存
+#   python benchmark.py -k import           # import utils の時間が予算（--import-budget）に収まるかだけ確認
+#
+# ネットワークは使わない。--data-dir を指定しなければ、固定シードの合成データをローカルストア形式で
+# 一時ディレクトリに作成し、LocalFileSource から読み込む（MARKET_DATA_SOURCE=local と同じ経路）。
+# 乱数はすべて固定シードなので、同じマシンなら計算内容は毎回同じになる。
+#
+# 結果（実時間・ピークメモリ・パス/秒）は --history の JSON に追記する。同じマシン・同じモードの直近
+# --baseline-runs 回の中央値と比べ、追跡対象のベンチマークが閾値を超えて悪化したら終了コード 1 で終わる。
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import utils
+
+
+BENCH_SEED = 20240901
+BENCH_TICKERS = ["VOO", "QQQ", "VT"]
+BENCH_START, BENCH_END = "2009-09-01", "2025-01-01"
+
+# パラメータの組（パス数 × 月数 × 取り崩し戦略）
+SIZES = {"full": {"paths": [1000, 10000], "months": [120, 360]}, "quick": {"paths": [1000], "months": [120]}}
+WITHDRAWAL_STRATEGIES = {
+    "consume": {},  # 既定（余剰は消費、不足は取り崩し額の範囲で生活）
+    "balanced": {"option1_2": "1-2-2", "option2_1": "2-1-2"},
+    "preserve": {"option1_1": "1-1-2", "option1_2": "1-2-3", "option2_1": "2-1-3", "option2_2": "2-2-2"},
+}
+
+# 見積もり係数の校正に使うサイズ（パス数, 月数）。2点の差から 1パス・1ヶ月あたりの係数を求める
+CALIBRATION_SIZES = [(1000, 120), (5000, 600)]
+
+# import utils の時間の予算（秒）。新しいプロセスで計測し、超えたら失敗（コンテナの起動が遅くなるのを防ぐ）
+IMPORT_BUDGET_S = float(os.getenv("IMPORT_BUDGET_S", "1.0"))
+# import utils の時点では読み込まない重いモジュール（utils は使う関数の中で読み込む）
+LAZY_MODULES = ["streamlit", "yfinance", "scipy.stats", "plotly.graph_objects"]
+
+# 悪化とみなさない差の下限（計測ノイズ対策）
+MIN_TIME_DELTA = 0.005         # 秒
+MIN_MEMORY_DELTA = 1 * 2**20   # バイト
+
+
+# 固定シードの合成日次OHLCをローカルストアに保存（相関のある3銘柄）
+def make_fixture(directory):
+    rng = np.random.default_rng(BENCH_SEED)
+    dates = pd.bdate_range("2005-01-03", "2025-06-30")
+    common = rng.normal(0.0003, 0.009, len(dates))
+    for i, ticker in enumerate(BENCH_TICKERS):
+        log_returns = common * (1 + 0.2 * i) + rng.normal(0, 0.004, len(dates))
+        close = 100 * np.exp(np.cumsum(log_returns))
+        df = pd.DataFrame({"Open": close, "High": close * 1.01, "Low": close * 0.99, "Close": close, "Volume": 1e6}, index=dates)
+        utils.save_ohlc(df, ticker, directory)
+
+
+# ベンチマークの定義 (名前, 関数, パス数, 追跡対象か) のリスト
+def build_benchmarks(mode):
+    sizes = SIZES[mode]
+    df_monthly = utils.load_monthly_data("VOO", BENCH_START, BENCH_END)
+    x = df_monthly['Log_Return'].values
+    log_returns = utils.load_monthly_portfolio_data(BENCH_TICKERS, BENCH_START, BENCH_END).values
+    skew_model = utils.fit_return_model("skewnorm", x)
+    benchmarks = []
+
+    def add(name, fn, n_paths=0, tracked=True):
+        benchmarks.append((name, fn, n_paths, tracked))
+
+    def load():
+        utils._DOWNLOAD_CACHE.clear()
+        utils.load_monthly_data("VOO", BENCH_START, BENCH_END)
+    add("load_monthly_data", load, tracked=False)  # ファイル I/O を含むので参考値
+
+    def fit_distribution():
+        utils._FIT_CACHE.clear()
+        utils.fit_distribution(df_monthly, "VOO")
+    add("fit_distribution", fit_distribution)
+
+    for kind in utils.RETURN_MODELS:
+        def fit(kind=kind):
+            utils._FIT_CACHE.clear()
+            utils.fit_return_model(kind, x)
+        add(f"fit[{kind}]", fit)
+
+    # パラメータの推定誤差を反映したモデル（元のモデルの推定 + 再標本化したデータへの当てはめ直し）
+    for kind in utils.UNCERTAINTY_BASE_MODELS:
+        def fit_uncertain(kind=kind):
+            utils._FIT_CACHE.clear()
+            utils.fit_return_model("uncertain", x, base=kind)
+        add(f"fit[uncertain:{kind}]", fit_uncertain)
+
+    for n_paths in sizes["paths"]:
+        def price_paths(n_paths=n_paths):
+            utils.monte_carlo_simulation_log(df_monthly, skew_model, n_sims=n_paths, rng=np.random.default_rng(BENCH_SEED))
+        add(f"monte_carlo_simulation_log[{n_paths}x{len(df_monthly)}]", price_paths, n_paths)
+
+        for n_months in sizes["months"]:
+            size = f"{n_paths}x{n_months}"
+            for kind in utils.RETURN_MODELS:
+                model = utils.fit_return_model(kind, x)
+
+                def sample(model=model, n_paths=n_paths, n_months=n_months):
+                    utils.sample_returns(model, n_paths, n_months, np.random.default_rng(BENCH_SEED))
+                add(f"sample_returns[{kind},{size}]", sample, n_paths)
+
+            # STEP2 の積立ループ（リターン生成 + 資産推移 + 目標到達月）
+            contributions = np.full(n_months, 5e4)
+
+            def accumulation(n_paths=n_paths, n_months=n_months, contributions=contributions):
+                r = utils.sample_returns(skew_model, n_paths, n_months, np.random.default_rng(BENCH_SEED))
+                paths = utils.simulate_accumulation(r, 1e6, contributions)
+                utils.months_to_target(paths, 3e7)
+            add(f"accumulation[{size}]", accumulation, n_paths)
+
+            # 取り崩しループ（リターンは事前に生成し、エンジン部分だけを計測）
+            r = utils.sample_returns(skew_model, n_paths, n_months, np.random.default_rng(BENCH_SEED))
+            for strategy, options in WITHDRAWAL_STRATEGIES.items():
+                def withdrawal(r=r, options=options):
+                    utils.simulate_withdrawal(r, 4000, 400, 20, 1.0, 10, 30, inflation_rate=2.0, **options)
+                add(f"withdrawal[{size},{strategy}]", withdrawal, n_paths)
+
+            portfolio_model = utils.fit_return_model("mvnormal", log_returns)
+
+            def portfolio(n_paths=n_paths, contributions=contributions):
+                utils.simulate_portfolio(
+                    portfolio_model, [50, 30, 20], n_paths, 1e6, contributions, 12,
+                    rng=np.random.default_rng(BENCH_SEED),
+                )
+            add(f"portfolio[{size}]", portfolio, n_paths)
+    return benchmarks
+
+
+# 1ベンチマークを計測（ウォームアップ1回、repeat 回の実時間の中央値、ピークメモリは別の1回で計測）
+def measure(fn, repeat):
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return statistics.median(times), min(times), peak
+
+
+# 新しいプロセスで import utils の時間を計測（repeat 回の中央値と最小値）し、読み込まれてしまった重いモジュールも返す
+def measure_import(repeat):
+    code = (
+        "import json, sys, time; start = time.perf_counter(); import utils; elapsed = time.perf_counter() - start; "
+        f"print(json.dumps([elapsed, [m for m in {LAZY_MODULES!r} if m in sys.modules]]))"
+    )
+    times, loaded = [], []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        elapsed, loaded = json.loads(out.stdout.strip().splitlines()[-1])
+        times.append(elapsed)
+    return statistics.median(times), min(times), loaded
+
+
+# utils.estimate_run の係数をエンジン（要約関数まで含む）ごとに測定
+def calibrate(repeat):
+    df_monthly = utils.load_monthly_data("VOO", BENCH_START, BENCH_END)
+    model = utils.fit_return_model("skewnorm", df_monthly['Log_Return'].values)
+    portfolio_model = utils.fit_return_model("mvnormal", utils.load_monthly_portfolio_data(BENCH_TICKERS, BENCH_START, BENCH_END).values)
+    withdrawal_kwargs = dict(initial_assets=4000, initial_savings=400, monthly_need=20, withdrawal_rate=1.0,
+                             min_savings_ratio=10, max_savings_ratio=30, inflation_rate=2.0)
+    seeds = iter(range(10**9))  # 毎回別のシナリオにして結果キャッシュに当たらないようにする
+    runners = {
+        "accumulation": lambda n_paths, n_months, chunk_size=None: utils.accumulation_summary(
+            model, n_paths, 1e6, np.full(n_months, 5e4), 3e7, seed=next(seeds), chunk_size=chunk_size),
+        "withdrawal": lambda n_paths, n_months, chunk_size=None: utils.withdrawal_summary(
+            model, n_paths, n_months, withdrawal_kwargs, seed=next(seeds), chunk_size=chunk_size),
+        "portfolio": lambda n_paths, n_months, chunk_size=None: utils.portfolio_summary(
+            portfolio_model, [50, 30, 20], n_paths, 1e6, np.full(n_months, 5e4), 3e7, seed=next(seeds), chunk_size=chunk_size),
+        # 月数の前半を積立、後半を取り崩しにする
+        "lifecycle": lambda n_paths, n_months, chunk_size=None: utils.lifecycle_summary(
+            model, n_paths, 100, np.full(n_months // 2, 5.0), {k: v for k, v in withdrawal_kwargs.items() if k != "initial_assets"},
+            n_months - n_months // 2, seed=next(seeds), chunk_size=chunk_size),
+    }
+    cost_model = {}
+    for engine, run in runners.items():
+        n_assets = len(BENCH_TICKERS) if engine == "portfolio" else 1
+        block = utils.PATH_BLOCK_SIZE
+        points = []
+        for n_paths, n_months in CALIBRATION_SIZES:
+            wall, _, peak = measure(lambda: run(n_paths, n_months), repeat)
+            points.append((n_paths * n_months * n_assets, wall, peak / n_months))
+        (w1, t1, _), (w2, t2, m2) = points
+        s_per_pm = max((t2 - t1) / (w2 - w1), 0.0)
+        # 月あたりのピーク = 1ブロックの作業領域（ブロックの行数に比例）+ 集計状態。ブロックを2倍にした実行との差から分ける
+        n_paths, n_months = CALIBRATION_SIZES[-1]
+        _, _, peak = measure(lambda: run(n_paths, n_months, 2 * block), 1)
+        bytes_per_pm = max((peak / n_months - m2) / (block * n_assets), 0.0)
+        state_bytes_per_month = max(m2 - bytes_per_pm * block * n_assets, 0.0)
+        cost_model[engine] = {
+            "overhead_s": max(t1 - s_per_pm * w1, 0.0),
+            "s_per_pm": s_per_pm,
+            "bytes_per_pm": bytes_per_pm,
+            "state_bytes_per_month": state_bytes_per_month,
+        }
+        print(f"{engine:<13} " + "  ".join(
+            f"{n_paths}x{n_months}: {t*1e3:.1f}ms, {m/1024:.0f}KB/月" for (n_paths, n_months), (_, t, m) in zip(CALIBRATION_SIZES, points))
+            + f"  作業領域 {bytes_per_pm:.1f}B/pm, 集計状態 {state_bytes_per_month/1024:.1f}KB/月")
+    return cost_model
+
+
+def _git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+# 同じマシン・同じモードの直近 n_runs 回の中央値をベンチマークごとに返す
+def baseline(history, machine, mode, n_runs):
+    runs = [run for run in history if run.get("machine") == machine and run.get("mode") == mode][-n_runs:]
+    names = {name for run in runs for name in run["results"]}
+    base = {}
+    for name in names:
+        values = [run["results"][name] for run in runs if name in run["results"]]
+        base[name] = {
+            "wall_s": statistics.median(v["wall_s"] for v in values),
+            "peak_bytes": statistics.median(v["peak_bytes"] for v in values),
+        }
+    return base
+
+
+# 閾値を超えた悪化の一覧
+def find_regressions(results, base, threshold, tracked):
+    regressions = []
+    for name, r in results.items():
+        b = base.get(name)
+        if b is None or name not in tracked:
+            continue
+        if r["wall_s"] > b["wall_s"] * (1 + threshold) and r["wall_s"] - b["wall_s"] > MIN_TIME_DELTA:
+            regressions.append(f"{name}: 実時間 {b['wall_s']*1e3:.1f}ms -> {r['wall_s']*1e3:.1f}ms")
+        if r["peak_bytes"] > b["peak_bytes"] * (1 + threshold) and r["peak_bytes"] - b["peak_bytes"] > MIN_MEMORY_DELTA:
+            regressions.append(f"{name}: ピークメモリ {b['peak_bytes']/2**20:.1f}MB -> {r['peak_bytes']/2**20:.1f}MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="utils とシミュレーションエンジンのベンチマーク")
+    parser.add_argument("--quick", action="store_true", help="小さいサイズだけ実行する")
+    parser.add_argument("-k", dest="filter", default="", help="名前にこの文字列を含むベンチマークだけ実行する")
+    parser.add_argument("--repeat", type=int, default=5, help="計測の繰り返し回数（中央値を採用）")
+    parser.add_argument("--data-dir", default=None, help="ローカルストアのディレクトリ（既定: 合成データを一時作成）")
+    parser.add_argument("--history", default="benchmark_history.json", help="結果を追記する JSON ファイル")
+    parser.add_argument("--threshold", type=float, default=0.2, help="悪化とみなす割合（0.2 = 20%%）")
+    parser.add_argument("--baseline-runs", type=int, default=5, help="比較対象にする直近の実行回数")
+    parser.add_argument("--no-record", action="store_true", help="履歴に追記しない")
+    parser.add_argument("--calibrate", action="store_true", help="見積もりの係数を測定して --cost-model に保存する")
+    parser.add_argument("--cost-model", default=utils.COST_MODEL_PATH, help="見積もり係数の保存先")
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET_S, help="import utils の時間の上限（秒）")
+    args = parser.parse_args()
+    mode = "quick" if args.quick else "full"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = args.data_dir
+        if data_dir is None:
+            data_dir = os.path.join(tmp, "market")
+            make_fixture(data_dir)
+        utils.set_data_source(utils.LocalFileSource(data_dir))
+
+        if args.calibrate:
+            utils.RESULT_CACHE = utils.ResultCache(directory=os.path.join(tmp, "result_cache"))
+            cost_model = calibrate(args.repeat)
+            with open(args.cost_model, "w", encoding="utf-8") as f:
+                json.dump(cost_model, f, indent=1)
+            print(f"見積もり係数を保存しました: {args.cost_model}")
+            return 0
+
+        benchmarks = [b for b in build_benchmarks(mode) if args.filter in b[0]]
+        results = {}
+        over_budget = []
+        width = max((len(b[0]) for b in benchmarks), default=0)
+        width = max(width, len("import[utils]"))
+        print(f"{'benchmark':<{width}}  {'wall(ms)':>10}  {'min(ms)':>10}  {'peak(MB)':>9}  {'paths/s':>12}")
+        # 起動時間（import utils）は予算と比べる。重いモジュールが読み込まれていれば予算内でも失敗
+        if args.filter in "import[utils]":
+            wall, best, loaded = measure_import(args.repeat)
+            results["import[utils]"] = {"wall_s": wall, "min_s": best, "peak_bytes": 0, "paths_per_s": None}
+            print(f"{'import[utils]':<{width}}  {wall*1e3:>10.2f}  {best*1e3:>10.2f}  {'-':>9}  {'-':>12}")
+            if wall > args.import_budget:
+                over_budget.append(f"import[utils]: {wall:.2f}s（予算 {args.import_budget:.2f}s）")
+            if loaded:
+                over_budget.append(f"import[utils]: 遅延読み込みのはずのモジュールが読み込まれています: {', '.join(loaded)}")
+        for name, fn, n_paths, _ in benchmarks:
+            wall, best, peak = measure(fn, args.repeat)
+            results[name] = {"wall_s": wall, "min_s": best, "peak_bytes": peak,
+                             "paths_per_s": n_paths / wall if n_paths else None}
+            rate = f"{n_paths / wall:>12,.0f}" if n_paths else f"{'-':>12}"
+            print(f"{name:<{width}}  {wall*1e3:>10.2f}  {best*1e3:>10.2f}  {peak/2**20:>9.1f}  {rate}")
+
+    machine = f"{platform.node()}|{platform.machine()}|{platform.processor() or platform.system()}"
+    history = load_history(args.history)
+    base = baseline(history, machine, mode, args.baseline_runs)
+    tracked = {b[0] for b in benchmarks if b[3]}
+    regressions = find_regressions(results, base, args.threshold, tracked)
+
+    if not args.no_record:
+        history.append({
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "machine": machine,
+            "mode": mode,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "results": results,
+        })
+        with open(args.history, "w", encoding="utf-8") as f:
+            json.dump(history, f, ensure_ascii=False, indent=1)
+
+    if over_budget:
+        print("起動時間の予算を超えています:")
+        for line in over_budget:
+            print(f"  {line}")
+    if not base:
+        print("比較対象の履歴がありません（今回の結果が次回以降の基準になります）")
+    elif regressions:
+        print(f"{args.threshold*100:.0f}% を超える悪化があります:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    else:
+        print(f"直近 {args.baseline_runs} 回の中央値と比べて {args.threshold*100:.0f}% を超える悪化はありません")
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,37 @@
+# ローカルの市場データストア（MARKET_DATA_DIR）への一括取り込み
+#
+# 例:
+#   python import_market_data.py path/to/csv_dir            # <ティッカー>.csv / .parquet をまとめて取り込む
+#   python import_market_data.py --download VOO QQQ VT QLD  # Yahoo! Finance から取得して保存（オフライン用の準備）
+#
+# 取り込み後は MARKET_DATA_SOURCE=local で起動すると、ネットワークなしでアプリ・ベンチマークが動作する。
+import argparse
+import utils
+
+
+def main():
+    parser = argparse.ArgumentParser(description="月次OHLCデータをローカルストアに取り込む")
+    parser.add_argument("src_dir", nargs="?", help="<ティッカー>.csv / .parquet が置かれたディレクトリ")
+    parser.add_argument("--download", nargs="+", metavar="TICKER", help="Yahoo! Finance から取得して保存するティッカー")
+    parser.add_argument("--store", default=utils.MARKET_DATA_DIR, help="保存先ディレクトリ（既定: MARKET_DATA_DIR）")
+    parser.add_argument("--format", choices=["parquet", "csv"], default=None, help="保存形式（既定: parquet が使えれば parquet）")
+    args = parser.parse_args()
+
+    if not args.src_dir and not args.download:
+        parser.error("src_dir か --download のどちらかを指定してください。")
+
+    if args.src_dir:
+        for ticker, path in utils.import_market_data_dir(args.src_dir, args.store, args.format).items():
+            print(f"{ticker}: {path}")
+
+    for ticker in args.download or []:
+        df = utils.YFinanceSource().fetch((ticker,))
+        if df.empty:
+            print(f"{ticker}: 取得できませんでした")
+            continue
+        path = utils.save_ohlc(df.xs(ticker, axis=1, level="Ticker"), ticker, args.store, args.format)
+        print(f"{ticker}: {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+# 長い計算の進捗通知・中断と、サーバー全体のジョブキュー（同時実行数の制限とユーザー間の公平性）
+#
+# エンジンは control（RunControl）を受け取り、チャンクごとに control.update(done, total) を呼ぶ。
+# ページは run_in_queue でジョブを投入し、順番待ち・進捗を表示しながら結果を待つ（再描画されたら RunCancelled）。
+import contextvars
+import os
+import threading
+from collections import OrderedDict
+
+
+# -------------------------
+# --- 長い計算の進捗通知と中断 ---
+# -------------------------
+PROGRESS_EVERY_MONTHS = 12  # 一括計算のとき、何ヶ月ごとに進捗を通知するか
+
+
+# 中断された計算
+class RunCancelled(Exception):
+    pass
+
+
+# 1回の実行の進捗通知と中断（エンジンはチャンクごと、一括計算なら PROGRESS_EVERY_MONTHS ヶ月ごとに update を呼ぶ）
+class RunControl:
+    def __init__(self, on_progress=None):
+        self.on_progress = on_progress  # 進捗（0〜1）を受け取る関数
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        if self._cancelled.is_set():
+            raise RunCancelled()
+
+    def update(self, done, total):
+        self.check()
+        if self.on_progress is not None:
+            self.on_progress(min(done / total, 1.0))
+
+
+# セッションの新しい実行を開始（同じキーで実行中の古い実行は中断する）
+def begin_run(state, key, on_progress=None):
+    cancel_run(state, key)
+    control = RunControl(on_progress)
+    state[key] = control
+    return control
+
+
+# セッションで実行中の計算を中断（入力が変わって再描画されたときなど）
+def cancel_run(state, key):
+    control = state.get(key)
+    if control is not None:
+        control.cancel()
+
+
+# -------------------------
+# --- サーバー全体のジョブキュー（同時実行数の制限とユーザー間の公平性） ---
+# -------------------------
+JOB_BLAS_THREADS = int(os.getenv("JOB_BLAS_THREADS", "1"))  # 1ジョブが使う BLAS/OpenMP のスレッド数
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", max(1, (os.cpu_count() or 1) // JOB_BLAS_THREADS)))  # 同時に実行するジョブ数
+
+
+# BLAS/OpenMP のスレッド数を制限（ジョブ数 × スレッド数がコア数を超えないようにする）
+def limit_blas_threads(n_threads=JOB_BLAS_THREADS):
+    for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ.setdefault(var, str(n_threads))  # これから起動するプロセス向け
+    try:
+        from threadpoolctl import threadpool_limits  # 読み込み済みの BLAS に反映する場合のみ必要
+    except ImportError:
+        return None
+    return threadpool_limits(limits=n_threads)
+
+
+# キューに投入された1件のジョブ
+class Job:
+    def __init__(self, user, fn, args, kwargs, control):
+        self.user = user
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.control = control
+        self.context = contextvars.copy_context()  # 呼び出し元の計測（span）をワーカーでも引き継ぐ（入れ子はスレッドごと）
+        self.progress = 0.0
+        self.started = False
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def _set_progress(self, fraction):
+        self.progress = fraction
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def result(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+# 同時実行数を制限するジョブキュー（ユーザーごとの列から順番に1件ずつ取り出す）
+class JobScheduler:
+    def __init__(self, n_workers=JOB_WORKERS):
+        self.n_workers = n_workers
+        self._queues = OrderedDict()  # ユーザー -> 待ち行列（取り出すたびに末尾へ回す）
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def _start_workers(self):
+        if self._threads:
+            return
+        limit_blas_threads()
+        for i in range(self.n_workers):
+            thread = threading.Thread(target=self._worker, name=f"simulation-job-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # ジョブを投入（control を渡せば、中断と進捗をジョブ経由で扱う）
+    def submit(self, user, fn, *args, control=None, **kwargs):
+        control = RunControl() if control is None else control
+        job = Job(user, fn, args, {**kwargs, "control": control}, control)
+        if control.on_progress is None:
+            control.on_progress = job._set_progress
+        with self._cond:
+            self._start_workers()
+            self._queues.setdefault(user, []).append(job)
+            self._cond.notify()
+        return job
+
+    # 実行待ちの順番（0 なら実行中または完了）
+    def position(self, job):
+        with self._cond:
+            if job.started or job.done():
+                return 0
+            order = self._dispatch_order()
+        return order.index(job) + 1 if job in order else 0
+
+    # 現在の待ち行列をユーザー間で1件ずつ交互に並べた順序
+    def _dispatch_order(self):
+        queues = [list(q) for q in self._queues.values()]
+        order = []
+        while any(queues):
+            for q in queues:
+                if q:
+                    order.append(q.pop(0))
+        return order
+
+    def _next_job(self):
+        for user in list(self._queues):
+            queue = self._queues[user]
+            if queue:
+                job = queue.pop(0)
+                self._queues.move_to_end(user)  # 次は別のユーザーを優先
+                if not queue:
+                    del self._queues[user]
+                return job
+            del self._queues[user]
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                job.started = True
+            try:
+                job.control.check()  # 待っている間に中断されたジョブは実行しない
+                job._result = job.context.run(job.fn, *job.args, **job.kwargs)
+            except BaseException as e:
+                job._error = e
+            finally:
+                job._done.set()
+
+
+JOB_SCHEDULER = JobScheduler()
+
+
+# 現在の Streamlit セッションの ID（ジョブキューでユーザーを区別する）
+def session_id():
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else "local"
+
+
+# ジョブをサーバー全体のキューに投入し、順番待ち・進捗を表示しながら結果を待つ（ページ用）
+def run_in_queue(state, key, fn, *args, **kwargs):
+    """再描画で待ちが打ち切られた場合や begin_run/cancel_run で中断された場合は RunCancelled。"""
+    control = begin_run(state, key)
+    job = JOB_SCHEDULER.submit(session_id(), fn, *args, control=control, **kwargs)
+    import streamlit as st
+    status = st.empty()
+    progress_bar = st.progress(0.0, text="シミュレーション中...")
+    try:
+        while not job.wait(0.1):
+            position = JOB_SCHEDULER.position(job)
+            if position > 0:
+                status.info(f"他のユーザーのシミュレーションが実行中です。順番待ち: {position} 番目")
+            else:
+                status.empty()
+                progress_bar.progress(job.progress, text=f"シミュレーション中... {job.progress*100:.0f}%")
+        return job.result()
+    finally:
+        # 待っている途中で再描画されたら、ジョブも中断してワーカーを空ける
+        if not job.done():
+            control.cancel()
+        status.empty()
+        progress_bar.empty()
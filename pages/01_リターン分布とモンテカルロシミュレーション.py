@@ -1,13 +1,18 @@
 import streamlit as st
-import numpy as np
-import plotly.graph_objects as go
 from datetime import datetime
 from datetime import datetime
+import profiling
 import utils
 
 # キャッシュをクリアして実行
 st.cache_data.clear()
 
+# 既定ティッカーの市場データを裏で先読み（プロセス内で1回だけ）
+utils.start_background_prefetch()
+
+# このページの描画をステージごとに計測（?perf=1 または PERF_PANEL=1 で末尾に表示）
+profiler = profiling.page_profiler(st.session_state, "01_リターン分布")
+
 #######################################################################################################################
 # -------------------------
 # --- 月次データに対する分布当てはめ ---
@@ -50,6 +55,26 @@ end_date = f"{end_year}-{end_month:02d}-01" # フォーマットを整える (YY
 st.write(f"選択されたティッカー: **{ticker}**")
 st.write(f"期間: **{start_date} 〜 {end_date or '現在'}**")
 
+# リターンモデル選択
+return_model_label = st.selectbox(
+    "リターンモデル（シミュレーションに用いる月次リターンの生成方法）",
+    list(utils.RETURN_MODELS.values()),
+)
+return_model = next(k for k, v in utils.RETURN_MODELS.items() if v == return_model_label)
+mean_block_length = 12
+if return_model == "bootstrap":
+    mean_block_length = st.number_input(
+        "平均ブロック長（月）", min_value=1, max_value=60, value=12,
+        help="実績リターンをこの平均長さ（幾何分布）のブロック単位で再標本化します。長いほど過去の変動の偏り（ボラティリティの集中）を保ちます。"
+    )
+parameter_uncertainty = False
+if return_model in utils.UNCERTAINTY_BASE_MODELS:
+    parameter_uncertainty = st.checkbox(
+        "パラメータの推定誤差を反映する",
+        help="実績リターンを再標本化して推定し直したパラメータを多数用意し、パスのまとまりごとに異なるパラメータで生成します。"
+             "限られた期間のデータから推定した期待リターン・リスクの不確かさが、結果の幅に加わります。"
+    )
+
 # Streamlitに描画するスペースを確保
 chart_placeholder = st.empty()
 
@@ -64,13 +89,23 @@ if df_monthly.empty:
 # -------------------------
 # --- 対数リターンヒストグラム ---
 # -------------------------
-skew_params, fig, summary_table = utils.fit_distribution(df_monthly, ticker)
+# ブートストラップはスキュー付き正規分布を使わないので、当てはめ（skewnorm.fit）を省略する
+skew_params, fig, summary_table = utils.fit_distribution(df_monthly, ticker, fit_skew=(return_model != "bootstrap"))
+# シミュレーションに用いるリターンモデルを推定（推定結果はキャッシュされ、同じデータでは再推定しない）
+model_params = {"mean_block_length": mean_block_length} if return_model == "bootstrap" else {}
+model = utils.fit_return_model(return_model, df_monthly['Log_Return'].values, **model_params)
+if parameter_uncertainty:
+    model = utils.fit_return_model("uncertain", df_monthly['Log_Return'].values, base=return_model)
 
 # Streamlit に描画（古いグラフは置き換え）
-chart_placeholder.plotly_chart(fig, use_container_width=True, clear_figure=True)
+with profiling.span("plotly_chart", figure="fig"):
+    chart_placeholder.plotly_chart(fig, use_container_width=True, clear_figure=True)
 
-st.markdown("**統計量サマリー(正規分布 vs スキュー付き正規分布)**")
+st.markdown("**統計量サマリー(正規分布)**" if skew_params is None else "**統計量サマリー(正規分布 vs スキュー付き正規分布)**")
 st.table(summary_table)
+if parameter_uncertainty:
+    st.markdown(f"**パラメータの推定誤差（再標本化して推定し直した {model.n_draws} 組の分布）**")
+    st.table(utils.uncertainty_table(model))
 
 # --- 補足説明 ---
 st.markdown("""
@@ -86,33 +121,34 @@ st.markdown("""
 # -------------------------
 # --- モンテカルロシミュレーション対数株価 ---
 # -------------------------
-log_price_paths = utils.monte_carlo_simulation_log(df_monthly, skew_params, n_sims=5000)
-# パーセンタイル（対数価格）
-percentiles_log = np.percentile(log_price_paths, [2.5, 50, 97.5], axis=0)
+# パーセンタイル（対数価格）：同じシナリオの結果は全ユーザー共有のキャッシュから返す
+price_bands = utils.price_path_bands(df_monthly, model, n_sims=5000)
+percentiles_log = price_bands["percentiles_log"]
 # 実際の対数株価
 actual_log_prices = df_monthly['Log_Close'].values
 dates = df_monthly.index
 
 # --- グラフ描画 ---
-fig2 = go.Figure()
-# シミュレーション（2.5%・50%・97.5%ライン）
-fig2.add_trace(go.Scatter(
-    x=dates, y=percentiles_log[0], mode='lines',
+fig2 = utils.chart_figure("plotly_white")
+# シミュレーション（2.5%・50%・97.5%ライン、帯の上下は同じ位置で間引く）
+band_index = utils.band_index(percentiles_log)
+fig2.add_trace(utils.line_trace(
+    dates, percentiles_log[0], index=band_index, mode='lines',
     name="シミュレーション下限 (2.5%)", line=dict(color='red', dash='dot')
 ))
-fig2.add_trace(go.Scatter(
-    x=dates, y=percentiles_log[2], mode='lines',
+fig2.add_trace(utils.line_trace(
+    dates, percentiles_log[2], index=band_index, mode='lines',
     name="シミュレーション上限 (97.5%)",
     fill="tonexty", fillcolor="rgba(173,216,230,0.2)",
     line=dict(color='green', dash='dot')
 ))
-# 実際の対数株価
-fig2.add_trace(go.Scatter(
-    x=dates, y=actual_log_prices, mode='lines+markers',
+# 実際の対数株価（実測値なので間引かない）
+fig2.add_trace(utils.line_trace(
+    dates, actual_log_prices, max_points=0, mode='lines+markers',
     name="実際の対数株価", line=dict(color='black', width=2)
 )) 
-fig2.add_trace(go.Scatter(
-    x=dates, y=percentiles_log[1], mode='lines',
+fig2.add_trace(utils.line_trace(
+    dates, percentiles_log[1], index=band_index, mode='lines',
     name="シミュレーション中央値 (50%)", line=dict(color='blue', width=2)
 ))
 
@@ -120,12 +156,11 @@ fig2.update_layout(
     #title_text=f"{ticker} の対数チャート<br>&モンテカルロシミュレーション<br>（スキュー付き正規分布）",
     xaxis_title="日付",
     yaxis_title="対数チャート",
-    template="plotly_white",
     height=500
 )
 fig2.update_layout(
     title=dict(
-        text=f"{ticker} の対数チャート<br>&モンテカルロシミュレーション<br>（スキュー付き正規分布）",
+        text=f"{ticker} の対数チャート<br>&モンテカルロシミュレーション<br>（{utils.RETURN_MODELS[return_model]}）",
         x=0.5,   # 中央揃え
         xanchor='center',
         y=0.90,   # 上から少し下げる（デフォルトは1.0）
@@ -146,14 +181,22 @@ graph_container = st.container()
 
 #１回分のシミュレーション結果を追加描画
 if st.button("シミュレーション例描画"):
-    one_path = utils.monte_carlo_simulation_log(df_monthly, skew_params, n_sims=1)
+    one_path = utils.monte_carlo_simulation_log(df_monthly, model, n_sims=1)
     one_path = one_path[0]
-    fig2.add_trace(go.Scatter(
-        x=dates, y=one_path, mode="lines",
+    fig2.add_trace(utils.line_trace(
+        dates, one_path, mode="lines",
         name="シミュレーション1例",
         line=dict(color="red", width=1)
     ))
 
 # ---- グラフ描画（ここが1回だけ）----
 with graph_container:
-    st.plotly_chart(fig2, use_container_width=True)
+    with profiling.span("plotly_chart", figure="fig2"):
+        st.plotly_chart(fig2, use_container_width=True)
+
+# 株価パスのリスク指標（シミュレーションと同じ計算で集計した分布）
+st.markdown("**株価パスのリスク指標（5000 試行の分布）**")
+st.table(utils.risk_table(utils.risk_percentiles(price_bands)))
+
+# 計測結果（パフォーマンス欄・構造化ログ）
+utils.render_performance(profiler)
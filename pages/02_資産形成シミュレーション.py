@@ -1,14 +1,24 @@
 import streamlit as st
 import numpy as np
-from scipy.stats import skewnorm
 import plotly.graph_objects as go
 from datetime import datetime
 import pandas as pd
+import jobs
+import profiling
 import utils
 
 # キャッシュをクリアして実行
 st.cache_data.clear()
 
+# 既定ティッカーの市場データを裏で先読み（プロセス内で1回だけ）
+utils.start_background_prefetch()
+
+# このページの描画をステージごとに計測（?perf=1 または PERF_PANEL=1 で末尾に表示）
+profiler = profiling.page_profiler(st.session_state, "02_資産形成")
+
+# 再描画（入力の変更・再クリック）されたら、このセッションで実行中の古いシミュレーションを中断する
+jobs.cancel_run(st.session_state, "run_step2")
+
 #######################################################################################################################
 # -------------------------
 # --- 月次データに対する分布当てはめ ---
@@ -51,6 +61,26 @@ end_date = f"{end_year}-{end_month:02d}-01" # フォーマットを整える (YY
 st.write(f"選択されたティッカー: **{ticker}**")
 st.write(f"期間: **{start_date} 〜 {end_date or '現在'}**")
 
+# リターンモデル選択
+return_model_label = st.selectbox(
+    "リターンモデル（シミュレーションに用いる月次リターンの生成方法）",
+    list(utils.RETURN_MODELS.values()),
+)
+return_model = next(k for k, v in utils.RETURN_MODELS.items() if v == return_model_label)
+mean_block_length = 12
+if return_model == "bootstrap":
+    mean_block_length = st.number_input(
+        "平均ブロック長（月）", min_value=1, max_value=60, value=12,
+        help="実績リターンをこの平均長さ（幾何分布）のブロック単位で再標本化します。長いほど過去の変動の偏り（ボラティリティの集中）を保ちます。"
+    )
+parameter_uncertainty = False
+if return_model in utils.UNCERTAINTY_BASE_MODELS:
+    parameter_uncertainty = st.checkbox(
+        "パラメータの推定誤差を反映する",
+        help="実績リターンを再標本化して推定し直したパラメータを多数用意し、パスのまとまりごとに異なるパラメータで生成します。"
+             "限られた期間のデータから推定した期待リターン・リスクの不確かさが、結果の幅に加わります。"
+    )
+
 # Streamlitに描画するスペースを確保
 chart_placeholder = st.empty()
 
@@ -65,13 +95,23 @@ if df_monthly.empty:
 # -------------------------
 # --- 対数リターンヒストグラム ---
 # -------------------------
-skew_params, fig, summary_table = utils.fit_distribution(df_monthly, ticker)
+# ブートストラップはスキュー付き正規分布を使わないので、当てはめ（skewnorm.fit）を省略する
+skew_params, fig, summary_table = utils.fit_distribution(df_monthly, ticker, fit_skew=(return_model != "bootstrap"))
+# シミュレーションに用いるリターンモデルを推定（推定結果はキャッシュされ、同じデータでは再推定しない）
+model_params = {"mean_block_length": mean_block_length} if return_model == "bootstrap" else {}
+model = utils.fit_return_model(return_model, df_monthly['Log_Return'].values, **model_params)
+if parameter_uncertainty:
+    model = utils.fit_return_model("uncertain", df_monthly['Log_Return'].values, base=return_model)
 
 # Streamlit に描画（古いグラフは置き換え）
-chart_placeholder.plotly_chart(fig, use_container_width=True, clear_figure=True)
+with profiling.span("plotly_chart", figure="fig"):
+    chart_placeholder.plotly_chart(fig, use_container_width=True, clear_figure=True)
 
-st.markdown("**統計量サマリー(正規分布 vs スキュー付き正規分布)**")
+st.markdown("**統計量サマリー(正規分布)**" if skew_params is None else "**統計量サマリー(正規分布 vs スキュー付き正規分布)**")
 st.table(summary_table)
+if parameter_uncertainty:
+    st.markdown(f"**パラメータの推定誤差（再標本化して推定し直した {model.n_draws} 組の分布）**")
+    st.table(utils.uncertainty_table(model))
 
 # --- 補足説明 ---
 st.markdown("""
@@ -86,33 +126,33 @@ st.markdown("""
 # -------------------------
 # --- モンテカルロシミュレーション対数株価 ---
 # -------------------------
-log_price_paths = utils.monte_carlo_simulation_log(df_monthly, skew_params, n_sims=5000)
-# パーセンタイル（対数価格）
-percentiles_log = np.percentile(log_price_paths, [2.5, 50, 97.5], axis=0)
+# パーセンタイル（対数価格）：同じシナリオの結果は全ユーザー共有のキャッシュから返す
+percentiles_log = utils.price_path_bands(df_monthly, model, n_sims=5000)["percentiles_log"]
 # 実際の対数株価
 actual_log_prices = df_monthly['Log_Close'].values
 dates = df_monthly.index
 
 # --- グラフ描画 ---
-fig2 = go.Figure()
-# シミュレーション（2.5%・50%・97.5%ライン）
-fig2.add_trace(go.Scatter(
-    x=dates, y=percentiles_log[0], mode='lines',
+fig2 = utils.chart_figure("plotly_white")
+# シミュレーション（2.5%・50%・97.5%ライン、帯の上下は同じ位置で間引く）
+band_index = utils.band_index(percentiles_log)
+fig2.add_trace(utils.line_trace(
+    dates, percentiles_log[0], index=band_index, mode='lines',
     name="シミュレーション下限 (2.5%)", line=dict(color='red', dash='dot')
 ))
-fig2.add_trace(go.Scatter(
-    x=dates, y=percentiles_log[2], mode='lines',
+fig2.add_trace(utils.line_trace(
+    dates, percentiles_log[2], index=band_index, mode='lines',
     name="シミュレーション上限 (97.5%)",
     fill="tonexty", fillcolor="rgba(173,216,230,0.2)",
     line=dict(color='green', dash='dot')
 ))
-# 実際の対数株価
-fig2.add_trace(go.Scatter(
-    x=dates, y=actual_log_prices, mode='lines+markers',
+# 実際の対数株価（実測値なので間引かない）
+fig2.add_trace(utils.line_trace(
+    dates, actual_log_prices, max_points=0, mode='lines+markers',
     name="実際の対数株価", line=dict(color='black', width=2)
 )) 
-fig2.add_trace(go.Scatter(
-    x=dates, y=percentiles_log[1], mode='lines',
+fig2.add_trace(utils.line_trace(
+    dates, percentiles_log[1], index=band_index, mode='lines',
     name="シミュレーション中央値 (50%)", line=dict(color='blue', width=2)
 ))
 
@@ -120,12 +160,11 @@ fig2.update_layout(
     #title_text=f"{ticker} の対数チャート<br>&モンテカルロシミュレーション<br>（スキュー付き正規分布）",
     xaxis_title="日付",
     yaxis_title="対数チャート",
-    template="plotly_white",
     height=500
 )
 fig2.update_layout(
     title=dict(
-        text=f"{ticker} の対数チャート<br>&モンテカルロシミュレーション<br>（スキュー付き正規分布）",
+        text=f"{ticker} の対数チャート<br>&モンテカルロシミュレーション<br>（{utils.RETURN_MODELS[return_model]}）",
         x=0.5,   # 中央揃え
         xanchor='center',
         y=0.90,   # 上から少し下げる（デフォルトは1.0）
@@ -146,17 +185,18 @@ graph_container = st.container()
 
 #１回分のシミュレーション結果を追加描画
 if st.button("シミュレーション例描画"):
-    one_path = utils.monte_carlo_simulation_log(df_monthly, skew_params, n_sims=1)
+    one_path = utils.monte_carlo_simulation_log(df_monthly, model, n_sims=1)
     one_path = one_path[0]
-    fig2.add_trace(go.Scatter(
-        x=dates, y=one_path, mode="lines",
+    fig2.add_trace(utils.line_trace(
+        dates, one_path, mode="lines",
         name="シミュレーション1例",
         line=dict(color="red", width=1)
     ))
 
 # ---- グラフ描画（ここが1回だけ）----
 with graph_container:
-    st.plotly_chart(fig2, use_container_width=True)
+    with profiling.span("plotly_chart", figure="fig2"):
+        st.plotly_chart(fig2, use_container_width=True)
 
 
 #######################################################################################################################
@@ -211,24 +251,25 @@ st.markdown("""
 - 「行を追加」で複数の積立パターンを入力可能
 """)
 
+# スケジュールは行の辞書のリストで保存し、表示のたびに DataFrame に戻す（セッションに DataFrame を持たない）
 if 'schedule' not in st.session_state:
-    st.session_state.schedule = pd.DataFrame([{
+    st.session_state.schedule = [{
         "開始年": start_year,
         "開始月": start_month,
         "終了年": start_year + 1,
         "終了月": start_month,
         "毎月積立額(万円)": 0,
         "年初一括額(1月)(万円)": 0
-    }])
+    }]
 
 schedule_df_edited = st.data_editor(
-    st.session_state.schedule,
+    pd.DataFrame(st.session_state.schedule),
     num_rows="dynamic",
     use_container_width=True,
 )
 
 # 空の場合は計算を止める
-if st.session_state.schedule.empty:
+if not st.session_state.schedule:
     st.warning("積立スケジュールを入力してください。")
     st.stop()
 st.markdown("※必要に応じて行を追加・削除して投資シナリオを自由に設定できます。")
@@ -271,10 +312,46 @@ with col_y:
     y_max = st.number_input("縦軸最大値（万円）", value=10000, key="y_max_input_step2")
 
 
+# シミュレーション回数（「試行を追加」では前回の結果に追加分だけを計算して足す）
+n_sims = 5000
+n_sims_added = 5000
+# 実行前の見積もり（メモリ予算を超える場合は単精度で計算する）
+run_plan = utils.plan_run("accumulation", n_sims, n_months)
+st.caption(utils.describe_plan(run_plan))
+# 結果の計算に使う入力（前回の結果と同じときだけ「試行を追加」できる）
+input_key = utils.scenario_key(
+    "step2", model=model, initial_investment=initial_investment, target_amount=target_amount,
+    start=(start_year, start_month), n_months=n_months, schedule=schedule_df_edited.to_dict("records"),
+)
+
+# 結果はセッションごとのメモリ予算の中で保存する（グラフは保存せず、表示のたびに作り直す）
+results = utils.session_results(st.session_state)
+
 # -------------------------
 # シミュレーションボタン
 # -------------------------
-if st.button("▶ シミュレーション実行(STEP2)"):
+# 追加分は前回と同じブロック・dtype で計算し、保存済みの集計に続ける（そのままでは予算に収まらなければ追加しない）
+previous = results.get("step2") if results.matches_input("step2", input_key) else None
+add_plan = utils.plan_added_run("accumulation", previous["run_plan"], previous["n_sims"] + n_sims_added, n_months) if previous else None
+
+col_run, col_add = st.columns(2)
+with col_run:
+    run_clicked = st.button("▶ シミュレーション実行(STEP2)")
+with col_add:
+    add_clicked = st.button(
+        f"＋ 試行を{n_sims_added:,}回追加して精度を上げる", disabled=add_plan is None or add_plan["mode"] == "refuse", key="add_step2",
+        help=add_plan["reason"] if add_plan and add_plan["reason"] else "前回と同じ入力のときだけ追加できます（入力を変えたら実行し直してください）",
+    )
+if add_clicked:
+    n_sims = previous["n_sims"] + n_sims_added
+    run_plan = add_plan
+
+if run_clicked or add_clicked:
+    # 予算を超えるシナリオは実行しない
+    if run_plan["mode"] == "refuse":
+        st.error(f"{run_plan['reason']}。期間か試行回数を減らしてください。")
+        st.stop()
+
     df = schedule_df_edited.copy()
 
     #入力チェック
@@ -302,93 +379,72 @@ if st.button("▶ シミュレーション実行(STEP2)"):
         st.stop()
 
     # ここまで通ればOK → デフォルト値補完後のクリーンデータを保存
-    st.session_state.schedule = df
+    st.session_state.schedule = df.to_dict("records")
     # st.success("入力チェック完了。シミュレーションを開始します。")
 
     # 毎月積立額と年初一括額の配列作成
-    monthly_contributions = np.zeros(n_months)
-    for i, row in st.session_state.schedule.iterrows():
-        # 月次積立
-        for y in range(int(row["開始年"]), int(row["終了年"])+1):
-            for m in range(1, 13):
-                # 月インデックス計算
-                month_idx = (y - start_year) * 12 + (m - start_month)
-                if month_idx < 0 or month_idx >= n_months:
-                    continue
-                # 月次積立
-                monthly_contributions[month_idx] += row["毎月積立額(万円)"]
-        # 年初一括
-        if row["年初一括額(1月)(万円)"] > 0:
-            first_year = int(row["開始年"]) if int(row["開始月"]) == 1 else int(row["開始年"])+1
-            for y in range(first_year, int(row["終了年"])+1):
-                month_idx = (y - start_year) * 12  # 1月
-                if 0 <= month_idx < n_months:
-                    monthly_contributions[month_idx] += row["年初一括額(1月)(万円)"]
+    schedule_rows = df[
+        ["開始年", "開始月", "終了年", "終了月", "毎月積立額(万円)", "年初一括額(1月)(万円)"]
+    ].itertuples(index=False)
+    monthly_contributions = utils.build_monthly_contributions(schedule_rows, start_year, start_month, n_months)
 
     # --- モンテカルロシミュレーション ---
-    # シミュレーション回数
-    n_sims = 5000
-
-    # STEP.1で推定したスキュー付き正規分布パラメータ
-    a, loc, scale = skew_params
-
-    # 月次リターンシミュレーション
-    simulated_log_returns = skewnorm.rvs(a, loc=loc, scale=scale, size=(n_sims, n_months))
-
-    # 累積資産計算
-    asset_paths = np.zeros_like(simulated_log_returns)
-    asset_paths[:, 0] = initial_investment * 1e4 + monthly_contributions[0]*1e4  # 単位: 円
-    for t in range(1, n_months):
-        asset_paths[:, t] = asset_paths[:, t-1] * np.exp(simulated_log_returns[:, t]) + monthly_contributions[t]*1e4
-
-    # パーセンタイル（2.5%,50%,97.5%）
-    percentiles = np.percentile(asset_paths, [2.5,50,97.5], axis=0)
+    # STEP.1で選択したリターンモデルで資産推移を計算し、パーセンタイル帯と目標到達までの期間分布に要約（単位: 円）
+    # 同じシナリオの結果は全ユーザー共有のキャッシュから返す
+    # サーバー全体のジョブキューで実行し、順番待ち・進捗を表示（再描画されたら中断）
+    try:
+        summary = jobs.run_in_queue(
+            st.session_state, "run_step2", utils.accumulation_summary,
+            model, n_sims, initial_investment * 1e4, monthly_contributions * 1e4, target_amount * 1e4,
+            chunk_size=run_plan["chunk_size"], dtype=run_plan["dtype"],
+        )
+    except jobs.RunCancelled:
+        st.stop()
 
     # -------------------------
-    # 目標資産額に到達するまでの期間分布
+    # ヒストリカル検証（STEP.1の実績リターンで全開始月を検証）
     # -------------------------
-    time_to_target = []
-    for sim in asset_paths:
-        hit = np.where(sim >= target_amount*1e4)[0]  # 到達した月インデックス
-        if len(hit) > 0:
-            time_to_target.append(hit[0] + 1)  # 最初に到達した月（1始まり）
-        else:
-            time_to_target.append(np.nan)  # 未到達は NaN
-    time_to_target = np.array(time_to_target)
-    # NaN を除外
-    valid_times = time_to_target[~np.isnan(time_to_target)]
-    # 月 → 年換算
-    years_to_target = valid_times / 12
-    # パーセンタイル計算
-    percentiles_time = np.percentile(years_to_target, [2.5, 50, 97.5])
-
-    # --- 結果を session_state に保存 ---
-    st.session_state["sim_result"] = {
-        "dates_sim": dates_sim,
-        "percentiles": percentiles,
+    backtest = utils.backtest_accumulation(df_monthly, initial_investment * 1e4, monthly_contributions * 1e4, target_amount * 1e4)
+
+    # --- 結果を保存（配列は単精度に縮めて保存される） ---
+    results.put("step2", {
+        "start": dates_sim[0],
+        "percentiles": summary["percentiles"],
         "target_amount": target_amount,
         "x_start": x_start,
         "x_end": x_end,
         "y_min": y_min,
         "y_max": y_max,
-        "percentiles_time": percentiles_time,
-        "years_to_target": years_to_target
-    }
-    st.session_state["sim_executed"] = True
+        "percentiles_time": summary["percentiles_time"],
+        "hit_rate": float(summary["hit_rate"]),
+        "hit_rate_se": float(summary["hit_rate_se"]),
+        "n_sims": n_sims,
+        "input_key": input_key,
+        "run_plan": run_plan,
+        "hist_counts": summary["hist_counts"],
+        "hist_edges": summary["hist_edges"],
+        "risk": utils.risk_percentiles(summary),
+        "backtest": backtest,
+        "n_months": n_months
+    })
     run_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     st.success("シミュレーションを実行しました。入力を変更したら再実行してください。")
     st.caption(f"実行時刻：{run_time}")
 # -------------------------
 # 表示部：前回の結果を保持
 # -------------------------
-if "sim_executed" in st.session_state and st.session_state["sim_executed"]:
-    result = st.session_state["sim_result"]
+result = results.get("step2")
+if result is None and "step2" in results.evicted:
+    st.info("前回の結果はメモリ節約のため破棄されました。もう一度実行してください。")
+if result is not None:
+    dates_sim = pd.date_range(start=result["start"], periods=result["n_months"], freq='MS')
 
     # --- メイングラフ ---
-    fig3 = go.Figure()
-    fig3.add_trace(go.Scatter(x=result["dates_sim"], y=result["percentiles"][0]/1e4, mode='lines', name='下限(2.5%)', line=dict(color='red', dash='dot')))
-    fig3.add_trace(go.Scatter(x=result["dates_sim"], y=result["percentiles"][2]/1e4, mode='lines', name='上限(97.5%)', fill="tonexty", fillcolor="rgba(173,216,230,0.2)", line=dict(color='green', dash='dot')))
-    fig3.add_trace(go.Scatter(x=result["dates_sim"], y=result["percentiles"][1]/1e4, mode='lines', name='中央値(50%)', line=dict(color='blue', width=2)))
+    fig3 = utils.chart_figure("plotly_white")
+    band_index = utils.band_index(result["percentiles"])
+    fig3.add_trace(utils.line_trace(dates_sim, result["percentiles"][0]/1e4, index=band_index, mode='lines', name='下限(2.5%)', line=dict(color='red', dash='dot')))
+    fig3.add_trace(utils.line_trace(dates_sim, result["percentiles"][2]/1e4, index=band_index, mode='lines', name='上限(97.5%)', fill="tonexty", fillcolor="rgba(173,216,230,0.2)", line=dict(color='green', dash='dot')))
+    fig3.add_trace(utils.line_trace(dates_sim, result["percentiles"][1]/1e4, index=band_index, mode='lines', name='中央値(50%)', line=dict(color='blue', width=2)))
     # グラフに目標線を追加
     fig3.add_hline(
         y=result["target_amount"],
@@ -403,7 +459,6 @@ if "sim_executed" in st.session_state and st.session_state["sim_executed"]:
         yaxis_title="資産額（万円）",
         xaxis=dict(range=[result["x_start"], result["x_end"]]),
         yaxis=dict(range=[result["y_min"], result["y_max"]]),
-        template="plotly_white",
         height=500
     )
     fig3.update_layout(
@@ -423,13 +478,17 @@ if "sim_executed" in st.session_state and st.session_state["sim_executed"]:
         ),
         margin=dict(t=120)  # 上の余白をpxで指定
     )
-    st.plotly_chart(fig3, use_container_width=True)
+    with profiling.span("plotly_chart", figure="fig3"):
+        st.plotly_chart(fig3, use_container_width=True)
 
     # --- 到達年数ヒストグラム ---
-    fig4 = go.Figure()
-    fig4.add_trace(go.Histogram(
-        x=result["years_to_target"],
-        nbinsx=60,
+    fig4 = utils.chart_figure("plotly_white")
+    # ヒストグラムは集計済みの度数を棒グラフで描画
+    hist_edges = result["hist_edges"]
+    fig4.add_trace(go.Bar(
+        x=(hist_edges[:-1] + hist_edges[1:]) / 2,
+        y=result["hist_counts"],
+        width=np.diff(hist_edges),
         name="到達までの年数分布",
         marker_color="skyblue"
     ))
@@ -453,10 +512,10 @@ if "sim_executed" in st.session_state and st.session_state["sim_executed"]:
         ),
         xaxis_title="到達年数",
         yaxis_title="シミュレーション回数",
-        template="plotly_white",
         height=500
     )
-    st.plotly_chart(fig4, use_container_width=True)
+    with profiling.span("plotly_chart", figure="fig4"):
+        st.plotly_chart(fig4, use_container_width=True)
 
     # パーセンタイルの値をテキストで出力
     st.markdown(f"""
@@ -464,5 +523,27 @@ if "sim_executed" in st.session_state and st.session_state["sim_executed"]:
     - 2.5 %tile: {result["percentiles_time"][0]:.1f} 年
     - 50 %tile (中央値): {result["percentiles_time"][1]:.1f} 年
     - 97.5 %tile: {result["percentiles_time"][2]:.1f} 年
+    - 目標資産額への到達率: {result["hit_rate"]*100:.1f}%（標準誤差 ±{result["hit_rate_se"]*100:.2f}%）
     """)
+    st.caption(f"試行回数: {result['n_sims']:,} 回。精度が足りない場合は「試行を追加」で前回の結果に試行を追加できます。")
 
+    # 資産推移のリスク指標（積立を含む資産額の下落・高値を下回っていた期間）
+    st.markdown("**資産推移のリスク指標（全試行の分布）**")
+    st.table(utils.risk_table(result["risk"]))
+
+    # -------------------------
+    # ヒストリカル検証の結果
+    # -------------------------
+    st.markdown("**ヒストリカル検証（実績リターンでの全開始月検証）**")
+    backtest = result.get("backtest")
+    if backtest is None:
+        st.info(f"STEP.1のデータ期間が投資期間（{result.get('n_months', '-')}ヶ月）より短いため、ヒストリカル検証はできません。STEP.1の開始年月を早めてください。")
+    else:
+        col_b1, col_b2, col_b3 = st.columns(3)
+        col_b1.metric("検証した開始月の数", f"{len(backtest['start_dates'])}")
+        col_b2.metric("目標到達率", f"{backtest['success_rate']*100:.1f}%")
+        col_b3.metric("最悪の開始月", backtest["worst_start"].strftime("%Y-%m"))
+        st.caption(f"最悪の開始月の最終資産額: {backtest['worst_path'][-1]/1e4:,.0f} 万円")
+
+# 計測結果（パフォーマンス欄・構造化ログ）
+utils.render_performance(profiler)
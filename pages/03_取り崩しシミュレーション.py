@@ -1,12 +1,11 @@
 import streamlit as st
 import numpy as np
-from scipy.stats import skewnorm
-import plotly.graph_objects as go
 from datetime import datetime
-import pandas as pd
 from plotly.subplots import make_subplots
 from streamlit_js_eval import streamlit_js_eval
 import os
+import jobs
+import profiling
 import utils
 
 #デバイス確認
@@ -83,6 +82,25 @@ def premium_auth():
 # キャッシュをクリアして実行
 st.cache_data.clear()
 
+# 既定ティッカーの市場データを裏で先読み（プロセス内で1回だけ）
+utils.start_background_prefetch()
+
+# このページの描画をステージごとに計測（?perf=1 または PERF_PANEL=1 で末尾に表示）
+profiler = profiling.page_profiler(st.session_state, "03_取り崩し")
+
+# 再描画（入力の変更・再クリック）されたら、このセッションで実行中の古いシミュレーションを中断する
+jobs.cancel_run(st.session_state, "run_step3")
+
+# 端末の確認（User-Agent）はセッションごとに1回だけ、重い処理の前に行う
+# 初回はブラウザからの応答待ちで止まり、応答が届くと自動で再描画される（この時点ではデータ取得・計算はしない）
+if "is_mobile" not in st.session_state:
+    ua = streamlit_js_eval(js_expressions="navigator.userAgent", key="ua_step3")
+    if ua is None:
+        st.info("端末情報を取得中...（ページが自動で再描画されます）")
+        st.stop()
+    st.session_state["is_mobile"] = is_mobile_device(ua)
+is_mobile = st.session_state["is_mobile"]
+
 
 #######################################################################################################################
 # -------------------------
@@ -126,6 +144,26 @@ end_date = f"{end_year}-{end_month:02d}-01" # フォーマットを整える (YY
 st.write(f"選択されたティッカー: **{ticker}**")
 st.write(f"期間: **{start_date} 〜 {end_date or '現在'}**")
 
+# リターンモデル選択
+return_model_label = st.selectbox(
+    "リターンモデル（シミュレーションに用いる月次リターンの生成方法）",
+    list(utils.RETURN_MODELS.values()),
+)
+return_model = next(k for k, v in utils.RETURN_MODELS.items() if v == return_model_label)
+mean_block_length = 12
+if return_model == "bootstrap":
+    mean_block_length = st.number_input(
+        "平均ブロック長（月）", min_value=1, max_value=60, value=12,
+        help="実績リターンをこの平均長さ（幾何分布）のブロック単位で再標本化します。長いほど過去の変動の偏り（ボラティリティの集中）を保ちます。"
+    )
+parameter_uncertainty = False
+if return_model in utils.UNCERTAINTY_BASE_MODELS:
+    parameter_uncertainty = st.checkbox(
+        "パラメータの推定誤差を反映する",
+        help="実績リターンを再標本化して推定し直したパラメータを多数用意し、パスのまとまりごとに異なるパラメータで生成します。"
+             "限られた期間のデータから推定した期待リターン・リスクの不確かさが、結果の幅に加わります。"
+    )
+
 # Streamlitに描画するスペースを確保
 chart_placeholder = st.empty()
 
@@ -140,14 +178,23 @@ if df_monthly.empty:
 # -------------------------
 # --- 対数リターンヒストグラム ---
 # -------------------------
-skew_params, fig, summary_table = utils.fit_distribution(df_monthly, ticker)
-a, loc, scale = skew_params
+# ブートストラップはスキュー付き正規分布を使わないので、当てはめ（skewnorm.fit）を省略する
+skew_params, fig, summary_table = utils.fit_distribution(df_monthly, ticker, fit_skew=(return_model != "bootstrap"))
+# シミュレーションに用いるリターンモデルを推定（推定結果はキャッシュされ、同じデータでは再推定しない）
+model_params = {"mean_block_length": mean_block_length} if return_model == "bootstrap" else {}
+model = utils.fit_return_model(return_model, df_monthly['Log_Return'].values, **model_params)
+if parameter_uncertainty:
+    model = utils.fit_return_model("uncertain", df_monthly['Log_Return'].values, base=return_model)
 
 # Streamlit に描画（古いグラフは置き換え）
-chart_placeholder.plotly_chart(fig, use_container_width=True, clear_figure=True)
+with profiling.span("plotly_chart", figure="fig"):
+    chart_placeholder.plotly_chart(fig, use_container_width=True, clear_figure=True)
 
-st.markdown("**統計量サマリー(正規分布 vs スキュー付き正規分布)**")
+st.markdown("**統計量サマリー(正規分布)**" if skew_params is None else "**統計量サマリー(正規分布 vs スキュー付き正規分布)**")
 st.table(summary_table)
+if parameter_uncertainty:
+    st.markdown(f"**パラメータの推定誤差（再標本化して推定し直した {model.n_draws} 組の分布）**")
+    st.table(utils.uncertainty_table(model))
 
 # --- 補足説明 ---
 st.markdown("""
@@ -162,33 +209,33 @@ st.markdown("""
 # -------------------------
 # --- モンテカルロシミュレーション対数株価 ---
 # -------------------------
-log_price_paths = utils.monte_carlo_simulation_log(df_monthly, skew_params, n_sims=5000)
-# パーセンタイル（対数価格）
-percentiles_log = np.percentile(log_price_paths, [2.5, 50, 97.5], axis=0)
+# パーセンタイル（対数価格）：同じシナリオの結果は全ユーザー共有のキャッシュから返す
+percentiles_log = utils.price_path_bands(df_monthly, model, n_sims=5000)["percentiles_log"]
 # 実際の対数株価
 actual_log_prices = df_monthly['Log_Close'].values
 dates = df_monthly.index
 
 # --- グラフ描画 ---
-fig2 = go.Figure()
-# シミュレーション（2.5%・50%・97.5%ライン）
-fig2.add_trace(go.Scatter(
-    x=dates, y=percentiles_log[0], mode='lines',
+fig2 = utils.chart_figure("plotly_white")
+# シミュレーション（2.5%・50%・97.5%ライン、帯の上下は同じ位置で間引く）
+band_index = utils.band_index(percentiles_log)
+fig2.add_trace(utils.line_trace(
+    dates, percentiles_log[0], index=band_index, mode='lines',
     name="シミュレーション下限 (2.5%)", line=dict(color='red', dash='dot')
 ))
-fig2.add_trace(go.Scatter(
-    x=dates, y=percentiles_log[2], mode='lines',
+fig2.add_trace(utils.line_trace(
+    dates, percentiles_log[2], index=band_index, mode='lines',
     name="シミュレーション上限 (97.5%)",
     fill="tonexty", fillcolor="rgba(173,216,230,0.2)",
     line=dict(color='green', dash='dot')
 ))
-# 実際の対数株価
-fig2.add_trace(go.Scatter(
-    x=dates, y=actual_log_prices, mode='lines+markers',
+# 実際の対数株価（実測値なので間引かない）
+fig2.add_trace(utils.line_trace(
+    dates, actual_log_prices, max_points=0, mode='lines+markers',
     name="実際の対数株価", line=dict(color='black', width=2)
 )) 
-fig2.add_trace(go.Scatter(
-    x=dates, y=percentiles_log[1], mode='lines',
+fig2.add_trace(utils.line_trace(
+    dates, percentiles_log[1], index=band_index, mode='lines',
     name="シミュレーション中央値 (50%)", line=dict(color='blue', width=2)
 ))
 
@@ -196,12 +243,11 @@ fig2.update_layout(
     #title_text=f"{ticker} の対数チャート<br>&モンテカルロシミュレーション<br>（スキュー付き正規分布）",
     xaxis_title="日付",
     yaxis_title="対数チャート",
-    template="plotly_white",
     height=500
 )
 fig2.update_layout(
     title=dict(
-        text=f"{ticker} の対数チャート<br>&モンテカルロシミュレーション<br>（スキュー付き正規分布）",
+        text=f"{ticker} の対数チャート<br>&モンテカルロシミュレーション<br>（{utils.RETURN_MODELS[return_model]}）",
         x=0.5,   # 中央揃え
         xanchor='center',
         y=0.90,   # 上から少し下げる（デフォルトは1.0）
@@ -222,17 +268,18 @@ graph_container = st.container()
 
 #１回分のシミュレーション結果を追加描画
 if st.button("シミュレーション例描画"):
-    one_path = utils.monte_carlo_simulation_log(df_monthly, skew_params, n_sims=1)
+    one_path = utils.monte_carlo_simulation_log(df_monthly, model, n_sims=1)
     one_path = one_path[0]
-    fig2.add_trace(go.Scatter(
-        x=dates, y=one_path, mode="lines",
+    fig2.add_trace(utils.line_trace(
+        dates, one_path, mode="lines",
         name="シミュレーション1例",
         line=dict(color="red", width=1)
     ))
 
 # ---- グラフ描画（ここが1回だけ）----
 with graph_container:
-    st.plotly_chart(fig2, use_container_width=True)
+    with profiling.span("plotly_chart", figure="fig2"):
+        st.plotly_chart(fig2, use_container_width=True)
 
 
 #######################################################################################################################
@@ -278,6 +325,7 @@ with col1:
     withdrawal_rate = st.number_input("取り崩し率（月次, %）", value=1.0, step=0.1)
 
 n_trials = 500 #試行回数（モンテカルロシミュレーション）
+n_trials_added = 500 #「試行を追加」で前回の結果に足す試行回数
 
 #戦略の選択
 #資産に対する定率取り崩し額を計算する
@@ -384,18 +432,58 @@ with col2:
     y_max_used = st.number_input("最大値（万円）", value=100, key="y_max_used")
 
 
-ua = streamlit_js_eval(js_expressions="navigator.userAgent", key="ua_step3")
-
-if ua is None:
-    st.info("User-Agent を取得中...（ページが自動で再描画されます）")
-    st.stop()
+n_months = simulation_years * 12
+withdrawal_kwargs = dict(
+    initial_assets=initial_assets,
+    initial_savings=initial_savings,
+    monthly_need=initial_monthly_need,
+    withdrawal_rate=withdrawal_rate,
+    min_savings_ratio=min_savings_ratio,
+    max_savings_ratio=max_savings_ratio,
+    inflation_rate=inflation_rate,
+    adjust_need_for_inflation=adjust_need_for_inflation,
+    option1_1=selected_option1_1,
+    option1_2=selected_option1_2,
+    option2_1=selected_option2_1,
+    option2_2=selected_option2_2,
+)
+# 結果の計算に使う入力（前回の結果と同じときだけ「試行を追加」できる）
+input_key = utils.scenario_key("step3", model=model, n_months=n_months, **withdrawal_kwargs)
 
-# UA 取得成功
-is_mobile = is_mobile_device(ua)
+# 実行前の見積もり（メモリ予算を超える場合は単精度で計算する）
+run_plan = utils.plan_run("withdrawal", n_trials, n_months)
+st.caption(utils.describe_plan(run_plan))
 # -------------------------
 # シミュレーション実行ボタン
 # -------------------------
-if st.button("▶ シミュレーション実行(STEP2)"):
+# 全試行の推移をファイル（np.memmap）に保存すると、試行を個別に確認できる（試行回数が多くてもメモリを使わない）
+keep_paths = st.checkbox("試行ごとの推移を保存して、個別に確認する", value=False, key="keep_paths_step3")
+
+# 結果はセッションごとのメモリ予算の中で保存する（グラフは保存せず、表示のたびに作り直す）
+results = utils.session_results(st.session_state)
+
+# 追加分は前回と同じブロック・dtype で計算し、保存済みの集計に続ける（そのままでは予算に収まらなければ追加しない）
+previous = results.get("step3") if results.matches_input("step3", input_key) else None
+add_plan = utils.plan_added_run("withdrawal", previous["run_plan"], previous["n_trials"] + n_trials_added, n_months) if previous else None
+
+col_run, col_add = st.columns(2)
+with col_run:
+    run_clicked = st.button("▶ シミュレーション実行(STEP2)")
+with col_add:
+    add_clicked = st.button(
+        f"＋ 試行を{n_trials_added:,}回追加して精度を上げる", disabled=add_plan is None or add_plan["mode"] == "refuse", key="add_step3",
+        help=add_plan["reason"] if add_plan and add_plan["reason"] else "前回と同じ入力のときだけ追加できます（入力を変えたら実行し直してください）",
+    )
+if add_clicked:
+    n_trials = previous["n_trials"] + n_trials_added
+    run_plan = add_plan
+
+if run_clicked or add_clicked:
+    # 予算を超えるシナリオは実行しない
+    if run_plan["mode"] == "refuse":
+        st.error(f"{run_plan['reason']}。期間か試行回数を減らしてください。")
+        st.stop()
+
     # チェック対象のキー一覧
     option_keys = ["option1_1", "option1_2", "option2_1", "option2_2"]
     for key in option_keys:
@@ -404,140 +492,90 @@ if st.button("▶ シミュレーション実行(STEP2)"):
             st.error("有料の選択肢が選択されています。認証しないと実行できません。")
             st.stop()
 
-    n_months = simulation_years * 12
-    monthly_need = initial_monthly_need
-
-    results = []
-    for sim in range(n_trials):
-        assets = initial_assets
-        savings = initial_savings
-        need = monthly_need
-        total = assets + savings
-        
-        r = skewnorm.rvs(a, loc=loc, scale=scale, size=n_months)
-        for m in range(n_months):
-            # ランダムリターン
-            assets *= np.exp(r[m])
-
-            withdrawal = assets * (withdrawal_rate / 100)
-
-            min_s = total * (min_savings_ratio / 100)
-            max_s = total * (max_savings_ratio / 100)
-
-            used, savings = utils.withdrawal_strategy(
-                withdrawal, need, savings, max_s, min_s,
-                selected_option1_1,
-                selected_option1_2,
-                selected_option2_1,
-                selected_option2_2
-            )
-
-            assets -= used
-            total = assets + savings
-
-            results.append([sim, m, assets, savings, total, need, used])
-
-            # 翌月
-            if adjust_need_for_inflation:
-                need *= (1 + inflation_rate / 100 / 12)
-            if total <= 0:
-                break
-    
-    #"Sim": 試行インデックス, "Month": 月インデックス, "Assets": 株式資産, "Savings": 貯金, "Total": 資産総額, "Need": 必要生活費, "Used": 消費額
-    df = pd.DataFrame(results, columns=["Sim", "Month", "Assets", "Savings", "Total", "Need", "Used"])
-    
-    if is_mobile:
-        # スマホは縦4つ
-        fig = make_subplots(
-            rows=4, cols=1,
-            subplot_titles=["総資産", "株式資産", "貯金", "必要生活費と消費額"],
-            vertical_spacing=0.09
-        )
-        layout_mode = "mobile"
-
-    else:
-        # PCは2×2
-        fig = make_subplots(
-            rows=2, cols=2,
-            subplot_titles=["総資産", "株式資産", "貯金", "必要生活費と消費額"],
-            vertical_spacing=0.15,
-            horizontal_spacing=0.10,
+    # 全試行を試行方向にベクトル化して計算し、月ごとのパーセンタイル帯 [2.5%, 50%, 97.5%] に要約（破綻後の月は除外）
+    # 同じシナリオの結果は全ユーザー共有のキャッシュから返す
+    # サーバー全体のジョブキューで実行し、順番待ち・進捗を表示（再描画されたら中断）
+    try:
+        bands = jobs.run_in_queue(
+            st.session_state, "run_step3", utils.withdrawal_summary,
+            model, n_trials, n_months, withdrawal_kwargs,
+            chunk_size=run_plan["chunk_size"], dtype=run_plan["dtype"],
         )
-        layout_mode = "pc"
-
-    # --- サブプロット位置（PC とスマホで変わる） ---
-    pos_total    = (1, 1) if layout_mode == "pc" else (1, 1)  # 総資産
-    pos_assets   = (1, 2) if layout_mode == "pc" else (2, 1)  # 株式資産
-    pos_savings  = (2, 1) if layout_mode == "pc" else (3, 1)  # 貯金
-    pos_usage    = (2, 2) if layout_mode == "pc" else (4, 1)  # 必要生活費＆消費額
-
-
-    # --- 総資産 ---
-    df_total = df.groupby(["Sim", "Month"])["Total"].sum().unstack().T
-    median = df_total.median(axis=1)
-    p5 = df_total.quantile(0.025, axis=1)
-    p95 = df_total.quantile(0.975, axis=1)
-
-    fig.add_trace(go.Scatter(x=df_total.index, y=median, name="総資産 中央値", line=dict(color="black")), row=pos_total[0], col=pos_total[1])
-    fig.add_trace(go.Scatter(x=df_total.index, y=p5, name="2.5%tile", line=dict(color="gray", dash="dot")), row=pos_total[0], col=pos_total[1])
-    fig.add_trace(go.Scatter(x=df_total.index, y=p95, name="97.5%tile", fill="tonexty", fillcolor="rgba(200,200,200,0.2)", line=dict(color="gray", dash="dot")), row=pos_total[0], col=pos_total[1])
-    fig.update_yaxes(range=[y_min_total, y_max_total], row=pos_total[0], col=pos_total[1])
-
-    
-
-    # --- 株式資産 ---
-    df_assets = df.groupby(["Sim", "Month"])["Assets"].sum().unstack().T
-    median = df_assets.median(axis=1)
-    p5 = df_assets.quantile(0.025, axis=1)
-    p95 = df_assets.quantile(0.975, axis=1)
-    fig.add_trace(go.Scatter(x=df_assets.index, y=median, name="株式資産 中央値", line=dict(color="blue")),row=pos_assets[0], col=pos_assets[1])
-    fig.add_trace(go.Scatter(x=df_assets.index, y=p5, name="2.5%tile", line=dict(color="lightblue", dash="dot")),row=pos_assets[0], col=pos_assets[1])
-    fig.add_trace(go.Scatter(x=df_assets.index, y=p95, name="97.5%tile", fill="tonexty", fillcolor="rgba(173,216,230,0.2)", line=dict(color="lightblue", dash="dot")),row=pos_assets[0], col=pos_assets[1])
-    fig.update_yaxes(range=[y_min_assets, y_max_assets], row=pos_assets[0], col=pos_assets[1])
-
-    # --- 貯金 ---
-    df_savings = df.groupby(["Sim", "Month"])["Savings"].sum().unstack().T
-    median = df_savings.median(axis=1)
-    p5 = df_savings.quantile(0.025, axis=1)
-    p95 = df_savings.quantile(0.975, axis=1)
-    fig.add_trace(go.Scatter(x=df_savings.index, y=median, name="貯金 中央値", line=dict(color="orange")),row=pos_savings[0], col=pos_savings[1])
-    fig.add_trace(go.Scatter(x=df_savings.index, y=p5, name="2.5%tile", line=dict(color="gold", dash="dot")),row=pos_savings[0], col=pos_savings[1])
-    fig.add_trace(go.Scatter(x=df_savings.index, y=p95, name="97.5%tile", fill="tonexty", fillcolor="rgba(255,215,0,0.2)", line=dict(color="gold", dash="dot")),row=pos_savings[0], col=pos_savings[1])
-    fig.update_yaxes(range=[y_min_savings, y_max_savings], row=pos_savings[0], col=pos_savings[1])
-
-    # --- 必要生活費 & 消費額（同じグラフに描画） ---
-    df_need = df.groupby(["Sim", "Month"])["Need"].sum().unstack().T
-    df_used = df.groupby(["Sim", "Month"])["Used"].sum().unstack().T
-
-    median_need = df_need.median(axis=1)
-    median_used = df_used.median(axis=1)
-    p5 = df_used.quantile(0.025, axis=1)
-    p95 = df_used.quantile(0.975, axis=1)
-    fig.add_trace(go.Scatter(x=median_need.index, y=median_need, name="必要生活費", line=dict(color="green")),row=pos_usage[0], col=pos_usage[1])
-    fig.add_trace(go.Scatter(x=df_need.index, y=median_used, name="消費額 中央値", line=dict(color="red")),row=pos_usage[0], col=pos_usage[1])
-    fig.add_trace(go.Scatter(x=df_used.index, y=p5, name="2.5%tile", line=dict(color="salmon", dash="dot")),row=pos_usage[0], col=pos_usage[1])
-    fig.add_trace(go.Scatter(x=df_used.index, y=p95, name="97.5%tile", fill="tonexty", fillcolor="rgba(250,128,114,0.15)", line=dict(color="salmon", dash="dot")),row=pos_usage[0], col=pos_usage[1])
-    fig.update_yaxes(range=[y_min_used, y_max_used], row=pos_usage[0], col=pos_usage[1])
-    
-    # --- レイアウト ---
-    
-    if is_mobile:
-        fig.update_xaxes(title_text="経過月数", row=1, col=1)
-        fig.update_yaxes(title_text="金額（万円）", row=1, col=1)
-
-        fig.update_xaxes(title_text="経過月数", row=2, col=1)
-        fig.update_yaxes(title_text="金額（万円）", row=2, col=1)
+    except jobs.RunCancelled:
+        st.stop()
+
+    # -------------------------
+    # ヒストリカル検証（STEP.1の実績リターンで全開始月を検証）
+    # -------------------------
+    backtest = utils.backtest_withdrawal(df_monthly, n_months, **withdrawal_kwargs)
+
+    # 要約と同じ試行の推移を保存（前回の保存分は削除）
+    results.discard("paths_step3")
+    if keep_paths:
+        try:
+            path_store = jobs.run_in_queue(
+                st.session_state, "run_step3", utils.withdrawal_path_store,
+                model, n_trials, n_months, withdrawal_kwargs,
+                chunk_size=run_plan["chunk_size"], dtype=run_plan["dtype"],
+            )
+        except jobs.RunCancelled:
+            st.stop()
+        results.put("paths_step3", path_store)
+
+    # パーセンタイル帯・要約・検証結果を保存（配列は単精度に縮めて保存される。予算を超えたら古いものから破棄）
+    results.put("step3", {
+        "bands": {k: bands[k] for k in utils.WITHDRAWAL_KEYS},
+        "survival": bands["survival"],
+        "Total_survivors": bands["Total_survivors"],
+        "risk": utils.risk_percentiles(bands),
+        "n_trials": n_trials,
+        "input_key": input_key,
+        "run_plan": run_plan,
+        "success_rate": float(bands["success_rate"]),
+        "success_rate_se": float(bands["success_rate_se"]),
+        "backtest": backtest,
+        "n_months": n_months,
+    })
 
-        fig.update_xaxes(title_text="経過月数", row=3, col=1)
-        fig.update_yaxes(title_text="金額（万円）", row=3, col=1)
+    run_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    st.success("シミュレーションを実行しました。入力を変更したら再実行してください。")
+    st.caption(f"実行時刻：{run_time}")
 
-        fig.update_xaxes(title_text="経過月数", row=4, col=1)
-        fig.update_yaxes(title_text="金額（万円）", row=4, col=1)
+# -------------------------
+# グラフ表示（過去の結果があれば、保存したパーセンタイル帯から作り直して表示）
+# -------------------------
+result = results.get("step3")
+if result is None and "step3" in results.evicted:
+    st.info("前回の結果はメモリ節約のため破棄されました。もう一度実行してください。")
+if result is not None:
+    months_axis = np.arange(result["bands"]["Total"].shape[1])
+    layout_mode = "mobile" if is_mobile else "pc"
+    y_ranges = [[y_min_total, y_max_total], [y_min_assets, y_max_assets], [y_min_savings, y_max_savings], [y_min_used, y_max_used]]
+
+    # --- レイアウト（PC とスマホで変わる）。同じ表示設定なら作成済みのレイアウトを使い回し、データだけ差し替える ---
+    def build_layout():
+        if layout_mode == "mobile":
+            # スマホは縦4つ
+            fig = make_subplots(
+                rows=4, cols=1,
+                subplot_titles=["総資産", "株式資産", "貯金", "必要生活費と消費額"],
+                vertical_spacing=0.09
+            )
+        else:
+            # PCは2×2
+            fig = make_subplots(
+                rows=2, cols=2,
+                subplot_titles=["総資産", "株式資産", "貯金", "必要生活費と消費額"],
+                vertical_spacing=0.15,
+                horizontal_spacing=0.10,
+            )
+        fig.update_xaxes(title_text="経過月数")
+        fig.update_yaxes(title_text="金額（万円）")
+        for k, y_range in enumerate(y_ranges, start=1):
+            fig.layout["yaxis" if k == 1 else f"yaxis{k}"].range = y_range
         fig.update_layout(
-            xaxis_title="経過月数",
-            yaxis_title="金額（万円）",
-            height=1800,
-            width=None,
+            height=1800 if layout_mode == "mobile" else 900,
+            width=None if layout_mode == "mobile" else 1100,
             title=dict(
                 text=f"モンテカルロシミュレーション結果",
                 x=0.5,   # 中央揃え
@@ -552,51 +590,119 @@ if st.button("▶ シミュレーション実行(STEP2)"):
                 xanchor="center",
                 x=0.5
             ),
-            margin=dict(t=300)  # 上の余白をpxで指定
+            margin=dict(t=300 if layout_mode == "mobile" else 200)  # 上の余白をpxで指定
         )
-    else:
-        fig.update_xaxes(title_text="経過月数", row=1, col=1)
-        fig.update_yaxes(title_text="金額（万円）", row=1, col=1)
+        return fig.layout
 
-        fig.update_xaxes(title_text="経過月数", row=2, col=1)
-        fig.update_yaxes(title_text="金額（万円）", row=2, col=1)
+    # --- サブプロットの番号（PC・スマホとも 1:総資産, 2:株式資産, 3:貯金, 4:必要生活費＆消費額） ---
+    def subplot_trace(k, y, **kwargs):
+        axis = "" if k == 1 else k
+        return utils.line_trace(months_axis, y, xaxis=f"x{axis}", yaxis=f"y{axis}", **kwargs)
 
-        fig.update_xaxes(title_text="経過月数", row=1, col=2)
-        fig.update_yaxes(title_text="金額（万円）", row=1, col=2)
+    traces = []
+    # --- 総資産（帯の上下と中央値は同じ位置で間引く） ---
+    p5, median, p95 = result["bands"]["Total"]
+    index = utils.band_index(result["bands"]["Total"])
+    traces.append(subplot_trace(1, median, index=index, name="総資産 中央値", line=dict(color="black")))
+    traces.append(subplot_trace(1, p5, index=index, name="2.5%tile", line=dict(color="gray", dash="dot")))
+    traces.append(subplot_trace(1, p95, index=index, name="97.5%tile", fill="tonexty", fillcolor="rgba(200,200,200,0.2)", line=dict(color="gray", dash="dot")))
 
-        fig.update_xaxes(title_text="経過月数", row=2, col=2)
-        fig.update_yaxes(title_text="金額（万円）", row=2, col=2)
-        fig.update_layout(
-            xaxis_title="経過月数",
-            yaxis_title="金額（万円）",
-            height=900,
-            width=1100,
-            title=dict(
-                text=f"モンテカルロシミュレーション結果",
-                x=0.5,   # 中央揃え
-                xanchor='center',
-                y=0.95,   # 上から少し下げる（デフォルトは1.0）
-                yanchor='top'
-            ),
-            legend=dict(
-                orientation="h",  # 横並び
-                yanchor="bottom",
-                y=1.03,
-                xanchor="center",
-                x=0.5
-            ),
-            margin=dict(t=200)  # 上の余白をpxで指定
+    # --- 株式資産 ---
+    p5, median, p95 = result["bands"]["Assets"]
+    index = utils.band_index(result["bands"]["Assets"])
+    traces.append(subplot_trace(2, median, index=index, name="株式資産 中央値", line=dict(color="blue")))
+    traces.append(subplot_trace(2, p5, index=index, name="2.5%tile", line=dict(color="lightblue", dash="dot")))
+    traces.append(subplot_trace(2, p95, index=index, name="97.5%tile", fill="tonexty", fillcolor="rgba(173,216,230,0.2)", line=dict(color="lightblue", dash="dot")))
+
+    # --- 貯金 ---
+    p5, median, p95 = result["bands"]["Savings"]
+    index = utils.band_index(result["bands"]["Savings"])
+    traces.append(subplot_trace(3, median, index=index, name="貯金 中央値", line=dict(color="orange")))
+    traces.append(subplot_trace(3, p5, index=index, name="2.5%tile", line=dict(color="gold", dash="dot")))
+    traces.append(subplot_trace(3, p95, index=index, name="97.5%tile", fill="tonexty", fillcolor="rgba(255,215,0,0.2)", line=dict(color="gold", dash="dot")))
+
+    # --- 必要生活費 & 消費額（同じグラフに描画） ---
+    median_need = result["bands"]["Need"][1]
+    p5, median_used, p95 = result["bands"]["Used"]
+    index = utils.band_index(np.vstack([median_need, result["bands"]["Used"]]))
+    traces.append(subplot_trace(4, median_need, index=index, name="必要生活費", line=dict(color="green")))
+    traces.append(subplot_trace(4, median_used, index=index, name="消費額 中央値", line=dict(color="red")))
+    traces.append(subplot_trace(4, p5, index=index, name="2.5%tile", line=dict(color="salmon", dash="dot")))
+    traces.append(subplot_trace(4, p95, index=index, name="97.5%tile", fill="tonexty", fillcolor="rgba(250,128,114,0.15)", line=dict(color="salmon", dash="dot")))
+
+    fig = utils.cached_figure(("step3", layout_mode, str(y_ranges)), build_layout, traces)
+
+    with profiling.span("plotly_chart", figure="fig_step3"):
+        st.plotly_chart(fig, use_container_width=True)
+    st.caption(
+        f"試行回数: {result['n_trials']:,} 回、最後まで総資産が尽きなかった割合: {result['success_rate']*100:.1f}%"
+        f"（標準誤差 ±{result['success_rate_se']*100:.2f}%）。精度が足りない場合は「試行を追加」で前回の結果に試行を追加できます。"
+    )
+
+    # -------------------------
+    # 生存曲線（各月末に総資産が残っている試行の割合）
+    # -------------------------
+    st.markdown("**総資産が残っている割合（生存曲線）**")
+    survival = result["survival"]
+    fig_survival = utils.chart_figure("plotly_white")
+    fig_survival.add_trace(utils.line_trace(np.arange(1, len(survival) + 1) / 12, survival * 100, mode="lines", name="総資産が残っている割合", line=dict(color="black")))
+    fig_survival.update_layout(xaxis_title="経過年数", yaxis_title="割合（%）", yaxis_range=[0, 101], height=300)
+    with profiling.span("plotly_chart", figure="fig_survival"):
+        st.plotly_chart(fig_survival, use_container_width=True)
+    # 最後まで尽きなかった試行だけの最終総資産（破綻した試行を含む帯より、残せる額の見込みが分かる）
+    survivors_final = result["Total_survivors"][:, -1]
+    if not np.isnan(survivors_final).any():
+        st.caption(
+            f"最後まで総資産が尽きなかった試行の最終総資産: 2.5%tile {survivors_final[0]:,.0f} 万円、"
+            f"中央値 {survivors_final[1]:,.0f} 万円、97.5%tile {survivors_final[2]:,.0f} 万円"
         )
-    
 
-    # グラフと実行時刻を保存
-    st.session_state["fig_step3"] = fig
-    run_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    st.success("シミュレーションを実行しました。入力を変更したら再実行してください。")
-    st.caption(f"実行時刻：{run_time}")
+    # 総資産のリスク指標（資産が尽きた試行は、尽きた後を資産0として数える）
+    st.markdown("**総資産のリスク指標（全試行の分布）**")
+    st.table(utils.risk_table(result["risk"]))
+
+    # -------------------------
+    # 個別の試行（保存した推移から読み出す）
+    # -------------------------
+    path_store = results.get("paths_step3")
+    if path_store is not None:
+        st.markdown("**個別の試行**")
+        ruin_month = path_store.index["ruin_month"]
+        ruined = ruin_month >= 0
+        # 資産が尽きた試行を先に、次に総資産の最小値が小さい順に並べる
+        worst = np.lexsort((path_store.index["min_total"], ~ruined))[:50]
+
+        def trial_label(i):
+            if ruined[i]:
+                return f"試行 #{i}（{ruin_month[i] + 1} ヶ月目に総資産が尽きた）"
+            return f"試行 #{i}（最終総資産 {path_store.index['final'][i]:,.0f} 万円）"
+        trial = st.selectbox(f"総資産が少なくなった試行（資産が尽きた試行: {ruined.sum():,} / {path_store.n_paths:,}）", worst, format_func=trial_label)
+        fig_trial = utils.chart_figure("plotly_white")
+        median_total = path_store.bands("Total", [50])[0]
+        fig_trial.add_trace(utils.line_trace(np.arange(path_store.n_months), median_total, mode="lines", name="全試行の中央値", line=dict(color="gray", dash="dot")))
+        for name, label in [("Total", "総資産"), ("Assets", "株式資産"), ("Savings", "貯金")]:
+            fig_trial.add_trace(utils.line_trace(np.arange(path_store.n_months), path_store.paths(name, trial)[0], mode="lines", name=label))
+        fig_trial.update_layout(xaxis_title="月", yaxis_title="金額（万円）", height=400,
+                                legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5))
+        with profiling.span("plotly_chart", figure="fig_trial"):
+            st.plotly_chart(fig_trial, use_container_width=True)
+
+    # -------------------------
+    # ヒストリカル検証の結果
+    # -------------------------
+    st.markdown("**ヒストリカル検証（実績リターンでの全開始月検証）**")
+    backtest = result["backtest"]
+    if backtest is None:
+        st.info(f"STEP.1のデータ期間がシミュレーション期間（{result['n_months']}ヶ月）より短いため、ヒストリカル検証はできません。STEP.1の開始年月を早めるか、シミュレーション年数を短くしてください。")
+    else:
+        col_b1, col_b2, col_b3 = st.columns(3)
+        col_b1.metric("検証した開始月の数", f"{len(backtest['start_dates'])}")
+        col_b2.metric("資産が尽きなかった割合", f"{backtest['success_rate']*100:.1f}%")
+        col_b3.metric("最悪の開始月", backtest["worst_start"].strftime("%Y-%m"))
+        if backtest["success"].all():
+            st.caption(f"最悪の開始月の最終総資産: {backtest['worst_final']:,.0f} 万円")
+        else:
+            st.caption(f"最悪の開始月では {backtest['worst_ruin_month'] + 1} ヶ月目に総資産が尽きました。")
 
-# -------------------------
-# グラフ表示（過去の結果があれば再表示）
-# -------------------------
-if "fig_step3" in st.session_state:
-    st.plotly_chart(st.session_state["fig_step3"], use_container_width=True)
+# 計測結果（パフォーマンス欄・構造化ログ）
+utils.render_performance(profiler)
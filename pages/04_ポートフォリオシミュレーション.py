@@ -0,0 +1,278 @@
+import streamlit as st
+import numpy as np
+from datetime import datetime
+import pandas as pd
+import jobs
+import profiling
+import utils
+
+# キャッシュをクリアして実行
+st.cache_data.clear()
+
+# 既定ティッカーの市場データを裏で先読み（プロセス内で1回だけ）
+utils.start_background_prefetch()
+
+# このページの描画をステージごとに計測（?perf=1 または PERF_PANEL=1 で末尾に表示）
+profiler = profiling.page_profiler(st.session_state, "04_ポートフォリオ")
+
+# 再描画（入力の変更・再クリック）されたら、このセッションで実行中の古いシミュレーションを中断する
+jobs.cancel_run(st.session_state, "run_portfolio")
+
+#######################################################################################################################
+# -------------------------
+# --- 複数銘柄の月次データと相関 ---
+# -------------------------
+st.title("ポートフォリオシミュレーション")
+st.subheader("複数銘柄の月次データと相関 STEP.1")
+st.markdown("""
+- 複数のインデックスを組み合わせたポートフォリオ（例: VOO+QQQ+VT）の資産形成をシミュレーションします。
+- 全銘柄の月次データをまとめて取得し、月次対数リターンの共分散（相関）を推定します。
+- 銘柄間の相関を保ったまま全銘柄のリターンを同時に生成し、リバランスを考慮して資産推移を計算します。
+""")
+
+# ティッカー選択（複数）
+default_tickers = utils.DEFAULT_TICKERS
+selected_tickers = st.multiselect("ティッカーを選択してください（複数可）", default_tickers, default=["VOO", "QQQ", "VT"])
+custom_tickers = st.text_input("カスタムティッカーを追加（カンマ区切り、例: AAPL, TSLA）", value="")
+tickers = selected_tickers + [t.strip().upper() for t in custom_tickers.split(",") if t.strip()]
+tickers = list(dict.fromkeys(tickers))  # 重複を除外（順序は保持）
+
+if len(tickers) == 0:
+    st.warning("ティッカーを1つ以上選択してください。")
+    st.stop()
+
+# 日付選択
+current_year = datetime.now().year
+current_month = datetime.now().month
+years = list(range(1999, current_year + 1))
+months = list(range(1, 13))
+
+col1, col2 = st.columns(2)
+with col1:
+    year = st.selectbox("開始年", years, index=years.index(2009) if 2009 in years else 0)
+with col2:
+    month = st.selectbox("開始月", months, index=8)
+start_date = f"{year}-{month:02d}-01" # フォーマットを整える (YYYY-MM-01)
+
+col3, col4 = st.columns(2)
+with col3:
+    end_year = st.selectbox("終了年", years, index=years.index(current_year))
+with col4:
+    end_month = st.selectbox("終了月", months, index=current_month - 1)  # デフォルト今月
+end_date = f"{end_year}-{end_month:02d}-01" # フォーマットを整える (YYYY-MM-01)
+
+st.write(f"選択されたティッカー: **{', '.join(tickers)}**")
+st.write(f"期間: **{start_date} 〜 {end_date or '現在'}**")
+
+# -------------------------
+# --- データ取得・相関 ---
+# -------------------------
+# 全銘柄の月次対数リターンを1回のダウンロードで取得
+log_returns = utils.load_monthly_portfolio_data(tickers, start_date, end_date)
+if log_returns.empty:
+    st.error("データが取得できませんでした。ティッカーと期間を確認してください。")
+    st.stop()
+missing = [t for t in tickers if t not in log_returns.columns]
+if missing:
+    st.warning(f"次のティッカーはデータが取得できなかったため除外しました: {', '.join(missing)}")
+tickers = list(log_returns.columns)
+st.caption(f"全銘柄のデータが揃う {len(log_returns)} ヶ月分（{log_returns.index[0]:%Y-%m} 〜 {log_returns.index[-1]:%Y-%m}）を使用します。")
+
+# 統計量サマリー（年率換算）
+mean_annual_log, std_annual_log, mean_annual_exp = utils.annualize(log_returns.mean(), log_returns.std())
+summary_table = pd.DataFrame({
+    "期待リターン(年次)": [f"{v*100:.2f}%" for v in mean_annual_exp],
+    "リスク(年次)": [f"{v*100:.2f}%" for v in std_annual_log],
+}, index=tickers)
+st.markdown("**統計量サマリー**")
+st.table(summary_table)
+
+# 相関行列
+st.markdown("**月次対数リターンの相関行列**")
+st.dataframe(log_returns.corr().round(2), use_container_width=True)
+
+
+#######################################################################################################################
+# -------------------------
+# --- ポートフォリオ資産形成シミュレーション ---
+# -------------------------
+st.subheader("ポートフォリオ資産形成シミュレーション STEP.2")
+st.markdown("""
+- 目標配分（％）を設定してください。合計が100%でなくても比率として正規化します。
+- 初期投資・毎月の積立は目標配分で各銘柄に配分します。
+- リバランスを選ぶと、指定した間隔で目標配分に戻します。
+""")
+
+# 目標配分
+weights_df = st.data_editor(
+    pd.DataFrame({"ティッカー": tickers, "配分(%)": [round(100 / len(tickers), 1)] * len(tickers)}),
+    disabled=["ティッカー"],
+    hide_index=True,
+    use_container_width=True,
+    key=f"weights_{'_'.join(tickers)}",
+)
+
+# リターンモデル・リバランス
+model_label = st.selectbox("リターンモデル", list(utils.PORTFOLIO_MODELS.values()))
+portfolio_model = next(k for k, v in utils.PORTFOLIO_MODELS.items() if v == model_label)
+mean_block_length = 12
+if portfolio_model == "joint_bootstrap":
+    mean_block_length = st.number_input("平均ブロック長（月）", min_value=1, max_value=60, value=12)
+
+rebalance_options = {"リバランスなし": 0, "毎月": 1, "四半期ごと": 3, "半年ごと": 6, "毎年": 12}
+rebalance_label = st.selectbox("リバランス", list(rebalance_options), index=4)
+
+col1, col2 = st.columns(2)
+with col1:
+    investment_years = st.number_input("投資期間（年）", min_value=1, max_value=50, value=30)
+    initial_investment = st.number_input("初期投資額（万円）", min_value=0, value=100)
+with col2:
+    monthly_contribution = st.number_input("毎月積立額（万円）", min_value=0, value=5)
+    target_amount = st.number_input("目標資産額（万円）", min_value=0, value=3000)
+
+n_sims = 5000
+n_sims_added = 5000  #「試行を追加」で前回の結果に足す試行回数
+n_months = investment_years * 12
+
+# 実行前の見積もり（メモリ予算を超える場合は単精度で計算する）
+run_plan = utils.plan_run("portfolio", n_sims, n_months, n_assets=len(tickers))
+st.caption(utils.describe_plan(run_plan))
+# 結果の計算に使う入力（前回の結果と同じときだけ「試行を追加」できる）
+input_key = utils.scenario_key(
+    "portfolio", log_returns=log_returns.values, tickers=tickers, model=portfolio_model, mean_block_length=mean_block_length,
+    weights=weights_df["配分(%)"].tolist(), rebalance_months=rebalance_options[rebalance_label], n_months=n_months,
+    initial_investment=initial_investment, monthly_contribution=monthly_contribution, target_amount=target_amount,
+)
+
+# -------------------------
+# シミュレーションボタン
+# -------------------------
+# 結果はセッションごとのメモリ予算の中で保存する（グラフは保存せず、表示のたびに作り直す）
+results = utils.session_results(st.session_state)
+
+# 追加分は前回と同じブロック・dtype で計算し、保存済みの集計に続ける（そのままでは予算に収まらなければ追加しない）
+previous = results.get("portfolio") if results.matches_input("portfolio", input_key) else None
+add_plan = utils.plan_added_run("portfolio", previous["run_plan"], previous["n_sims"] + n_sims_added, n_months, n_assets=len(tickers)) if previous else None
+
+col_run, col_add = st.columns(2)
+with col_run:
+    run_clicked = st.button("▶ シミュレーション実行(STEP2)")
+with col_add:
+    add_clicked = st.button(
+        f"＋ 試行を{n_sims_added:,}回追加して精度を上げる", disabled=add_plan is None or add_plan["mode"] == "refuse",
+        key="add_portfolio", help=add_plan["reason"] if add_plan and add_plan["reason"] else "前回と同じ入力のときだけ追加できます（入力を変えたら実行し直してください）",
+    )
+if add_clicked:
+    n_sims = previous["n_sims"] + n_sims_added
+    run_plan = add_plan
+
+if run_clicked or add_clicked:
+    # 予算を超えるシナリオは実行しない
+    if run_plan["mode"] == "refuse":
+        st.error(f"{run_plan['reason']}。期間か試行回数を減らしてください。")
+        st.stop()
+
+    weights = weights_df["配分(%)"].fillna(0).to_numpy(dtype=float)
+    if (weights < 0).any() or weights.sum() <= 0:
+        st.error("配分は0以上で、合計が0より大きくなるように入力してください。")
+        st.stop()
+
+    # 相関を含むリターンモデルを推定（推定結果はキャッシュされる）
+    model_params = {"mean_block_length": mean_block_length} if portfolio_model == "joint_bootstrap" else {}
+    model = utils.fit_return_model(portfolio_model, log_returns.values, **model_params)
+
+    # 積立額（単位: 円）
+    monthly_contributions = np.full(n_months, monthly_contribution * 1e4)
+    # パーセンタイル（2.5%,50%,97.5%）と目標到達率に要約（同じシナリオの結果は全ユーザー共有のキャッシュから返す）
+    # サーバー全体のジョブキューで実行し、順番待ち・進捗を表示（再描画されたら中断）
+    try:
+        summary = jobs.run_in_queue(
+            st.session_state, "run_portfolio", utils.portfolio_summary,
+            model, weights, n_sims, initial_investment * 1e4, monthly_contributions, target_amount * 1e4,
+            rebalance_months=rebalance_options[rebalance_label],
+            chunk_size=run_plan["chunk_size"], dtype=run_plan["dtype"],
+        )
+    except jobs.RunCancelled:
+        st.stop()
+
+    # 日付の列は保存せず、開始月と月数から表示のたびに作り直す（配列は単精度に縮めて保存される）
+    results.put("portfolio", {
+        "start": f"{current_year}-{current_month:02d}-01",
+        "n_months": n_months,
+        "percentiles": summary["percentiles"],
+        "target_amount": target_amount,
+        "hit_rate": float(summary["hit_rate"]),
+        "hit_rate_se": float(summary["hit_rate_se"]),
+        "n_sims": n_sims,
+        "input_key": input_key,
+        "run_plan": run_plan,
+        "final_percentiles": summary["final_percentiles"],
+        "risk": utils.risk_percentiles(summary),
+        "weights": weights / weights.sum(),
+        "tickers": tickers,
+    })
+    run_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    st.success("シミュレーションを実行しました。入力を変更したら再実行してください。")
+    st.caption(f"実行時刻：{run_time}")
+
+# -------------------------
+# 表示部：前回の結果を保持
+# -------------------------
+result = results.get("portfolio")
+if result is None and "portfolio" in results.evicted:
+    st.info("前回の結果はメモリ節約のため破棄されました。もう一度実行してください。")
+if result is not None:
+    dates_sim = pd.date_range(start=result["start"], periods=result["n_months"], freq='MS')
+
+    fig = utils.chart_figure("plotly_white")
+    band_index = utils.band_index(result["percentiles"])
+    fig.add_trace(utils.line_trace(dates_sim, result["percentiles"][0]/1e4, index=band_index, mode='lines', name='下限(2.5%)', line=dict(color='red', dash='dot')))
+    fig.add_trace(utils.line_trace(dates_sim, result["percentiles"][2]/1e4, index=band_index, mode='lines', name='上限(97.5%)', fill="tonexty", fillcolor="rgba(173,216,230,0.2)", line=dict(color='green', dash='dot')))
+    fig.add_trace(utils.line_trace(dates_sim, result["percentiles"][1]/1e4, index=band_index, mode='lines', name='中央値(50%)', line=dict(color='blue', width=2)))
+    fig.add_hline(
+        y=result["target_amount"],
+        line_dash="dash",
+        line_color="purple",
+        annotation_text="目標資産額",
+        annotation_position="top right"
+    )
+    allocation = " / ".join(f"{t} {w*100:.0f}%" for t, w in zip(result["tickers"], result["weights"]))
+    fig.update_layout(
+        xaxis_title="年月",
+        yaxis_title="資産額（万円）",
+        height=500,
+        title=dict(
+            text=f"ポートフォリオ資産形成シミュレーション<br>（{allocation}）",
+            x=0.5,   # 中央揃え
+            xanchor='center',
+            y=0.90,   # 上から少し下げる（デフォルトは1.0）
+            yanchor='top'
+        ),
+        legend=dict(
+            orientation="h",  # 横並び
+            yanchor="bottom",
+            y=1.03,
+            xanchor="center",
+            x=0.5
+        ),
+        margin=dict(t=150)  # 上の余白をpxで指定
+    )
+    with profiling.span("plotly_chart", figure="fig"):
+        st.plotly_chart(fig, use_container_width=True)
+
+    final = result["final_percentiles"] / 1e4
+    st.markdown(f"""
+    **最終資産額の統計値 (万円):**
+    - 2.5 %tile: {final[0]:,.0f} 万円
+    - 50 %tile (中央値): {final[1]:,.0f} 万円
+    - 97.5 %tile: {final[2]:,.0f} 万円
+    - 目標資産額への到達率: {result["hit_rate"]*100:.1f}%（標準誤差 ±{result["hit_rate_se"]*100:.2f}%）
+    """)
+    st.caption(f"試行回数: {result['n_sims']:,} 回。精度が足りない場合は「試行を追加」で前回の結果に試行を追加できます。")
+
+    # 資産推移のリスク指標（積立を含む資産額の下落・高値を下回っていた期間）
+    st.markdown("**資産推移のリスク指標（全試行の分布）**")
+    st.table(utils.risk_table(result["risk"]))
+
+# 計測結果（パフォーマンス欄・構造化ログ）
+utils.render_performance(profiler)
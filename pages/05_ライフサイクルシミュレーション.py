@@ -0,0 +1,281 @@
+import streamlit as st
+import numpy as np
+from datetime import datetime
+import pandas as pd
+import jobs
+import profiling
+import utils
+
+# キャッシュをクリアして実行
+st.cache_data.clear()
+
+# 既定ティッカーの市場データを裏で先読み（プロセス内で1回だけ）
+utils.start_background_prefetch()
+
+# このページの描画をステージごとに計測（?perf=1 または PERF_PANEL=1 で末尾に表示）
+profiler = profiling.page_profiler(st.session_state, "05_ライフサイクル")
+
+# 再描画（入力の変更・再クリック）されたら、このセッションで実行中の古いシミュレーションを中断する
+jobs.cancel_run(st.session_state, "run_lifecycle")
+
+#######################################################################################################################
+# -------------------------
+# --- 月次データとリターンモデル ---
+# -------------------------
+st.title("ライフサイクルシミュレーション")
+st.subheader("月次データとリターンモデル STEP.1")
+st.markdown("""
+- 積立（資産形成）から取り崩しまでを、1本のつながったリターンの推移でシミュレーションします。
+- 試行ごとに積立の最終資産がそのまま取り崩しの初期資産になるので、退職時資産のばらつきも含めて「最後まで資産が尽きない確率」を求めます。
+""")
+
+# ティッカー選択
+ticker_choice = st.selectbox("ティッカーを選択してください。またはcustomにして希望の銘柄を入力してください。(Yahoo! Finance登録銘柄)", utils.DEFAULT_TICKERS + ["custom"])
+if ticker_choice == "custom":
+    ticker = st.text_input("カスタムティッカーを入力してください（例: AAPL, TSLAなど）", value="AAPL")
+else:
+    ticker = ticker_choice
+
+# 日付選択
+current_year = datetime.now().year
+current_month = datetime.now().month
+years = list(range(1999, current_year + 1))
+months = list(range(1, 13))
+
+col1, col2 = st.columns(2)
+with col1:
+    year = st.selectbox("開始年", years, index=years.index(2009) if 2009 in years else 0)
+with col2:
+    month = st.selectbox("開始月", months, index=8)
+start_date = f"{year}-{month:02d}-01" # フォーマットを整える (YYYY-MM-01)
+
+col3, col4 = st.columns(2)
+with col3:
+    end_year = st.selectbox("終了年", years, index=years.index(current_year))
+with col4:
+    end_month = st.selectbox("終了月", months, index=current_month - 1)  # デフォルト今月
+end_date = f"{end_year}-{end_month:02d}-01" # フォーマットを整える (YYYY-MM-01)
+
+# リターンモデル選択
+return_model_label = st.selectbox(
+    "リターンモデル（シミュレーションに用いる月次リターンの生成方法）",
+    list(utils.RETURN_MODELS.values()),
+)
+return_model = next(k for k, v in utils.RETURN_MODELS.items() if v == return_model_label)
+mean_block_length = 12
+if return_model == "bootstrap":
+    mean_block_length = st.number_input("平均ブロック長（月）", min_value=1, max_value=60, value=12)
+parameter_uncertainty = False
+if return_model in utils.UNCERTAINTY_BASE_MODELS:
+    parameter_uncertainty = st.checkbox(
+        "パラメータの推定誤差を反映する",
+        help="実績リターンを再標本化して推定し直したパラメータを多数用意し、パスのまとまりごとに異なるパラメータで生成します。"
+             "限られた期間のデータから推定した期待リターン・リスクの不確かさが、結果の幅に加わります。"
+    )
+
+# 月次データ取得
+df_monthly = utils.load_monthly_data(ticker, start_date, end_date)
+if df_monthly.empty:
+    st.error(f"ティッカー `{ticker}` のデータが取得できませんでした。入力を確認してください。")
+    st.stop()
+st.caption(f"{len(df_monthly)} ヶ月分（{df_monthly.index[0]:%Y-%m} 〜 {df_monthly.index[-1]:%Y-%m}）の月次リターンからリターンモデルを推定します。")
+
+
+#######################################################################################################################
+# -------------------------
+# --- 積立から取り崩しまでのシミュレーション ---
+# -------------------------
+st.subheader("積立から取り崩しまでのシミュレーション STEP.2")
+st.markdown("""
+- 金額はすべて万円です。生活費は現在の金額で入力してください（インフレを反映する場合は、積立期間の物価上昇分も加えて取り崩しを始めます）。
+- 取り崩しの戦略は「取り崩しシミュレーション」の既定の分岐（各項目の1番目の選択肢）で計算します。
+""")
+
+st.markdown("**積立（資産形成）**")
+col1, col2 = st.columns(2)
+with col1:
+    accumulation_years = st.number_input("積立期間（年）", min_value=1, max_value=50, value=20)
+    initial_investment = st.number_input("初期投資額（万円）", min_value=0, value=100)
+with col2:
+    monthly_contribution = st.number_input("毎月積立額（万円）", min_value=0, value=5)
+
+st.markdown("**取り崩し**")
+col1, col2 = st.columns(2)
+with col1:
+    retirement_years = st.number_input("取り崩し期間（年）", min_value=1, max_value=50, value=30)
+    monthly_need = st.number_input("生活費（月額, 現在の金額, 万円）", value=20, step=1)
+    withdrawal_rate = st.number_input("取り崩し率（月次, %）", value=1.0, step=0.1)
+with col2:
+    initial_savings = st.number_input("取り崩し開始時の現金貯金（万円）", value=400, step=50)
+    inflation_rate = st.number_input("インフレ率（年率, %）", value=2.0, step=0.1)
+    adjust_need_for_inflation = st.checkbox("生活費をインフレ率に応じて増加させる", value=True)
+
+col1, col2 = st.columns(2)
+with col1:
+    min_savings_ratio = st.number_input("貯金下限比率（資産に対して）[%]", value=10, step=1, min_value=0, max_value=100)
+with col2:
+    max_savings_ratio = st.number_input("貯金上限比率（資産に対して）[%]", value=30, step=1, min_value=0, max_value=100)
+
+n_trials = 2000
+n_trials_added = 2000  #「試行を追加」で前回の結果に足す試行回数
+n_accumulation_months = accumulation_years * 12
+n_withdrawal_months = retirement_years * 12
+
+# 実行前の見積もり（メモリ予算を超える場合は単精度で計算する）
+run_plan = utils.plan_run("lifecycle", n_trials, n_accumulation_months + n_withdrawal_months)
+st.caption(utils.describe_plan(run_plan))
+
+withdrawal_kwargs = dict(
+    initial_savings=initial_savings,
+    monthly_need=monthly_need,
+    withdrawal_rate=withdrawal_rate,
+    min_savings_ratio=min_savings_ratio,
+    max_savings_ratio=max_savings_ratio,
+    inflation_rate=inflation_rate,
+    adjust_need_for_inflation=adjust_need_for_inflation,
+)
+# 結果の計算に使う入力（前回の結果と同じときだけ「試行を追加」できる）
+input_key = utils.scenario_key(
+    "lifecycle", log_returns=df_monthly['Log_Return'].values, model=return_model, mean_block_length=mean_block_length,
+    parameter_uncertainty=parameter_uncertainty, initial_investment=initial_investment,
+    monthly_contribution=monthly_contribution, n_accumulation_months=n_accumulation_months,
+    n_withdrawal_months=n_withdrawal_months, **withdrawal_kwargs,
+)
+
+# -------------------------
+# シミュレーションボタン
+# -------------------------
+# 結果はセッションごとのメモリ予算の中で保存する（グラフは保存せず、表示のたびに作り直す）
+results = utils.session_results(st.session_state)
+
+# 追加分は前回と同じブロック・dtype で計算し、保存済みの集計に続ける（そのままでは予算に収まらなければ追加しない）
+previous = results.get("lifecycle") if results.matches_input("lifecycle", input_key) else None
+add_plan = utils.plan_added_run("lifecycle", previous["run_plan"], previous["n_trials"] + n_trials_added, n_accumulation_months + n_withdrawal_months) if previous else None
+
+col_run, col_add = st.columns(2)
+with col_run:
+    run_clicked = st.button("▶ シミュレーション実行(STEP2)")
+with col_add:
+    add_clicked = st.button(
+        f"＋ 試行を{n_trials_added:,}回追加して精度を上げる", disabled=add_plan is None or add_plan["mode"] == "refuse",
+        key="add_lifecycle", help=add_plan["reason"] if add_plan and add_plan["reason"] else "前回と同じ入力のときだけ追加できます（入力を変えたら実行し直してください）",
+    )
+if add_clicked:
+    n_trials = previous["n_trials"] + n_trials_added
+    run_plan = add_plan
+
+if run_clicked or add_clicked:
+    # 予算を超えるシナリオは実行しない
+    if run_plan["mode"] == "refuse":
+        st.error(f"{run_plan['reason']}。期間か試行回数を減らしてください。")
+        st.stop()
+
+    # リターンモデルを推定（推定結果はキャッシュされる）
+    model_params = {"mean_block_length": mean_block_length} if return_model == "bootstrap" else {}
+    model = utils.fit_return_model(return_model, df_monthly['Log_Return'].values, **model_params)
+    if parameter_uncertainty:
+        model = utils.fit_return_model("uncertain", df_monthly['Log_Return'].values, base=return_model)
+    # 積立と取り崩しを同じリターン列で1回に計算（同じシナリオの結果は全ユーザー共有のキャッシュから返す）
+    # サーバー全体のジョブキューで実行し、順番待ち・進捗を表示（再描画されたら中断）
+    try:
+        summary = jobs.run_in_queue(
+            st.session_state, "run_lifecycle", utils.lifecycle_summary,
+            model, n_trials, initial_investment, np.full(n_accumulation_months, float(monthly_contribution)),
+            withdrawal_kwargs, n_withdrawal_months,
+            chunk_size=run_plan["chunk_size"], dtype=run_plan["dtype"],
+        )
+    except jobs.RunCancelled:
+        st.stop()
+
+    # 日付の列は保存せず、開始月と月数から表示のたびに作り直す（配列は単精度に縮めて保存される）
+    results.put("lifecycle", {
+        "start": f"{current_year}-{current_month:02d}-01",
+        "n_accumulation_months": n_accumulation_months,
+        "percentiles": summary["percentiles"],
+        "survival": summary["survival"],
+        "retirement_percentiles": summary["retirement_percentiles"],
+        "retirement_edges": summary["retirement_edges"],
+        "retirement_counts": summary["retirement_counts"],
+        "success_by_retirement": summary["success_by_retirement"],
+        "success_rate": float(summary["success_rate"]),
+        "success_rate_se": float(summary["success_rate_se"]),
+        "n_trials": n_trials,
+        "input_key": input_key,
+        "run_plan": run_plan,
+    })
+    run_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    st.success("シミュレーションを実行しました。入力を変更したら再実行してください。")
+    st.caption(f"実行時刻：{run_time}")
+
+# -------------------------
+# 表示部：前回の結果を保持
+# -------------------------
+result = results.get("lifecycle")
+if result is None and "lifecycle" in results.evicted:
+    st.info("前回の結果はメモリ節約のため破棄されました。もう一度実行してください。")
+if result is not None:
+    percentiles = result["percentiles"]
+    dates_sim = pd.date_range(start=result["start"], periods=percentiles.shape[1], freq='MS')
+    retirement_date = dates_sim[result["n_accumulation_months"]]
+
+    col_m1, col_m2 = st.columns(2)
+    col_m1.metric("最後まで総資産が尽きない確率", f"{result['success_rate']*100:.1f}%")
+    col_m2.metric("退職時資産（中央値）", f"{result['retirement_percentiles'][1]:,.0f} 万円")
+
+    fig = utils.chart_figure("plotly_white")
+    band_index = utils.band_index(percentiles)
+    fig.add_trace(utils.line_trace(dates_sim, percentiles[0], index=band_index, mode='lines', name='下限(2.5%)', line=dict(color='red', dash='dot')))
+    fig.add_trace(utils.line_trace(dates_sim, percentiles[2], index=band_index, mode='lines', name='上限(97.5%)', fill="tonexty", fillcolor="rgba(173,216,230,0.2)", line=dict(color='green', dash='dot')))
+    fig.add_trace(utils.line_trace(dates_sim, percentiles[1], index=band_index, mode='lines', name='中央値(50%)', line=dict(color='blue', width=2)))
+    fig.add_vline(x=retirement_date, line_dash="dash", line_color="purple")
+    fig.add_annotation(x=retirement_date, y=1, yref="paper", text="取り崩し開始", showarrow=False, xanchor="left")
+    fig.update_layout(
+        xaxis_title="年月",
+        yaxis_title="総資産（万円）",
+        height=500,
+        legend=dict(
+            orientation="h",  # 横並び
+            yanchor="bottom",
+            y=1.03,
+            xanchor="center",
+            x=0.5
+        ),
+    )
+    with profiling.span("plotly_chart", figure="fig"):
+        st.plotly_chart(fig, use_container_width=True)
+
+    retirement = result["retirement_percentiles"]
+    st.markdown(f"""
+    **退職時資産（取り崩し開始時の株式資産）の統計値 (万円):**
+    - 2.5 %tile: {retirement[0]:,.0f} 万円
+    - 50 %tile (中央値): {retirement[1]:,.0f} 万円
+    - 97.5 %tile: {retirement[2]:,.0f} 万円
+    """)
+
+    # 退職時資産と成否の同時分布：退職時資産が元本の何倍だったかの区分ごとに、最後まで尽きなかった割合
+    st.markdown("**退職時資産の区分ごとの、最後まで総資産が尽きなかった割合**")
+    edges, counts = result["retirement_edges"], result["retirement_counts"]
+    multiples = utils.LIFECYCLE_MULTIPLE_EDGES
+    labels = [f"元本の{lo:g}〜{hi:g}倍" for lo, hi in zip(multiples[:-1], multiples[1:])] + [f"元本の{multiples[-1]:g}倍以上"]
+    joint_table = pd.DataFrame({
+        "退職時資産（万円）": [f"{lo:,.0f} 〜" for lo in edges],
+        "試行の割合": [f"{c / counts.sum() * 100:.1f}%" for c in counts],
+        "尽きなかった割合": [f"{r*100:.1f}%" if np.isfinite(r) else "-" for r in result["success_by_retirement"]],
+    }, index=labels)
+    st.table(joint_table[counts > 0])
+
+    # 生存曲線（取り崩し開始後、各月末に総資産が残っている試行の割合）
+    survival = result["survival"]
+    fig_survival = utils.chart_figure("plotly_white")
+    fig_survival.add_trace(utils.line_trace(np.arange(1, len(survival) + 1) / 12, survival * 100, mode="lines", name="総資産が残っている割合", line=dict(color="black")))
+    fig_survival.update_layout(xaxis_title="取り崩し開始からの年数", yaxis_title="割合（%）", yaxis_range=[0, 101], height=300)
+    with profiling.span("plotly_chart", figure="fig_survival"):
+        st.plotly_chart(fig_survival, use_container_width=True)
+
+    st.caption(
+        f"試行回数: {result['n_trials']:,} 回、最後まで総資産が尽きなかった割合の標準誤差 ±{result['success_rate_se']*100:.2f}%。"
+        "精度が足りない場合は「試行を追加」で前回の結果に試行を追加できます。"
+    )
+
+# 計測結果（パフォーマンス欄・構造化ログ）
+utils.render_performance(profiler)
@@ -0,0 +1,196 @@
+# 計測（ステージごとの実時間・CPU時間・ピークメモリ）
+#
+# ページ: profiler = profiling.page_profiler(st.session_state, "02_資産形成") で計測を始め、描画の最後に utils.render_performance(profiler) で終える。
+#   st.stop() で途中終了して止まらなかった計測は、同じセッションの次の page_profiler() が止める（tracemalloc の停止とログ出力は漏れない）。
+# 処理側: with profiling.span("download", tickers=...) / @profiling.timed("simulate_accumulation") でステージを記録する。
+# 計測していないときの span() はほぼ何もしない。
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+
+PERF_LOG = os.getenv("PERF_LOG", "") not in ("", "0")                    # 1 なら各ステージを構造化ログ（JSON 1行）に出力
+PERF_TRACE_MEMORY = os.getenv("PERF_TRACE_MEMORY", "") not in ("", "0")  # 1 ならピークメモリも計測（tracemalloc、数割遅くなる）
+PERF_PANEL = os.getenv("PERF_PANEL", "") not in ("", "0")                # 1 なら全ページに「パフォーマンス」欄を表示（?perf=1 でも表示）
+PERF_LOGGER = logging.getLogger("monte_carlo.perf")
+_PROFILER = contextvars.ContextVar("profiler", default=None)
+_PERF_EPOCH = time.perf_counter()
+
+
+# 1回の実行（ページの1回の描画など）のステージ計測結果
+class Profiler:
+    """
+    start() から stop() までの間、同じスレッド（と、そのコンテキストを引き継いだジョブのスレッド）で span() を通ったステージを記録する。
+    ステージの入れ子はスレッドごとに数える。計測していないときの span() はほぼ何もしない。stop() は2回目以降は何もしない。
+    """
+    def __init__(self, name, trace_memory=None):
+        self.name = name
+        self.trace_memory = PERF_TRACE_MEMORY if trace_memory is None else trace_memory
+        self.spans = []                  # 終了したステージの記録（終了順、全スレッド分）
+        self._local = threading.local()  # スレッドごとの実行中のステージ（入れ子）
+        self._owns_tracemalloc = False
+        self._running = False
+
+    # このスレッドで実行中のステージ（ページの再描画とジョブのワーカーが同時に計測しても混ざらない）
+    @property
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_tracemalloc = True
+        self._running = True
+        _PROFILER.set(self)
+        return self
+
+    def stop(self):
+        if not self._running:
+            return self
+        self._running = False
+        if _PROFILER.get() is self:
+            _PROFILER.set(None)
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+            self._owns_tracemalloc = False
+        if PERF_LOG:
+            self.log()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    # 開始順に並べた記録
+    def records(self):
+        return sorted(self.spans, key=lambda r: (r["start_ms"], r["depth"]))
+
+    def table(self):
+        df = pd.DataFrame(self.records(), columns=["name", "depth", "start_ms", "wall_ms", "cpu_ms", "peak_mb", "attrs"])
+        df["name"] = ["  " * d + n for d, n in zip(df["depth"], df["name"])]
+        df["attrs"] = [", ".join(f"{k}={v}" for k, v in a.items()) for a in df["attrs"]]
+        return df.drop(columns="depth")
+
+    # 1ステージ1行の JSON ログ
+    def log(self, logger=PERF_LOGGER):
+        for record in self.records():
+            logger.info(json.dumps({"profile": self.name, **record}, ensure_ascii=False, default=str))
+
+    # chrome://tracing / Perfetto で開けるトレース
+    def chrome_trace(self):
+        events = [
+            {
+                "name": r["name"], "cat": self.name, "ph": "X", "pid": os.getpid(), "tid": r["thread"],
+                "ts": r["start_ms"] * 1e3, "dur": r["wall_ms"] * 1e3,
+                "args": {"cpu_ms": r["cpu_ms"], "peak_mb": r["peak_mb"], **r["attrs"]},
+            }
+            for r in self.records()
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+# 計測中のステージ
+class _Span:
+    def __init__(self, profiler, name, attrs):
+        self.profiler = profiler
+        self.name = name
+        self.attrs = attrs
+        self.child_peak = 0
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = self.profiler._stack
+        self.parent = stack[-1] if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+        self.mem_start = None
+        if self.profiler.trace_memory and tracemalloc.is_tracing():
+            # 親のピークを退避してから、このステージ用にピークをリセット
+            current, peak = tracemalloc.get_traced_memory()
+            if self.parent is not None:
+                self.parent.child_peak = max(self.parent.child_peak, peak)
+            tracemalloc.reset_peak()
+            self.mem_start = current
+        self.cpu_start = time.thread_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        cpu = time.thread_time() - self.cpu_start
+        peak_mb = None
+        if self.mem_start is not None and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+            peak_mb = round((peak - self.mem_start) / 2**20, 3)
+            if self.parent is not None:
+                self.parent.child_peak = max(self.parent.child_peak, peak)
+        self.profiler._stack.pop()
+        self.profiler.spans.append({
+            "name": self.name,
+            "depth": self.depth,
+            "start_ms": round((self.start - _PERF_EPOCH) * 1e3, 3),
+            "wall_ms": round((end - self.start) * 1e3, 3),
+            "cpu_ms": round(cpu * 1e3, 3),
+            "peak_mb": peak_mb,
+            "thread": threading.get_ident(),
+            "attrs": self.attrs,
+        })
+        return False
+
+
+# 計測していないときの span()（何もしない）
+class _NullSpan:
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+# ページの描画の計測を開始（前回の描画が st.stop() で途中終了し、止まっていない計測があれば先に止める）
+def page_profiler(state, name):
+    previous = state.get("_page_profiler")
+    if previous is not None:
+        previous.stop()
+    profiler = state["_page_profiler"] = Profiler(name).start()
+    return profiler
+
+
+# ステージの計測: with span("download", tickers=...) as s: ...; s.set(cache="hit")
+def span(name, **attrs):
+    profiler = _PROFILER.get()
+    if profiler is None:
+        return _NULL_SPAN
+    return _Span(profiler, name, attrs)
+
+
+# 関数全体をステージとして計測するデコレーター
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,109 @@
+# 共有メモリ上の行列（複数プロセスの間でコピーせずに使う）
+#
+# 親プロセス: with SharedArrayPool() as pool: handle = pool.put(key, array) でハンドル（pickle できる）を作り、ワーカーに渡す。
+# ワーカー:   with shared_returns({key: handle}): ... の中では、utils の要約関数がリターン行列を生成せずに共有メモリを読む。
+import contextlib
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+_SHARED_RETURNS = {}   # リターン列のキー -> このプロセスで参照中の共有リターン行列（block_returns が使う）
+_ATTACHED = {}         # 共有メモリ名 -> [SharedMemory, 配列, 参照数]
+_ATTACH_LOCK = threading.Lock()
+
+
+# 共有メモリ上の配列を作成し、参照数で寿命を管理する（作成する側のプロセスで使う）
+class SharedArrayPool:
+    def __init__(self):
+        self._blocks = {}  # キー -> [SharedMemory, ハンドル, 参照数]
+        self._lock = threading.Lock()
+
+    # 配列を共有メモリにコピーし、ハンドル（名前・形・dtype、pickle できる）を返す。同じキーなら参照数を増やす
+    def put(self, key, array):
+        with self._lock:
+            if key in self._blocks:
+                self._blocks[key][2] += 1
+                return self._blocks[key][1]
+            array = np.ascontiguousarray(array)
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+            handle = {"name": shm.name, "shape": array.shape, "dtype": array.dtype.str}
+            self._blocks[key] = [shm, handle, 1]
+            return handle
+
+    # 参照数を減らし、0 になったら共有メモリを解放する
+    def release(self, key):
+        with self._lock:
+            entry = self._blocks.get(key)
+            if entry is None:
+                return
+            entry[2] -= 1
+            if entry[2] <= 0:
+                del self._blocks[key]
+                entry[0].close()
+                entry[0].unlink()
+
+    def close(self):
+        with self._lock:
+            blocks, self._blocks = self._blocks, {}
+        for shm, _, _ in blocks.values():
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# 共有メモリの配列を読み取り専用のビューとして参照する（同じプロセスで何度参照しても1回だけ開く）
+def attach_shared(handle):
+    with _ATTACH_LOCK:
+        entry = _ATTACHED.get(handle["name"])
+        if entry is None:
+            try:
+                shm = shared_memory.SharedMemory(name=handle["name"], track=False)  # Python 3.13 以降
+            except TypeError:
+                shm = shared_memory.SharedMemory(name=handle["name"])
+            view = np.ndarray(tuple(handle["shape"]), dtype=np.dtype(handle["dtype"]), buffer=shm.buf)
+            view.flags.writeable = False
+            entry = _ATTACHED[handle["name"]] = [shm, view, 0]
+        entry[2] += 1
+        return entry[1]
+
+
+def detach_shared(handle):
+    with _ATTACH_LOCK:
+        entry = _ATTACHED.get(handle["name"])
+        if entry is None:
+            return
+        entry[2] -= 1
+        if entry[2] <= 0:
+            del _ATTACHED[handle["name"]]
+            shm = entry[0]
+            entry.clear()
+            try:
+                shm.close()
+            except BufferError:
+                pass  # ビューがまだ使われていれば、プロセス終了時に閉じる
+
+
+# 共有メモリのリターン行列（リターン列のキー -> ハンドル）を、この中で実行する要約関数に使わせる
+@contextlib.contextmanager
+def shared_returns(handles):
+    for key, handle in handles.items():
+        _SHARED_RETURNS[key] = attach_shared(handle)
+    try:
+        yield
+    finally:
+        for key, handle in handles.items():
+            _SHARED_RETURNS.pop(key, None)
+            detach_shared(handle)
+
+
+# このプロセスで参照中の共有リターン行列（なければ None、utils.block_returns が使う）
+def get_shared_returns(key):
+    return _SHARED_RETURNS.get(key)
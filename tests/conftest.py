@@ -0,0 +1,8 @@
+# テスト共通の設定
+# 結果キャッシュ・パス行列の保存先をテストごとの一時ディレクトリにする（utils を読み込む前に設定する）
+import os
+import tempfile
+
+_TMP = tempfile.mkdtemp(prefix="mc_tests_")
+os.environ.setdefault("RESULT_CACHE_DIR", os.path.join(_TMP, "result_cache"))
+os.environ.setdefault("PATH_STORE_DIR", os.path.join(_TMP, "path_store"))
@@ -0,0 +1,67 @@
+# 「試行を追加」: N 本の結果に M 本を追加した結果は、N+M 本を1回で実行した結果と完全に一致する
+import numpy as np
+import pytest
+
+import utils
+
+
+WITHDRAWAL_KWARGS = dict(
+    initial_savings=400, monthly_need=20, withdrawal_rate=4.0, min_savings_ratio=10, max_savings_ratio=30,
+    inflation_rate=2.0, option1_2="1-2-2",
+)
+
+
+@pytest.fixture
+def model():
+    return utils.fit_return_model("normal", np.random.default_rng(0).normal(0.005, 0.05, 180))
+
+
+# 空の結果キャッシュで run(n) を実行する
+def _fresh_run(monkeypatch, tmp_path, name, run, n):
+    monkeypatch.setattr(utils, "RESULT_CACHE", utils.ResultCache(directory=str(tmp_path / name)))
+    return run(n)
+
+
+def _assert_identical(added, single):
+    assert added.keys() == single.keys()
+    for key in single:
+        np.testing.assert_array_equal(np.asarray(added[key]), np.asarray(single[key]), err_msg=key)
+
+
+# 端数（ブロックの途中まで）のある N・M も含める
+@pytest.mark.parametrize("n, m", [(1000, 500), (700, 800)])
+@pytest.mark.parametrize("engine", ["accumulation", "withdrawal", "lifecycle"])
+def test_added_paths_match_single_run(monkeypatch, tmp_path, model, engine, n, m):
+    runs = {
+        "accumulation": lambda n_paths: utils.accumulation_summary(
+            model, n_paths, 1e6, np.full(120, 5e4), 2e7, seed=1),
+        "withdrawal": lambda n_paths: utils.withdrawal_summary(
+            model, n_paths, 120, {"initial_assets": 2000, **WITHDRAWAL_KWARGS}, seed=1),
+        "lifecycle": lambda n_paths: utils.lifecycle_summary(
+            model, n_paths, 100, np.full(60, 5.0), WITHDRAWAL_KWARGS, 120, seed=1),
+    }
+    run = runs[engine]
+    _fresh_run(monkeypatch, tmp_path, "added", run, n)
+    # 保存済みの n 本の集計状態に続きのブロックだけを足す（生成するブロック数で確かめる）
+    sampled = []
+    sample_returns = utils.sample_returns
+    monkeypatch.setattr(utils, "sample_returns", lambda *args, **kwargs: sampled.append(1) or sample_returns(*args, **kwargs))
+    added = run(n + m)
+    block = utils.PATH_BLOCK_SIZE
+    assert len(sampled) == -(-(n + m) // block) - n // block
+    monkeypatch.setattr(utils, "sample_returns", sample_returns)
+    single = _fresh_run(monkeypatch, tmp_path, "single", run, n + m)
+    _assert_identical(added, single)
+
+
+def test_portfolio_added_paths_match_single_run(monkeypatch, tmp_path):
+    returns = np.random.default_rng(1).multivariate_normal([0.006, 0.008], [[0.002, 0.001], [0.001, 0.003]], 180)
+    model = utils.fit_return_model("mvnormal", returns)
+
+    def run(n_paths):
+        return utils.portfolio_summary(model, [60, 40], n_paths, 1e6, np.full(120, 5e4), 2e7, seed=2)
+
+    _fresh_run(monkeypatch, tmp_path, "added", run, 1000)
+    added = run(1600)
+    single = _fresh_run(monkeypatch, tmp_path, "single", run, 1600)
+    _assert_identical(added, single)
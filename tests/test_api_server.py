@@ -0,0 +1,108 @@
+# HTTP API の結合テスト（uvicorn をスレッドで起動し、ローカルの市場データで実際にリクエストを送る）
+import json
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("starlette")
+uvicorn = pytest.importorskip("uvicorn")
+
+import api_server
+import utils
+
+
+# 合成した月次OHLC（15年分）を一時ディレクトリのローカルストアに置く
+def _write_market_data(directory):
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2010-01-01", periods=180, freq="MS")
+    close = 100 * np.exp(np.cumsum(rng.normal(0.007, 0.045, len(dates))))
+    df = pd.DataFrame({"Open": close, "High": close, "Low": close, "Close": close, "Volume": 1.0}, index=dates)
+    utils.save_ohlc(df, "TEST", directory)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# ワーカープロセスは fork 時のデータソースを引き継ぐので、サーバー起動前に差し替える
+@pytest.fixture(scope="module")
+def base_url(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp("market"))
+    _write_market_data(directory)
+    utils.set_data_source(utils.LocalFileSource(directory))
+    api_server.API_WORKERS = 2
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(api_server.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 30
+    while not server.started:
+        assert time.monotonic() < deadline, "サーバーが起動しませんでした"
+        time.sleep(0.05)
+    yield f"http://127.0.0.1:{port}"
+    server.should_exit = True
+    thread.join(timeout=30)
+    utils.set_data_source(None)
+
+
+# (ステータス, ヘッダー, JSON) を返す
+def _post(base_url, path, body):
+    request = urllib.request.Request(
+        base_url + path, data=json.dumps(body).encode(), method="POST", headers={"Content-Type": "application/json"}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=120) as response:
+            return response.status, response.headers, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, json.loads(e.read())
+
+
+SCENARIO = {"ticker": "TEST", "start_date": "2010-01-01", "end_date": "2025-01-01", "years": 10}
+
+
+def test_withdrawal_returns_summary(base_url):
+    status, headers, body = _post(base_url, "/withdrawal", {**SCENARIO, "n_sims": 500, "seed": 1})
+    assert status == 200
+    assert headers["X-Coalesced"] == "0"
+    assert body["n_sims"] == 500
+    assert 0.0 <= body["success_rate"] <= 1.0
+    assert np.shape(body["Total"]) == (3, 10 * 12)
+
+
+@pytest.mark.parametrize("path, body", [
+    ("/withdrawal", {"n_sims": 0}),
+    ("/withdrawal", {"seed": "x"}),
+    ("/withdrawal", {"options": {"option1_1": "x"}}),
+    ("/accumulation", {"years": -1}),
+    ("/accumulation", {"ticker": "NOPE"}),
+])
+def test_invalid_requests_are_rejected_with_400(base_url, path, body):
+    status, _, payload = _post(base_url, path, {**SCENARIO, "n_sims": 100, **body})
+    assert status == 400
+    assert payload["error"]
+
+
+def test_unknown_endpoint_is_404(base_url):
+    status, _, _ = _post(base_url, "/nope", {})
+    assert status == 404
+
+
+def test_concurrent_identical_requests_are_coalesced(base_url):
+    # 同時に届いた同一入力は1回の計算にまとめ、全員に同じ結果を返す
+    body = {**SCENARIO, "years": 30, "n_sims": 20000, "seed": 7}
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        responses = list(executor.map(lambda _: _post(base_url, "/withdrawal", body), range(4)))
+    assert all(status == 200 for status, _, _ in responses)
+    coalesced = sorted(headers["X-Coalesced"] for _, headers, _ in responses)
+    assert coalesced.count("0") == 1 and coalesced.count("1") >= 1
+    assert len({headers["X-Scenario-Key"] for _, headers, _ in responses}) == 1
+    assert all(payload == responses[0][2] for _, _, payload in responses)
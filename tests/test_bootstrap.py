@@ -0,0 +1,46 @@
+# 定常ブートストラップの再標本化インデックスの性質
+import numpy as np
+
+import utils
+
+
+def test_indices_shape_and_range():
+    idx = utils.stationary_bootstrap_indices(50, 200, 120, mean_block_length=6, rng=np.random.default_rng(0))
+    assert idx.shape == (200, 120)
+    assert idx.min() >= 0 and idx.max() < 50
+
+
+def test_same_seed_gives_same_indices():
+    a = utils.stationary_bootstrap_indices(50, 20, 30, rng=np.random.default_rng(1))
+    b = utils.stationary_bootstrap_indices(50, 20, 30, rng=np.random.default_rng(1))
+    np.testing.assert_array_equal(a, b)
+
+
+def test_blocks_continue_circularly_with_expected_break_rate():
+    # ブロックの途中は前月の次の観測値（末尾の次は先頭）、新しいブロックは確率 1/mean_block_length で始まる
+    n_obs, mean_block_length = 1000, 8
+    idx = utils.stationary_bootstrap_indices(n_obs, 2000, 60, mean_block_length, rng=np.random.default_rng(2))
+    breaks = idx[:, 1:] != (idx[:, :-1] + 1) % n_obs
+    # 新しいブロックの開始位置が偶然「次の観測値」になる分（1/n_obs）だけ少なく見える
+    expected = (1 / mean_block_length) * (1 - 1 / n_obs)
+    assert abs(breaks.mean() - expected) < 0.01
+
+
+def test_very_long_blocks_are_one_circular_run():
+    idx = utils.stationary_bootstrap_indices(12, 50, 40, mean_block_length=1e12, rng=np.random.default_rng(3))
+    np.testing.assert_array_equal(idx, (idx[:, :1] + np.arange(40)) % 12)
+
+
+def test_block_length_one_is_iid_uniform():
+    n_obs = 10
+    idx = utils.stationary_bootstrap_indices(n_obs, 5000, 20, mean_block_length=1, rng=np.random.default_rng(4))
+    counts = np.bincount(idx.ravel(), minlength=n_obs) / idx.size
+    assert np.allclose(counts, 1 / n_obs, atol=0.005)
+
+
+def test_returns_resample_all_assets_from_the_same_month():
+    # (n_obs, n_assets) のリターンは同じ月の行をまとめて抽出する（銘柄間の相関を保つ）
+    log_returns = np.column_stack([np.arange(30.0), np.arange(30.0) * 10])
+    sampled = utils.stationary_bootstrap_returns(log_returns, 40, 24, rng=np.random.default_rng(5))
+    assert sampled.shape == (40, 24, 2)
+    np.testing.assert_array_equal(sampled[..., 1], sampled[..., 0] * 10)
@@ -0,0 +1,33 @@
+# グラフに送る系列の間引き
+import numpy as np
+import pandas as pd
+
+import utils
+
+
+def _bands(n=600):
+    walk = np.cumsum(np.random.default_rng(0).normal(size=(3, n)), axis=1)
+    return np.sort(walk, axis=0)
+
+
+def test_observed_series_is_not_decimated():
+    dates = pd.date_range("1990-01-01", periods=400, freq="MS")
+    y = np.random.default_rng(1).normal(size=400)
+    trace = utils.line_trace(dates, y, max_points=0, mode="lines+markers")
+    assert len(trace["y"]) == len(trace["x"]) == 400
+
+
+def test_band_traces_share_positions():
+    bands = _bands()
+    index = utils.band_index(bands, max_points=150)
+    assert len(index) <= 150
+    traces = [utils.line_trace(np.arange(bands.shape[1]), row, index=index) for row in bands]
+    assert all(np.array_equal(t["x"], traces[0]["x"]) for t in traces)
+    # 各系列の最大・最小と先頭・末尾は残る
+    for row in bands:
+        assert {0, len(row) - 1, int(row.argmin()), int(row.argmax())} <= set(index.tolist())
+
+
+def test_short_series_are_not_decimated():
+    assert utils.band_index(_bands(100), max_points=150) is None
+    assert utils.decimation_index(np.arange(10.0), 0) is None
@@ -0,0 +1,58 @@
+# ライフサイクル（積立から取り崩しへの引き継ぎ）
+import numpy as np
+
+import utils
+
+
+WITHDRAWAL_KWARGS = dict(
+    initial_savings=400, monthly_need=20, withdrawal_rate=1.0, min_savings_ratio=10, max_savings_ratio=30,
+    inflation_rate=2.0, adjust_need_for_inflation=True,
+)
+
+
+def _returns(n_accumulation, n_withdrawal, n_paths=300):
+    return np.random.default_rng(0).normal(0.005, 0.045, size=(n_paths, n_accumulation + n_withdrawal))
+
+
+def test_last_accumulated_value_is_initial_assets():
+    n_accumulation, n_withdrawal = 120, 240
+    log_returns = _returns(n_accumulation, n_withdrawal)
+    contributions = np.full(n_accumulation, 5.0)
+    result = utils.simulate_lifecycle(log_returns, 100, contributions, WITHDRAWAL_KWARGS)
+
+    accumulation = utils.simulate_accumulation(log_returns[:, :n_accumulation], 100, contributions)
+    np.testing.assert_array_equal(result["Accumulation"], accumulation)
+    # 取り崩し初月の株式資産（取り崩し前）は、積立の最終資産にその月のリターンを掛けたもの
+    first_assets = result["Assets"][:, 0] + result["Used"][:, 0]
+    np.testing.assert_allclose(first_assets, accumulation[:, -1] * np.exp(log_returns[:, n_accumulation]), rtol=1e-12)
+    # 試行ごとに積立の最終資産を初期資産にした取り崩しと一致する
+    need = WITHDRAWAL_KWARGS["monthly_need"] * (1 + WITHDRAWAL_KWARGS["inflation_rate"] / 100 / 12) ** n_accumulation
+    withdrawal = utils.simulate_withdrawal(
+        log_returns[:, n_accumulation:], accumulation[:, -1], **{**WITHDRAWAL_KWARGS, "monthly_need": need}
+    )
+    for key in ["Assets", "Savings", "Total", "Need", "Used", "ruin_month"]:
+        np.testing.assert_array_equal(result[key], withdrawal[key], err_msg=key)
+
+
+def test_need_is_not_inflated_when_adjustment_is_off():
+    log_returns = _returns(60, 60, n_paths=20)
+    kwargs = {**WITHDRAWAL_KWARGS, "adjust_need_for_inflation": False}
+    result = utils.simulate_lifecycle(log_returns, 100, np.full(60, 5.0), kwargs)
+    np.testing.assert_array_equal(result["Need"][:, 0], kwargs["monthly_need"])
+
+
+def test_summary_retirement_percentiles_match_accumulated_values():
+    model = utils.fit_return_model("normal", np.random.default_rng(1).normal(0.005, 0.045, 180))
+    n_paths, n_accumulation, n_withdrawal = 1000, 60, 120
+    summary = utils.lifecycle_summary(model, n_paths, 100, np.full(n_accumulation, 5.0), WITHDRAWAL_KWARGS, n_withdrawal, seed=3)
+    # 同じリターン列（ブロックごとの乱数列）を作り直して、積立の最終資産の分布と比べる
+    stream_key = utils.returns_key(model, n_accumulation + n_withdrawal, 3, np.float64, utils.PATH_BLOCK_SIZE)
+    log_returns = np.concatenate([
+        utils.sample_returns(model, utils.PATH_BLOCK_SIZE, n_accumulation + n_withdrawal, rng)
+        for rng in utils._block_rngs(stream_key, 0, n_paths // utils.PATH_BLOCK_SIZE)
+    ])
+    final = utils.simulate_accumulation(log_returns[:, :n_accumulation], 100, np.full(n_accumulation, 5.0))[:, -1]
+    # 要約の分位点は分位点スケッチ（相対誤差 SKETCH_RELATIVE_ACCURACY）から求める
+    np.testing.assert_allclose(
+        summary["retirement_percentiles"], np.percentile(final, utils.BAND_PERCENTILES), rtol=utils.SKETCH_RELATIVE_ACCURACY
+    )
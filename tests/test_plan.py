@@ -0,0 +1,57 @@
+# 実行コストの見積もりと予算に合わせた実行方法の選択
+import numpy as np
+
+import utils
+
+
+def test_plan_within_budget_runs_in_full():
+    plan = utils.plan_run("withdrawal", 5000, 360, memory_budget_mb=1024, time_budget_s=600)
+    assert plan["mode"] == "full"
+    assert plan["chunk_size"] is None and plan["dtype"] == np.float64
+
+
+def test_plan_shrinks_blocks_before_single_precision():
+    full = utils.estimate_run("withdrawal", 5000, 360)
+    budget_mb = full["peak_bytes"] / 2**20 * 0.9
+    plan = utils.plan_run("withdrawal", 5000, 360, memory_budget_mb=budget_mb, time_budget_s=600)
+    assert plan["mode"] == "chunked"
+    assert plan["dtype"] == np.float64
+    assert utils.MIN_CHUNK_SIZE <= plan["chunk_size"] < utils.PATH_BLOCK_SIZE
+    assert plan["peak_bytes"] <= budget_mb * 2**20
+    # 1つ大きいブロックでは予算を超える（予算内で最大のブロックを選ぶ）
+    larger = utils.estimate_run("withdrawal", 5000, 360, chunk_size=plan["chunk_size"] + 1)
+    assert larger["peak_bytes"] > budget_mb * 2**20
+
+
+def test_plan_refuses_when_nothing_fits():
+    plan = utils.plan_run("withdrawal", 5000, 360, memory_budget_mb=0.5, time_budget_s=600)
+    assert plan["mode"] == "refuse" and plan["reason"]
+    plan = utils.plan_run("withdrawal", 10**9, 360, time_budget_s=1)
+    assert plan["mode"] == "refuse" and plan["reason"]
+
+
+def test_chunked_plan_runs_with_its_block_size():
+    model = utils.fit_return_model("normal", np.random.default_rng(0).normal(0.005, 0.04, 120))
+    kwargs = dict(initial_assets=4000, initial_savings=400, monthly_need=20, withdrawal_rate=4.0,
+                  min_savings_ratio=10, max_savings_ratio=30)
+    result = utils.withdrawal_summary(model, 300, 24, kwargs, seed=0, chunk_size=70)
+    assert int(result["n_sims"]) == 300
+    assert result["Total"].shape == (3, 24)
+
+
+def test_added_run_keeps_the_previous_blocks_and_precision():
+    full = utils.estimate_run("withdrawal", 5000, 360)
+    budget_mb = full["peak_bytes"] / 2**20 * 0.9
+    previous = utils.plan_run("withdrawal", 5000, 360, memory_budget_mb=budget_mb, time_budget_s=600)
+    # 既定の予算なら一括で計算できる試行回数でも、追加分は前回のブロック・dtype のまま続ける
+    plan = utils.plan_added_run("withdrawal", previous, 10000, 360, time_budget_s=600)
+    assert utils.plan_run("withdrawal", 10000, 360, time_budget_s=600)["mode"] == "full"
+    assert plan["mode"] == "chunked"
+    assert plan["chunk_size"] == previous["chunk_size"] and plan["dtype"] == previous["dtype"]
+
+
+def test_added_run_is_refused_when_the_previous_plan_no_longer_fits():
+    previous = utils.plan_run("withdrawal", 5000, 360, memory_budget_mb=1024, time_budget_s=600)
+    plan = utils.plan_added_run("withdrawal", previous, 10**9, 360, memory_budget_mb=1024, time_budget_s=1)
+    assert plan["mode"] == "refuse" and plan["reason"]
+    assert plan["chunk_size"] is None and plan["dtype"] == np.float64
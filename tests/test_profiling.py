@@ -0,0 +1,75 @@
+# 計測（Profiler）の開始・終了
+import contextvars
+import threading
+import tracemalloc
+
+import profiling
+
+
+def test_page_profiler_stops_the_run_interrupted_by_st_stop():
+    state = {}
+    first = profiling.page_profiler(state, "page")
+    with profiling.span("load"):
+        pass
+    # st.stop() で中断され、render_performance に届かなかった描画
+    second = profiling.page_profiler(state, "page")
+    assert state["_page_profiler"] is second
+    assert not first._running
+    assert [r["name"] for r in first.records()] == ["load"]
+    with profiling.span("next"):
+        pass
+    assert len(first.records()) == 1
+    assert [r["name"] for r in second.records()] == ["next"]
+    second.stop()
+
+
+def test_interrupted_run_releases_tracemalloc_on_next_page():
+    state = {"_page_profiler": profiling.Profiler("page", trace_memory=True).start()}
+    assert tracemalloc.is_tracing()
+    profiling.page_profiler(state, "page").stop()
+    assert not tracemalloc.is_tracing()
+
+
+def test_stop_is_idempotent_and_logs_once(monkeypatch):
+    logged = []
+    monkeypatch.setattr(profiling, "PERF_LOG", True)
+    monkeypatch.setattr(profiling.Profiler, "log", lambda self: logged.append(self.name))
+    profiler = profiling.page_profiler({}, "page")
+    profiler.stop()  # ページ末尾の render_performance
+    profiler.stop()
+    assert logged == ["page"]
+
+
+def test_later_profiler_owns_tracemalloc_after_earlier_one_stopped():
+    with profiling.Profiler("first", trace_memory=True):
+        pass
+    with profiling.Profiler("second", trace_memory=True) as profiler:
+        assert tracemalloc.is_tracing()
+        assert profiler._owns_tracemalloc
+    assert not tracemalloc.is_tracing()
+
+
+def test_job_thread_keeps_its_own_span_stack():
+    # ジョブのワーカーは呼び出し元のコンテキスト（同じ Profiler）で動くが、入れ子はスレッドごとに数える
+    job_started, page_done = threading.Event(), threading.Event()
+
+    def job():
+        with profiling.span("job"):
+            job_started.set()
+            page_done.wait(5)
+            with profiling.span("job_step"):
+                pass
+
+    profiler = profiling.page_profiler({}, "page")
+    with profiling.span("page"):
+        worker = threading.Thread(target=contextvars.copy_context().run, args=(job,))
+        worker.start()
+        job_started.wait(5)
+    # ジョブが実行中のまま、ページ側のステージが先に終わる（再描画など）
+    page_done.set()
+    worker.join(5)
+    profiler.stop()
+    depths = {r["name"]: r["depth"] for r in profiler.records()}
+    assert depths == {"page": 0, "job": 0, "job_step": 1}
+    threads = {r["name"]: r["thread"] for r in profiler.records()}
+    assert threads["job"] == threads["job_step"] != threads["page"]
@@ -0,0 +1,51 @@
+# リターンモデルの共通インターフェース（fit / sample / cache_key）
+import numpy as np
+import pytest
+
+import utils
+
+
+RETURNS = np.random.default_rng(0).normal(0.006, 0.045, 180)
+MODELS = [(kind, {}) for kind in utils.RETURN_MODELS] + [("uncertain", {"base": "normal", "n_draws": 8})]
+
+
+@pytest.mark.parametrize("kind, params", MODELS, ids=[kind for kind, _ in MODELS])
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_sample_shape_dtype_and_determinism(kind, params, dtype):
+    model = utils.make_return_model(kind, **params).fit(RETURNS)
+    a = model.sample(np.random.default_rng(1), 300, 24, dtype)
+    b = model.sample(np.random.default_rng(1), 300, 24, dtype)
+    assert a.shape == (300, 24) and a.dtype == dtype
+    assert np.isfinite(a).all()
+    np.testing.assert_array_equal(a, b)
+
+
+@pytest.mark.parametrize("kind, params", MODELS, ids=[kind for kind, _ in MODELS])
+def test_cache_key_identifies_the_fit(kind, params):
+    key = utils.make_return_model(kind, **params).fit(RETURNS).cache_key()
+    assert key == utils.make_return_model(kind, **params).fit(RETURNS).cache_key()
+    assert key != utils.make_return_model(kind, **params).fit(RETURNS * 1.1).cache_key()
+
+
+@pytest.mark.parametrize("kind", ["skewnorm", "normal", "bootstrap"])
+def test_sampled_mean_is_close_to_data(kind):
+    model = utils.fit_return_model(kind, RETURNS)
+    sample = model.sample(np.random.default_rng(2), 2000, 60)
+    assert abs(sample.mean() - RETURNS.mean()) < 0.002
+    assert abs(sample.std() - RETURNS.std()) < 0.005
+
+
+def test_chunked_sampling_does_not_depend_on_workers():
+    model = utils.fit_return_model("normal", RETURNS)
+    serial = utils.sample_returns(model, 1000, 12, np.random.default_rng(3), chunk_size=128)
+    threaded = utils.sample_returns(model, 1000, 12, np.random.default_rng(3), chunk_size=128, n_workers=4)
+    np.testing.assert_array_equal(serial, threaded)
+
+
+@pytest.mark.parametrize("kind", list(utils.PORTFOLIO_MODELS))
+def test_portfolio_models_sample_all_assets(kind):
+    returns = np.random.default_rng(4).multivariate_normal([0.006, 0.008, 0.004], np.diag([0.002, 0.003, 0.001]), 180)
+    model = utils.fit_return_model(kind, returns)
+    sample = model.sample(np.random.default_rng(5), 200, 36)
+    assert sample.shape == (200, 36, 3)
+    np.testing.assert_array_equal(sample, model.sample(np.random.default_rng(5), 200, 36))
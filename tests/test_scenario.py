@@ -0,0 +1,52 @@
+# シナリオ定義の既定値補完と入力チェック
+import pytest
+
+import utils
+
+
+def test_defaults_are_filled():
+    scenario = utils.resolve_scenario({"type": "withdrawal", "n_sims": 100}, {"seed": 1})
+    assert scenario["n_sims"] == 100
+    assert scenario["seed"] == 1
+    assert scenario["years"] == utils.SCENARIO_DEFAULTS["years"]
+
+
+def test_valid_options_and_weights_are_accepted():
+    utils.resolve_scenario({"options": {"option1_2": "1-2-2", "option2_2": "2-2-2"}})
+    utils.resolve_scenario({"type": "portfolio", "tickers": ["A", "B"], "weights": [60, 0]})
+    utils.resolve_scenario({"type": "lifecycle", "retirement_years": 0, "seed": 0})
+
+
+@pytest.mark.parametrize("spec", [{"tickers": ["A", "B", "C"]}, {"tickers": ["A", "B", "C"], "weights": None}])
+def test_portfolio_weights_default_to_equal(spec):
+    scenario = utils.resolve_scenario({"type": "portfolio", **spec})
+    assert scenario["weights"] == [1.0, 1.0, 1.0]
+
+
+@pytest.mark.parametrize("spec", [
+    {"type": "unknown"},
+    {"n_sims": 0},
+    {"n_sims": -5},
+    {"n_sims": 10.5},
+    {"n_sims": True},
+    {"years": 0},
+    {"years": "30"},
+    {"retirement_years": -1},
+    {"seed": "x"},
+    {"seed": 1.5},
+    {"options": ["1-1-1"]},
+    {"options": {"option1_1": "x"}},
+    {"options": {"option9": "1-1-1"}},
+    {"weights": [-1, 2]},
+    {"weights": [0, 0]},
+    {"weights": ["a", "b"]},
+    {"type": "portfolio"},
+    {"type": "portfolio", "tickers": []},
+    {"type": "portfolio", "tickers": "VOO"},
+    {"type": "portfolio", "tickers": ["VOO", None]},
+    {"type": "portfolio", "tickers": ["VOO", "QQQ"], "weights": [1, 1, 1]},
+    {"type": "portfolio", "tickers": ["VOO", "QQQ", "VT"], "weights": [1]},
+])
+def test_invalid_values_raise_value_error(spec):
+    with pytest.raises(ValueError):
+        utils.resolve_scenario(spec)
@@ -0,0 +1,95 @@
+# 取り崩しエンジン（試行方向のベクトル化・破綻した試行の詰め直し）を、試行ごとの逐次計算（withdrawal_strategy）と比べる
+import itertools
+
+import numpy as np
+import pytest
+
+import utils
+
+
+KEYS = ["Assets", "Savings", "Total", "Need", "Used"]
+PARAMS = dict(
+    initial_assets=2000, initial_savings=300, monthly_need=18, withdrawal_rate=1.2,
+    min_savings_ratio=10, max_savings_ratio=30, inflation_rate=2.0, adjust_need_for_inflation=True,
+)
+
+
+# 試行を1本ずつ月ごとに計算する（総資産が0以下になった月で打ち切り）
+def scalar_withdrawal(log_returns, initial_assets, initial_savings, monthly_need, withdrawal_rate,
+                      min_savings_ratio, max_savings_ratio, inflation_rate, adjust_need_for_inflation, **options):
+    n_paths, n_months = log_returns.shape
+    out = {k: np.full((n_paths, n_months), np.nan) for k in KEYS}
+    ruin_month = np.full(n_paths, n_months)
+    for i in range(n_paths):
+        assets, savings, need = float(initial_assets), float(initial_savings), float(monthly_need)
+        total = assets + savings
+        for m in range(n_months):
+            assets *= np.exp(log_returns[i, m])
+            withdrawal = assets * (withdrawal_rate / 100)
+            min_s = total * (min_savings_ratio / 100)
+            max_s = total * (max_savings_ratio / 100)
+            used, savings = utils.withdrawal_strategy(withdrawal, need, savings, max_s, min_s, **options)
+            assets -= used
+            total = assets + savings
+            for k, v in zip(KEYS, [assets, savings, total, need, used]):
+                out[k][i, m] = v
+            if adjust_need_for_inflation:
+                need *= (1 + inflation_rate / 100 / 12)
+            if total <= 0:
+                ruin_month[i] = m
+                break
+    return out, ruin_month
+
+
+OPTION_SETS = [
+    dict(zip(["option1_1", "option1_2", "option2_1", "option2_2"], values))
+    for values in itertools.product(*utils.WITHDRAWAL_OPTIONS.values())
+]
+
+
+@pytest.fixture(scope="module")
+def log_returns():
+    return np.random.default_rng(0).normal(0.003, 0.06, size=(200, 180))
+
+
+# 取り崩し率 1.2% ではほぼ破綻せず、4% では分岐によって多くの試行が破綻する
+@pytest.mark.parametrize("withdrawal_rate", [1.2, 4.0])
+@pytest.mark.parametrize("options", OPTION_SETS, ids=lambda o: "/".join(o.values()))
+def test_vectorized_matches_scalar_loop(log_returns, options, withdrawal_rate):
+    params = {**PARAMS, "withdrawal_rate": withdrawal_rate}
+    expected, expected_ruin = scalar_withdrawal(log_returns, **params, **options)
+    result = utils.simulate_withdrawal(log_returns, **params, **options)
+    np.testing.assert_array_equal(result["ruin_month"], expected_ruin)
+    for k in KEYS:
+        # 破綻した月までは同じ値、以降は NaN
+        np.testing.assert_allclose(result[k], expected[k], rtol=1e-12, atol=1e-9, equal_nan=True, err_msg=k)
+
+
+def test_ruined_trials_are_compacted_and_nan_after_ruin(log_returns):
+    # 取り崩し率を高くして大半の試行を破綻させ、詰め直しを何度も通す
+    params = {**PARAMS, "monthly_need": 20, "withdrawal_rate": 4.0}
+    options = {"option1_2": "1-2-2", "option2_1": "2-1-2"}
+    expected, expected_ruin = scalar_withdrawal(log_returns, **params, **options)
+    result = utils.simulate_withdrawal(log_returns, **params, **options)
+    n_months = log_returns.shape[1]
+    ruined = result["ruin_month"] < n_months
+    assert ruined.mean() > 2 * utils.WITHDRAWAL_COMPACT_FRACTION
+    np.testing.assert_array_equal(result["ruin_month"], expected_ruin)
+    months = np.arange(n_months)
+    after_ruin = months[None, :] > result["ruin_month"][:, None]
+    for k in KEYS:
+        assert np.isnan(result[k][after_ruin]).all()
+        assert not np.isnan(result[k][~after_ruin]).any()
+        np.testing.assert_allclose(result[k], expected[k], rtol=1e-12, atol=1e-9, equal_nan=True, err_msg=k)
+    # 破綻した月の総資産は0以下、それまでは正
+    rows = np.flatnonzero(ruined)
+    assert (result["Total"][rows, result["ruin_month"][rows]] <= 0).all()
+
+
+def test_per_trial_initial_assets(log_returns):
+    initial_assets = np.linspace(500, 5000, log_returns.shape[0])
+    result = utils.simulate_withdrawal(log_returns, **{**PARAMS, "initial_assets": initial_assets})
+    for i in (0, 77, 199):
+        expected, ruin = scalar_withdrawal(log_returns[i:i + 1], **{**PARAMS, "initial_assets": initial_assets[i]})
+        assert result["ruin_month"][i] == ruin[0]
+        np.testing.assert_allclose(result["Total"][i], expected["Total"][0], rtol=1e-12, atol=1e-9, equal_nan=True)
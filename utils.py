@@ -1,18 +1,36 @@
-import streamlit as st
+# 起動を速くするため、重いモジュール（streamlit / yfinance / scipy.stats / plotly）は使う関数の中で読み込む
+# （numpy と pandas はほぼすべての処理で使うので先に読み込む）。新しく import を足すときは benchmark.py の import[utils] の予算を確認する
 import numpy as np
-import yfinance as yf
-from scipy.stats import norm, skewnorm
-import plotly.graph_objects as go
 from datetime import datetime
 import pandas as pd
+import copy
+import functools
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
+
+from jobs import PROGRESS_EVERY_MONTHS, RunCancelled
+from profiling import PERF_LOG, PERF_LOGGER, PERF_PANEL, span, timed
+from shared_arrays import get_shared_returns
 
 
 # -------------------------
 # --- データ取得・統計計算関数 ---
 # -------------------------
 # 月次データ取得と対数リターン・対数株価追加
+@timed("load_monthly_data")
 def load_monthly_data(ticker, start_date, end_date):
-    df = yf.download(ticker, start=start_date, end=end_date, interval='1mo')#['Close', 'High', 'Low', 'Open', 'Volume']
+    df = _download_monthly((ticker,), start_date, end_date)
     if df.empty:
         return df
     df['Log_Return'] = np.log(df['Close']).diff()
@@ -20,6 +38,20 @@ def load_monthly_data(ticker, start_date, end_date):
     df = df.dropna()
     return df
 
+
+# 複数ティッカーの月次対数リターン（列=ティッカー、全銘柄のデータが揃う月のみ）
+@timed("load_monthly_portfolio_data")
+def load_monthly_portfolio_data(tickers, start_date, end_date):
+    df = _download_monthly(tuple(tickers), start_date, end_date)
+    if df.empty:
+        return pd.DataFrame()
+    close = df['Close']
+    if isinstance(close, pd.Series):
+        close = close.to_frame(tickers[0])
+    # 取得できなかったティッカーの列は除外
+    close = close[[t for t in tickers if t in close.columns]].dropna(axis=1, how='all').dropna()
+    return np.log(close).diff().dropna()
+
 # 月次リターンの平均・標準偏差計算
 def calculate_statistics(monthly_df):    
     monthly_mean_log = monthly_df['Log_Return'].mean()
@@ -41,12 +73,769 @@ def calculate_var_cvar(returns, alpha=0.05):
     cvar = returns[returns <= var].mean()
     return var, cvar
 
-# 対数リターンにスキュー付き正規分布を当てはめたシミュレーション（対数価格スケール）
-def monte_carlo_simulation_log(monthly_df, skew_params, n_sims=10000):
+
+# -------------------------
+# --- 市場データのキャッシュ（stale-while-revalidate） ---
+# -------------------------
+DEFAULT_TICKERS = ["VOO", "QQQ", "VT", "QLD"]
+HISTORY_START_DATE = "1990-01-01"  # キャッシュは銘柄の組ごとにこの日以降の全期間を保持し、要求期間で切り出す
+DATA_TTL_SECONDS = 6 * 3600        # これより古いキャッシュは即座に返しつつ、裏で更新する
+DOWNLOAD_TIMEOUT = 10              # 1回のダウンロードのタイムアウト（秒）
+DOWNLOAD_RETRIES = 3               # 失敗時の試行回数
+DOWNLOAD_BACKOFF = 0.5             # 再試行までの待ち時間（秒、試行ごとに倍）
+
+_DOWNLOAD_CACHE = OrderedDict()    # tickers -> (DataFrame, 取得時刻)
+_DOWNLOAD_CACHE_SIZE = 32
+_REFRESHING = {}                   # tickers -> 実行中の更新（Future）
+_CACHE_LOCK = threading.Lock()
+_DATA_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="market-data")
+_HTTP = threading.local()
+_PREFETCH_STARTED = False
+PRELOAD_MODULES = ("scipy.stats", "plotly.graph_objects", "plotly.subplots")  # 起動後に裏で読み込んでおく重いモジュール
+
+
+# fork したワーカープロセスには親のスレッドが引き継がれないので、取得用のスレッドプールと実行中の更新を作り直す
+# （親で取得を始めてからワーカーを起動すると、子は存在しないスレッドの結果を待ち続けてしまう）
+def _reset_data_executor():
+    global _CACHE_LOCK, _DATA_EXECUTOR
+    _CACHE_LOCK = threading.Lock()
+    _DATA_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="market-data")
+    _REFRESHING.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_data_executor)
+
+
+# ワーカースレッドごとにHTTPセッションを使い回す（接続プール）
+def _http_session():
+    if not hasattr(_HTTP, "session"):
+        try:
+            from curl_cffi import requests as curl_requests
+            _HTTP.session = curl_requests.Session(impersonate="chrome")
+        except ImportError:
+            _HTTP.session = None  # yfinance 既定のセッションを使う
+    return _HTTP.session
+
+
+# -------------------------
+# --- データソース（yfinance / ローカルファイル） ---
+# -------------------------
+# 環境変数で切り替え: MARKET_DATA_SOURCE=yfinance|local, MARKET_DATA_DIR=ローカルストアのディレクトリ
+MARKET_DATA_SOURCE = os.getenv("MARKET_DATA_SOURCE", "yfinance")
+MARKET_DATA_DIR = os.getenv("MARKET_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "market"))
+# 月次OHLCの列と、日次から月次への集約方法
+OHLC_AGGREGATION = {"Open": "first", "High": "max", "Low": "min", "Close": "last", "Volume": "sum"}
+
+
+# Yahoo! Finance から取得（タイムアウト・再試行・指数バックオフ付き）
+class YFinanceSource:
+    name = "yfinance"
+
+    def fetch(self, tickers):
+        """HISTORY_START_DATE 以降の月次データを yf.download と同じ列構成 (Price, Ticker) で返す。"""
+        import yfinance as yf
+        symbols = tickers[0] if len(tickers) == 1 else list(tickers)
+        for attempt in range(DOWNLOAD_RETRIES):
+            try:
+                df = yf.download(
+                    symbols, start=HISTORY_START_DATE, interval='1mo',#['Close', 'High', 'Low', 'Open', 'Volume']
+                    timeout=DOWNLOAD_TIMEOUT, session=_http_session(), progress=False
+                )
+                if not df.empty:
+                    return df
+            except Exception:
+                pass  # 通信エラーは再試行する
+            if attempt < DOWNLOAD_RETRIES - 1:
+                time.sleep(DOWNLOAD_BACKOFF * 2 ** attempt)
+        return pd.DataFrame()
+
+
+# ローカルの月次OHLCファイル（<ティッカー>.parquet または <ティッカー>.csv）から取得
+class LocalFileSource:
+    name = "local"
+
+    def __init__(self, directory=MARKET_DATA_DIR):
+        self.directory = directory
+
+    def path_for(self, ticker, fmt):
+        return os.path.join(self.directory, f"{ticker.replace('/', '_')}.{fmt}")
+
+    def read(self, ticker):
+        for fmt in ("parquet", "csv"):
+            path = self.path_for(ticker, fmt)
+            if os.path.exists(path):
+                return read_ohlc_file(path)
+        return None
+
+    def fetch(self, tickers):
+        """ネットワークを使わずに yf.download と同じ列構成 (Price, Ticker) で返す。ファイルがない銘柄は除外。"""
+        frames = {}
+        for ticker in tickers:
+            df = self.read(ticker)
+            if df is not None:
+                frames[ticker] = df
+        if not frames:
+            return pd.DataFrame()
+        df = pd.concat(frames, axis=1)  # 列: (Ticker, Price)
+        df = df.swaplevel(axis=1).sort_index(axis=1)
+        df.columns.names = ["Price", "Ticker"]
+        return df[df.index >= pd.Timestamp(HISTORY_START_DATE)]
+
+
+# 月次OHLCファイルを読み込み（Date列またはインデックスが日付、月初日付に揃える）
+def read_ohlc_file(path):
+    if path.endswith(".parquet"):
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_csv(path)
+    df = df.rename(columns=str.title)
+    if "Date" in df.columns:
+        df = df.set_index("Date")
+    df.index = pd.to_datetime(df.index)
+    return to_monthly_ohlc(df)
+
+
+# 日次・月次いずれのOHLCも月初日付の月次OHLCに変換
+def to_monthly_ohlc(df):
+    df = df.rename(columns=str.title).sort_index()
+    if df.index.tz is not None:
+        df.index = df.index.tz_localize(None)
+    agg = {k: v for k, v in OHLC_AGGREGATION.items() if k in df.columns}
+    monthly = df.resample("MS").agg(agg).dropna(subset=["Close"])
+    monthly.index.name = "Date"
+    return monthly
+
+
+# ティッカーの月次OHLCをローカルストアに保存（parquet が使えなければ csv）
+def save_ohlc(df, ticker, directory=MARKET_DATA_DIR, fmt=None):
+    os.makedirs(directory, exist_ok=True)
+    fmt = fmt or ("parquet" if parquet_available() else "csv")
+    path = LocalFileSource(directory).path_for(ticker, fmt)
+    df = to_monthly_ohlc(df)
+    if fmt == "parquet":
+        df.to_parquet(path)
+    else:
+        df.to_csv(path)
+    return path
+
+
+# ディレクトリ内の OHLC ファイル（<ティッカー>.csv / .parquet）をまとめてローカルストアに取り込む
+def import_market_data_dir(src_dir, directory=MARKET_DATA_DIR, fmt=None):
+    imported = {}
+    for name in sorted(os.listdir(src_dir)):
+        ticker, ext = os.path.splitext(name)
+        if ext not in (".csv", ".parquet"):
+            continue
+        df = read_ohlc_file(os.path.join(src_dir, name))
+        imported[ticker] = save_ohlc(df, ticker, directory, fmt)
+    return imported
+
+
+# parquet の読み書きエンジン（pyarrow / fastparquet）が使えるか
+def parquet_available():
+    for module in ("pyarrow", "fastparquet"):
+        try:
+            __import__(module)
+            return True
+        except ImportError:
+            continue
+    return False
+
+
+_DATA_SOURCE = None
+
+
+# 設定（環境変数）に応じたデータソース
+def get_data_source():
+    global _DATA_SOURCE
+    if _DATA_SOURCE is None:
+        _DATA_SOURCE = LocalFileSource() if MARKET_DATA_SOURCE == "local" else YFinanceSource()
+    return _DATA_SOURCE
+
+
+# データソースを差し替え（ベンチマーク・負荷試験用）、キャッシュも破棄する
+def set_data_source(source):
+    global _DATA_SOURCE
+    with _CACHE_LOCK:
+        _DATA_SOURCE = source
+        _DOWNLOAD_CACHE.clear()
+
+
+# ダウンロードしてキャッシュを更新（失敗時は既存のキャッシュを残す）
+def _refresh_history(tickers):
+    try:
+        df = get_data_source().fetch(tickers)
+        if not df.empty:
+            with _CACHE_LOCK:
+                _DOWNLOAD_CACHE[tickers] = (df, time.time())
+                _DOWNLOAD_CACHE.move_to_end(tickers)
+                if len(_DOWNLOAD_CACHE) > _DOWNLOAD_CACHE_SIZE:
+                    _DOWNLOAD_CACHE.popitem(last=False)
+        return df
+    finally:
+        with _CACHE_LOCK:
+            _REFRESHING.pop(tickers, None)
+
+
+# 裏で更新を開始（同じ銘柄の更新が実行中ならそれを共有する）
+def _refresh_history_async(tickers):
+    with _CACHE_LOCK:
+        future = _REFRESHING.get(tickers)
+        if future is None:
+            future = _DATA_EXECUTOR.submit(_refresh_history, tickers)
+            _REFRESHING[tickers] = future
+    return future
+
+
+# 月次データを取得（キャッシュがあれば即座に返し、古ければ裏で更新する）
+def _download_monthly(tickers, start_date, end_date):
+    tickers = tuple(tickers)
+    with _CACHE_LOCK:
+        entry = _DOWNLOAD_CACHE.get(tickers)
+        if entry is not None:
+            _DOWNLOAD_CACHE.move_to_end(tickers)
+    with span("download", tickers=",".join(tickers)) as s:
+        if entry is None:
+            # キャッシュがない場合のみ取得を待つ
+            s.set(cache="miss")
+            df = _refresh_history_async(tickers).result()
+        else:
+            df, fetched_at = entry
+            s.set(cache="hit")
+            if time.time() - fetched_at > DATA_TTL_SECONDS:
+                s.set(cache="stale")
+                _refresh_history_async(tickers)
+    if df.empty:
+        return df.copy()
+    # 要求期間で切り出す（終了日は yf.download と同じく含まない）
+    mask = df.index >= pd.Timestamp(start_date, tz=df.index.tz)
+    if end_date:
+        mask &= df.index < pd.Timestamp(end_date, tz=df.index.tz)
+    return df[mask].copy()
+
+
+# サーバー起動時に既定ティッカーのキャッシュと重いモジュールを裏で温める（プロセス内で1回だけ）
+def start_background_prefetch(tickers=DEFAULT_TICKERS):
+    global _PREFETCH_STARTED
+    with _CACHE_LOCK:
+        if _PREFETCH_STARTED:
+            return
+        _PREFETCH_STARTED = True
+    for ticker in tickers:
+        _refresh_history_async((ticker,))
+    # 最初の描画を待たせずに、分布の当てはめ・グラフで使うモジュールを読み込んでおく（yfinance は取得時に読み込まれる）
+    for module in PRELOAD_MODULES:
+        _DATA_EXECUTOR.submit(importlib.import_module, module)
+
+# -------------------------
+# --- リターンモデル ---
+# -------------------------
+# リターンモデルの選択肢（表示名）
+RETURN_MODELS = {
+    "skewnorm": "スキュー付き正規分布",
+    "normal": "正規分布",
+    "bootstrap": "ブロック・ブートストラップ（実績リターンの再標本化）",
+    "regime": "レジームスイッチング（低ボラ/高ボラの2状態）",
+}
+
+
+# リターンモデルの共通インターフェース
+class ReturnModel:
+    """
+    月次対数リターンの生成モデル。各エンジンはこのインターフェースだけを使う。
+    - fit(returns): 実績の月次対数リターンから推定し、自身を返す
+    - sample(rng, n_paths, n_months, dtype): (n_paths, n_months) の対数リターンを一括生成
+    - cache_key(): 推定結果を一意に表す文字列（結果キャッシュのキーに使う）
+    - fit_resamples(samples): 各行（再標本化した実績リターン）で推定し直したモデルのリスト（自身の推定値を初期値にする）
+    """
+    name = ""
+
+    def fit(self, returns):
+        raise NotImplementedError
+
+    def fit_resamples(self, samples):
+        return [copy.copy(self).fit(row) for row in samples]
+
+    def sample(self, rng, n_paths, n_months, dtype=np.float64):
+        raise NotImplementedError
+
+    def cache_key(self):
+        raise NotImplementedError
+
+
+# スキュー付き正規分布
+class SkewNormalModel(ReturnModel):
+    name = "skewnorm"
+
+    def __init__(self, params=None):
+        self.params = params  # (a, loc, scale)
+
+    def fit(self, returns):
+        from scipy.stats import skewnorm
+        self.params = tuple(float(p) for p in skewnorm.fit(returns))
+        return self
+
+    def fit_resamples(self, samples):
+        params = _fit_skewnorm_batch(np.asarray(samples, dtype=float), self.params)
+        return [SkewNormalModel(tuple(float(p) for p in row)) for row in params]
+
+    def sample(self, rng, n_paths, n_months, dtype=np.float64):
+        from scipy.stats import skewnorm
+        a, loc, scale = self.params
+        return skewnorm.rvs(a, loc=loc, scale=scale, size=(n_paths, n_months), random_state=rng).astype(dtype, copy=False)
+
+    def cache_key(self):
+        return "skewnorm:" + ":".join(f"{p:.12g}" for p in self.params)
+
+
+# 正規分布
+class NormalModel(ReturnModel):
+    name = "normal"
+
+    def __init__(self, mean=None, std=None):
+        self.mean = mean
+        self.std = std
+
+    def fit(self, returns):
+        returns = np.asarray(returns, dtype=float)
+        self.mean = float(returns.mean())
+        self.std = float(returns.std(ddof=1))
+        return self
+
+    def fit_resamples(self, samples):
+        samples = np.asarray(samples, dtype=float)
+        return [NormalModel(float(m), float(s)) for m, s in zip(samples.mean(axis=1), samples.std(axis=1, ddof=1))]
+
+    def sample(self, rng, n_paths, n_months, dtype=np.float64):
+        return rng.normal(self.mean, self.std, size=(n_paths, n_months)).astype(dtype, copy=False)
+
+    def cache_key(self):
+        return f"normal:{self.mean:.12g}:{self.std:.12g}"
+
+
+# 定常ブロック・ブートストラップ（実績リターンの再標本化、当てはめ不要）
+class BootstrapModel(ReturnModel):
+    name = "bootstrap"
+
+    def __init__(self, mean_block_length=12):
+        self.mean_block_length = mean_block_length
+        self.returns = None
+
+    def fit(self, returns):
+        self.returns = np.asarray(returns, dtype=float).copy()
+        return self
+
+    def sample(self, rng, n_paths, n_months, dtype=np.float64):
+        return stationary_bootstrap_returns(self.returns, n_paths, n_months, self.mean_block_length, rng).astype(dtype, copy=False)
+
+    def cache_key(self):
+        return f"bootstrap:{self.mean_block_length}:{_array_digest(self.returns)}"
+
+
+# 2状態（低ボラ/高ボラ）のマルコフ・レジームスイッチング正規モデル
+class RegimeSwitchingModel(ReturnModel):
+    name = "regime"
+
+    def __init__(self, n_iter=200):
+        self.n_iter = n_iter
+        self.mu = None          # 各状態の平均
+        self.sigma = None       # 各状態の標準偏差
+        self.transition = None  # 遷移確率行列 P[i, j] = P(j | i)
+        self.initial = None     # 初期状態の確率（定常分布）
+
+    def fit(self, returns):
+        self.mu, self.sigma, self.transition, self.initial = _fit_two_state_hmm(np.asarray(returns, dtype=float), self.n_iter)
+        return self
+
+    def fit_resamples(self, samples):
+        init = (self.mu, self.sigma, self.transition, self.initial)
+        fitted = _fit_two_state_hmm(np.asarray(samples, dtype=float), self.n_iter, init=init)
+        models = []
+        for mu, sigma, transition, initial in zip(*fitted):
+            model = RegimeSwitchingModel(self.n_iter)
+            model.mu, model.sigma, model.transition, model.initial = mu, sigma, transition, initial
+            models.append(model)
+        return models
+
+    def sample(self, rng, n_paths, n_months, dtype=np.float64):
+        # 状態の遷移だけ月方向に進め、全パスを一括で処理する（True = 高ボラ状態）
+        u = rng.random((n_paths, n_months))
+        states = np.empty((n_paths, n_months), dtype=bool)
+        states[:, 0] = u[:, 0] < self.initial[1]
+        for t in range(1, n_months):
+            prev = states[:, t-1]
+            states[:, t] = np.where(prev, u[:, t] >= self.transition[1, 0], u[:, t] < self.transition[0, 1])
+        z = rng.standard_normal((n_paths, n_months))
+        returns = np.where(states, self.mu[1] + self.sigma[1] * z, self.mu[0] + self.sigma[0] * z)
+        return returns.astype(dtype, copy=False)
+
+    def cache_key(self):
+        params = np.concatenate([self.mu, self.sigma, self.transition.ravel()])
+        return "regime:" + ":".join(f"{p:.12g}" for p in params)
+
+
+# 2状態ガウスHMMをEM法（Baum-Welch）で推定
+def _fit_two_state_hmm(x, n_iter=200, tol=1e-8, init=None):
+    """
+    x が (n_series, T) のときは全系列を同時に推定し、各戻り値の先頭に系列の軸を付けて返す。
+    init=(mu, sigma, P, pi) を渡すとその推定値から始める（収束した系列から順に計算を外す）。
+    """
+    batch = x.ndim == 2
+    x = np.atleast_2d(x)
+    D, T = x.shape
+    if init is None:
+        mu = np.repeat(x.mean(axis=1, keepdims=True), 2, axis=1)
+        sigma = x.std(axis=1, keepdims=True) * np.array([0.7, 1.5])
+        P = np.tile([[0.95, 0.05], [0.10, 0.90]], (D, 1, 1))
+        pi = np.full((D, 2), 0.5)
+    else:
+        mu, sigma, P, pi = (np.broadcast_to(v, (D,) + np.shape(v)).copy() for v in init)
+    prev_ll = np.full(D, -np.inf)
+    active = np.arange(D)  # まだ収束していない系列（収束した系列は以降の計算から外す）
+    for _ in range(n_iter):
+        # 時間を先頭の軸にして、各時点の全系列を1回の行列積で進める
+        xt, m, s, Pa = x[active].T, mu[active], sigma[active], P[active]
+        n = len(active)
+        z = (xt[:, :, None, None] - m[:, None]) / s[:, None]
+        B = np.exp(-0.5 * z ** 2) / (s[:, None] * np.sqrt(2 * np.pi))  # 正規分布の密度 (T, n, 1, 2)
+        # 前向き（スケーリング付き）
+        alpha = np.empty((T, n, 1, 2))
+        c = np.empty((T, n, 1, 1))
+        a = pi[active, None] * B[0]
+        c[0] = a.sum(axis=-1, keepdims=True)
+        np.divide(a, c[0], out=alpha[0])
+        for t in range(1, T):
+            a = np.matmul(alpha[t-1], Pa) * B[t]
+            c[t] = a.sum(axis=-1, keepdims=True)
+            np.divide(a, c[t], out=alpha[t])
+        # 後ろ向き
+        beta = np.ones((T, n, 1, 2))
+        PT = Pa.transpose(0, 2, 1)
+        for t in range(T - 2, -1, -1):
+            np.divide(np.matmul(B[t+1] * beta[t+1], PT), c[t+1], out=beta[t])
+        alpha, beta, B, c = alpha[:, :, 0], beta[:, :, 0], B[:, :, 0], c[:, :, 0, 0]
+        gamma = alpha * beta
+        gamma /= gamma.sum(axis=2, keepdims=True)
+        xi = alpha[:-1, :, :, None] * Pa * (B[1:] * beta[1:])[:, :, None, :] / c[1:, :, None, None]
+        # パラメータ更新
+        Pa = xi.sum(axis=0)
+        P[active] = Pa / Pa.sum(axis=2, keepdims=True)
+        pi[active] = gamma[0]
+        weight = gamma.sum(axis=0)
+        mu[active] = m = np.einsum("tdk,td->dk", gamma, xt) / weight
+        sigma[active] = np.maximum(np.sqrt((gamma * (xt[:, :, None] - m) ** 2).sum(axis=0) / weight), 1e-6)
+        ll = np.log(c).sum(axis=0)
+        converged = ll - prev_ll[active] < tol
+        prev_ll[active] = ll
+        active = active[~converged]
+        if len(active) == 0:
+            break
+    # 状態0を低ボラ、状態1を高ボラに揃える
+    order = np.argsort(sigma, axis=1)
+    rows = np.arange(D)[:, None]
+    mu, sigma, P = mu[rows, order], sigma[rows, order], P[rows[:, :, None], order[:, :, None], order[:, None, :]]
+    # 定常分布
+    stationary = np.stack([P[:, 1, 0], P[:, 0, 1]], axis=1) / (P[:, 0, 1] + P[:, 1, 0])[:, None]
+    if batch:
+        return mu, sigma, P, stationary
+    return mu[0], sigma[0], P[0], stationary[0]
+
+
+SKEWNORM_MAX_STEP = 2.0    # ニュートン法の1回の更新幅の上限（形状 a、loc は scale 単位、log(scale) はその 1/4）
+SKEWNORM_SADDLE_A = 1e-2   # |a| がこれより小さく止まった系列は鞍点（a=0 の正規分布）とみなして当てはめ直す
+
+
+# スキュー付き正規分布の対数尤度と、(a, loc, log(scale)) についての勾配・ヘッセ行列（全系列をまとめて計算）
+def _skewnorm_loglik(x, theta):
+    from scipy.special import log_ndtr
+    a, loc, scale = theta[:, 0, None], theta[:, 1, None], np.exp(theta[:, 2, None])
+    z = (x - loc) / scale
+    u = a * z
+    log_cdf = log_ndtr(u)
+    w = np.exp(-0.5 * u ** 2 - 0.5 * np.log(2 * np.pi) - log_cdf)  # φ(u)/Φ(u)
+    dw = -w * (u + w)
+    ll = (np.log(2 / np.sqrt(2 * np.pi)) - theta[:, 2, None] - 0.5 * z ** 2 + log_cdf).sum(axis=1)
+    grad = np.stack([
+        (w * z).sum(axis=1),
+        ((z - a * w) / scale).sum(axis=1),
+        (z ** 2 - a * w * z - 1).sum(axis=1),
+    ], axis=1)
+    h_aa = (dw * z ** 2).sum(axis=1)
+    h_al = (-(dw * u + w) / scale).sum(axis=1)
+    h_as = (-(dw * u + w) * z).sum(axis=1)
+    h_ll = (-(1 - a ** 2 * dw) / scale ** 2).sum(axis=1)
+    h_ls = (-((2 - a ** 2 * dw) * z - a * w) / scale).sum(axis=1)
+    h_ss = (-z * ((2 - a ** 2 * dw) * z - a * w)).sum(axis=1)
+    hess = np.stack([
+        np.stack([h_aa, h_al, h_as], axis=1),
+        np.stack([h_al, h_ll, h_ls], axis=1),
+        np.stack([h_as, h_ls, h_ss], axis=1),
+    ], axis=1)
+    return ll, grad, hess
+
+
+# スキュー付き正規分布を各行に最尤推定（全行を同時にニュートン法で更新し、start=(a, loc, scale) から始める）
+def _fit_skewnorm_batch(x, start, n_iter=100, tol=1e-10):
+    """
+    再標本化したデータの推定値は元データの推定値の近くにあるため、そこから始めると数回の更新で収束する。
+    鞍点や未収束で止まった行だけ scipy の skewnorm.fit で当てはめ直し、尤度の高い方を使う。戻り値は (n_rows, 3)。
+    """
+    from scipy.stats import skewnorm
+    D = len(x)
+    theta = np.tile([start[0], start[1], np.log(start[2])], (D, 1))
+    active = np.ones(D, dtype=bool)
+    with np.errstate(all="ignore"):
+        ll, grad, hess = _skewnorm_loglik(x, theta)
+        for _ in range(n_iter):
+            # ヘッセ行列の固有値を絶対値に置き換えたニュートン方向（常に尤度が増える向き）
+            vals, vecs = np.linalg.eigh(-hess)
+            vals = np.maximum(np.abs(vals), 1e-8 * np.abs(vals).max(axis=1, keepdims=True) + 1e-300)
+            step = (vecs @ ((vecs.transpose(0, 2, 1) @ grad[:, :, None])[:, :, 0] / vals)[:, :, None])[:, :, 0]
+            bound = np.stack([np.full(D, SKEWNORM_MAX_STEP), SKEWNORM_MAX_STEP * np.exp(theta[:, 2]), np.full(D, SKEWNORM_MAX_STEP / 4)], axis=1)
+            step *= np.minimum(1.0, (bound / np.abs(step)).min(axis=1))[:, None]
+            # 尤度が下がらなくなるまで半分ずつ縮める
+            t = np.ones(D)
+            for _ in range(40):
+                ll_new = _skewnorm_loglik(x, theta + t[:, None] * step)[0]
+                ok = ~active | (ll_new >= ll)
+                if ok.all():
+                    break
+                t = np.where(ok, t, t / 2)
+            candidate = theta + t[:, None] * step
+            ll_new, grad_new, hess_new = _skewnorm_loglik(x, candidate)
+            improved = active & (ll_new >= ll)
+            gain = np.where(improved, ll_new - ll, 0.0)
+            theta[improved], ll[improved] = candidate[improved], ll_new[improved]
+            grad[improved], hess[improved] = grad_new[improved], hess_new[improved]
+            active &= improved & (gain >= tol)
+            if not active.any():
+                break
+    params = np.column_stack([theta[:, :2], np.exp(theta[:, 2])])
+    for i in np.flatnonzero(active | (np.abs(params[:, 0]) < SKEWNORM_SADDLE_A) | ~np.isfinite(ll)):
+        refit = skewnorm.fit(x[i])
+        if not np.isfinite(ll[i]) or skewnorm.logpdf(x[i], *refit).sum() > ll[i]:
+            params[i] = refit
+    return params
+
+
+# -------------------------
+# --- 複数銘柄（ポートフォリオ）のリターンモデル ---
+# -------------------------
+# ポートフォリオ用リターンモデルの選択肢（表示名）
+PORTFOLIO_MODELS = {
+    "mvnormal": "多変量正規分布（共分散）",
+    "joint_bootstrap": "同時ブロック・ブートストラップ（実績リターンの再標本化）",
+}
+
+
+# 多変量正規分布：共分散行列のコレスキー分解で相関のあるリターンを生成
+class MultivariateNormalModel(ReturnModel):
+    """fit には (n_obs, n_assets)、sample は (n_paths, n_months, n_assets) を返す。"""
+    name = "mvnormal"
+
+    def __init__(self):
+        self.mean = None
+        self.cov = None
+        self.chol = None
+
+    def fit(self, returns):
+        returns = np.asarray(returns, dtype=float)
+        self.mean = returns.mean(axis=0)
+        self.cov = np.atleast_2d(np.cov(returns, rowvar=False))
+        # 数値的に半正定値になる場合に備えてわずかに対角を足す
+        self.chol = np.linalg.cholesky(self.cov + 1e-12 * np.eye(len(self.cov)))
+        return self
+
+    def sample(self, rng, n_paths, n_months, dtype=np.float64):
+        n_assets = len(self.mean)
+        z = rng.standard_normal((n_paths * n_months, n_assets))
+        returns = (z @ self.chol.T).reshape(n_paths, n_months, n_assets)
+        returns += self.mean
+        return returns.astype(dtype, copy=False)
+
+    def cache_key(self):
+        params = np.concatenate([self.mean, self.cov.ravel()])
+        return "mvnormal:" + _array_digest(params)
+
+
+# 同時ブロック・ブートストラップ：同じ月の全銘柄リターンをまとめて再標本化
+class JointBootstrapModel(BootstrapModel):
+    """fit には (n_obs, n_assets)、sample は (n_paths, n_months, n_assets) を返す。"""
+    name = "joint_bootstrap"
+
+    def cache_key(self):
+        return f"joint_bootstrap:{self.mean_block_length}:{_array_digest(self.returns)}"
+
+
+# 定常ブートストラップ（Politis & Romano）の再標本化インデックス (n_paths, n_months)
+def stationary_bootstrap_indices(n_obs, n_paths, n_months, mean_block_length=12, rng=None):
+    """
+    各月で確率 1/mean_block_length で新しいブロックを開始し、それ以外は前月の次の観測値を使う（末尾は先頭へ循環）。
+    パスごとのループは使わず、インデックス演算で全パスを一括生成する。
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    # 各月で新しいブロックを始めるか（初月は必ず開始）
+    new_block = rng.random((n_paths, n_months)) < 1.0 / mean_block_length
+    new_block[:, 0] = True
+    # ブロック開始位置の候補（乱数）と、各月が属するブロックの開始月
+    starts = rng.integers(0, n_obs, size=(n_paths, n_months))
+    t = np.arange(n_months)
+    block_start_t = np.maximum.accumulate(np.where(new_block, t, 0), axis=1)
+    # ブロック開始位置 + ブロック内の経過月数
+    return (np.take_along_axis(starts, block_start_t, axis=1) + (t - block_start_t)) % n_obs
+
+
+# 定常ブートストラップ：実績対数リターンを幾何分布の長さのブロックで再標本化
+# log_returns が (n_obs, n_assets) の場合は同じ月を全銘柄で同時に抽出する（銘柄間の相関を保つ）
+def stationary_bootstrap_returns(log_returns, n_paths, n_months, mean_block_length=12, rng=None):
+    log_returns = np.asarray(log_returns, dtype=float)
+    idx = stationary_bootstrap_indices(len(log_returns), n_paths, n_months, mean_block_length, rng)
+    return log_returns[idx]
+
+
+# 配列内容のハッシュ（キャッシュキー用）
+def _array_digest(values):
+    return hashlib.sha1(np.ascontiguousarray(values).tobytes()).hexdigest()[:16]
+
+
+# モデル名から未推定のリターンモデルを作成
+def make_return_model(kind, **params):
+    models = {
+        "skewnorm": SkewNormalModel,
+        "normal": NormalModel,
+        "bootstrap": BootstrapModel,
+        "regime": RegimeSwitchingModel,
+        "mvnormal": MultivariateNormalModel,
+        "joint_bootstrap": JointBootstrapModel,
+        "uncertain": ParameterUncertaintyModel,
+    }
+    return models[kind](**params)
+
+
+# 推定済みモデルのキャッシュ（同じデータ・同じ設定なら再推定しない）
+_FIT_CACHE = OrderedDict()
+_FIT_CACHE_SIZE = 64
+
+
+# リターンモデルを推定（推定結果はプロセス内でキャッシュし、全セッションで共有）
+def fit_return_model(kind, returns, **params):
+    returns = np.asarray(returns, dtype=float)
+    key = (kind, tuple(sorted(params.items())), returns.shape, _array_digest(returns))
+    if key in _FIT_CACHE:
+        _FIT_CACHE.move_to_end(key)
+        return _FIT_CACHE[key]
+    with span(f"fit:{kind}", n_obs=len(returns)):
+        model = make_return_model(kind, **params).fit(returns)
+    _FIT_CACHE[key] = model
+    if len(_FIT_CACHE) > _FIT_CACHE_SIZE:
+        _FIT_CACHE.popitem(last=False)
+    return model
+
+
+# -------------------------
+# --- パラメータの推定誤差を反映したリターンモデル（外側: パラメータの抽出、内側: パス） ---
+# -------------------------
+UNCERTAINTY_BASE_MODELS = ["skewnorm", "normal", "regime"]                     # 推定誤差を反映できるモデル（パラメータを推定するもの）
+UNCERTAINTY_DRAWS = int(os.getenv("UNCERTAINTY_DRAWS", "100"))                 # 再標本化して推定し直すパラメータの組数（外側）
+UNCERTAINTY_INNER_PATHS = int(os.getenv("UNCERTAINTY_INNER_PATHS", "50"))      # 1組のパラメータで続けて生成するパス数（内側）
+
+
+# パラメータの推定誤差を反映したリターンモデル
+class ParameterUncertaintyModel(ReturnModel):
+    """
+    実績リターンを定常ブートストラップで n_draws 回再標本化し、元のモデルを当てはめ直したパラメータの組を持つ。
+    当てはめ直しは全組まとめて、全データでの推定値を初期値にして行う（fit_resamples）。
+    sample はパスを inner_paths 本ずつのまとまりに分け、まとまりごとに別の組のパラメータで生成する。
+    外側の組数は推定の手間で、内側のパス数は試行回数から決まるため、試行を追加しても当てはめ直しは不要。
+    """
+    name = "uncertain"
+
+    def __init__(self, base="skewnorm", n_draws=UNCERTAINTY_DRAWS, inner_paths=UNCERTAINTY_INNER_PATHS, mean_block_length=12, seed=0):
+        if base not in UNCERTAINTY_BASE_MODELS:
+            raise ValueError(f"推定誤差を反映できないリターンモデルです: {base}")
+        self.base = base
+        self.n_draws = n_draws
+        self.inner_paths = inner_paths
+        self.mean_block_length = mean_block_length
+        self.seed = seed
+        self.draws = None  # 当てはめ直したモデルのリスト
+
+    def fit(self, returns):
+        returns = np.asarray(returns, dtype=float)
+        # 全データでの推定（キャッシュ済みならそれを使う）を、当てはめ直しの初期値にする
+        base_model = fit_return_model(self.base, returns)
+        rng = np.random.default_rng(self.seed)
+        samples = stationary_bootstrap_returns(returns, self.n_draws, len(returns), self.mean_block_length, rng)
+        with span(f"fit_resamples:{self.base}", n_draws=self.n_draws):
+            self.draws = base_model.fit_resamples(samples)
+        return self
+
+    def sample(self, rng, n_paths, n_months, dtype=np.float64):
+        n_groups = min(len(self.draws), max(1, round(n_paths / self.inner_paths)))
+        draws = rng.choice(len(self.draws), size=n_groups, replace=False)
+        bounds = np.linspace(0, n_paths, n_groups + 1).astype(int)
+        out = np.empty((n_paths, n_months), dtype=dtype)
+        for draw, start, end in zip(draws, bounds[:-1], bounds[1:]):
+            out[start:end] = self.draws[draw].sample(rng, end - start, n_months, dtype)
+        return out
+
+    def cache_key(self):
+        keys = "|".join(model.cache_key() for model in self.draws)
+        return f"uncertain:{self.inner_paths}:" + hashlib.sha1(keys.encode()).hexdigest()[:16]
+
+
+# 当てはめ直したパラメータの組ごとの年率の期待リターン・リスクの分布（各組から生成したリターンで測る）
+def uncertainty_table(model, n_paths=200, n_months=120, seed=0):
+    rng = np.random.default_rng(seed)
+    samples = (draw.sample(rng, n_paths, n_months) for draw in model.draws)
+    moments = np.array([annualize(r.mean(), r.std()) for r in samples])
+    columns = [f"{p:g}%" for p in BAND_PERCENTILES]
+    return pd.DataFrame({
+        column: [f"{v*100:.2f}%" for v in values]
+        for column, values in zip(columns, np.percentile(moments[:, [2, 1]], BAND_PERCENTILES, axis=0))
+    }, index=["期待リターン(年次)", "リスク(年次)"])
+
+
+# リターンモデルから (n_paths, n_months) の対数リターンを生成
+@timed("sample_returns")
+def sample_returns(model, n_paths, n_months, rng=None, dtype=np.float64, chunk_size=None, n_workers=1):
+    """
+    chunk_size を指定するとパス方向にチャンク分割して生成する。
+    各チャンクは rng から派生した独立な乱数列を使うため、n_workers（スレッド並列数）によらず同じ結果になる。
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    if chunk_size is None or chunk_size >= n_paths:
+        return model.sample(rng, n_paths, n_months, dtype)
+
+    chunks = _path_chunks(n_paths, chunk_size, rng)
+    out = np.empty((n_paths, n_months), dtype=dtype)
+
+    def fill(chunk):
+        start, size, child_rng = chunk
+        out[start:start + size] = model.sample(child_rng, size, n_months, dtype)
+
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(fill, chunks))
+    else:
+        for chunk in chunks:
+            fill(chunk)
+    return out
+
+
+# パス方向のチャンク分割 [(開始位置, パス数, 乱数生成器)]。各チャンクは rng から派生した独立な乱数列を使う
+def _path_chunks(n_paths, chunk_size, rng):
+    starts = list(range(0, n_paths, chunk_size))
+    return [(start, min(chunk_size, n_paths - start), child_rng) for start, child_rng in zip(starts, rng.spawn(len(starts)))]
+
+
+# リターンモデルによるシミュレーション（対数価格スケール）
+@timed("monte_carlo_simulation_log")
+def monte_carlo_simulation_log(monthly_df, model, n_sims=10000, rng=None):
     T = len(monthly_df)  # 期間（月数）
-    a, loc, scale = skew_params
     # シミュレーション（log return）
-    simulated_returns = skewnorm.rvs(a, loc=loc, scale=scale, size=(n_sims, T))
+    simulated_returns = sample_returns(model, n_sims, T, rng)
     # 累積対数リターン
     cum_log_returns = np.cumsum(simulated_returns, axis=1)
     # 初期対数株価
@@ -55,7 +844,6 @@ def monte_carlo_simulation_log(monthly_df, skew_params, n_sims=10000):
     return log_price_return
 
 
-
 def withdrawal_strategy(
     withdrawal, monthly_need, savings, max_savings, min_savings,
     option1_1="1-1-1",
@@ -126,17 +914,1770 @@ def withdrawal_strategy(
     return used, savings
 
 
+# withdrawal_strategy のベクトル化版（全試行を一括で分岐処理）
+def withdrawal_strategy_vectorized(
+    withdrawal, monthly_need, savings, max_savings, min_savings,
+    option1_1="1-1-1",
+    option1_2="1-2-1",
+    option2_1="2-1-1",
+    option2_2="2-2-1"
+):
+    """
+    withdrawal_strategy と同じ分岐を配列（試行方向）に対して np.where で一括適用する。
+    戻り値は (used, savings) の配列。
+    """
+    withdrawal = np.asarray(withdrawal, dtype=float)
+    need = np.broadcast_to(np.asarray(monthly_need, dtype=float), withdrawal.shape)
+    savings = np.asarray(savings, dtype=float)
+    excess = withdrawal - need
+
+    # 分岐条件は更新前の貯金で判定する
+    case1 = withdrawal >= need
+    case1_1 = case1 & (savings >= max_savings)
+    case1_2 = case1 & ~(savings >= max_savings)
+    case2_1 = ~case1 & (savings >= need)
+    case2_2 = ~case1 & ~(savings >= need)
+
+    used = np.zeros_like(withdrawal)
+    new_savings = savings.copy()
+
+    # case1-1
+    used = np.where(case1_1, withdrawal if option1_1 == "1-1-1" else need, used)
+
+    # case1-2
+    if option1_2 == "1-2-1":
+        used = np.where(case1_2, withdrawal, used)
+    elif option1_2 == "1-2-2":
+        # バランス型(1-2-2)
+        low = case1_2 & (savings < min_savings)
+        to_savings = np.minimum(excess, max_savings - savings)
+        new_savings = np.where(low, savings + to_savings, new_savings)
+        used = np.where(low, need + (excess - to_savings), used)
+        used = np.where(case1_2 & ~low, withdrawal, used)
+    else:
+        new_savings = np.where(case1_2 & (excess > 0), savings + excess, new_savings)
+        used = np.where(case1_2, need, used)
+
+    # case2-1
+    if option2_1 == "2-1-1":
+        used = np.where(case2_1, withdrawal, used)
+    elif option2_1 == "2-1-2":
+        new_savings = np.where(case2_1, savings - (need - withdrawal), new_savings)
+        used = np.where(case2_1, need, used)
+    else:  # 2-1-3
+        from_savings = np.minimum(need, savings)
+        new_savings = np.where(case2_1, savings - from_savings, new_savings)
+        used = np.where(case2_1, from_savings, used)
+
+    # case2-2
+    used = np.where(case2_2, withdrawal if option2_2 == "2-2-1" else 0.0, used)
+
+    return used, new_savings
+
+
+# -------------------------
+# --- シミュレーションエンジン（試行方向にベクトル化） ---
+# -------------------------
+# 積立スケジュールから月ごとの積立額の配列 (n_months,) を作成
+def build_monthly_contributions(schedule_rows, start_year, start_month, n_months):
+    """
+    schedule_rows: (開始年, 開始月, 終了年, 終了月, 毎月積立額, 年初一括額) の並び。
+    金額の単位は入力のまま（ページでは万円）。
+    """
+    monthly_contributions = np.zeros(n_months)
+    for row_start_year, row_start_month, row_end_year, _, monthly_amount, lump_sum in schedule_rows:
+        # 月次積立
+        for y in range(int(row_start_year), int(row_end_year)+1):
+            for m in range(1, 13):
+                # 月インデックス計算
+                month_idx = (y - start_year) * 12 + (m - start_month)
+                if month_idx < 0 or month_idx >= n_months:
+                    continue
+                # 月次積立
+                monthly_contributions[month_idx] += monthly_amount
+        # 年初一括
+        if lump_sum > 0:
+            first_year = int(row_start_year) if int(row_start_month) == 1 else int(row_start_year)+1
+            for y in range(first_year, int(row_end_year)+1):
+                month_idx = (y - start_year) * 12  # 1月
+                if 0 <= month_idx < n_months:
+                    monthly_contributions[month_idx] += lump_sum
+    return monthly_contributions
+
+
+# 積立シミュレーション：log_returns (n_paths, n_months) から資産推移を計算
+@timed("simulate_accumulation")
+def simulate_accumulation(log_returns, initial_investment, monthly_contributions, dtype=np.float64, control=None):
+    """
+    初月は初期投資額＋初月積立額、以降は前月資産×exp(リターン)＋当月積立額。
+    金額の単位は呼び出し側に合わせる（ページでは円）。
+    """
+    log_returns = np.asarray(log_returns)
+    n_paths, n_months = log_returns.shape
+    growth = np.exp(log_returns)
+    asset_paths = np.empty((n_paths, n_months), dtype=dtype)
+    asset_paths[:, 0] = initial_investment + monthly_contributions[0]
+    for t in range(1, n_months):
+        if control is not None and t % PROGRESS_EVERY_MONTHS == 0:
+            control.update(t, n_months)
+        asset_paths[:, t] = asset_paths[:, t-1] * growth[:, t] + monthly_contributions[t]
+    return asset_paths
+
+
+# 目標額に最初に到達した月（1始まり）、未到達は NaN
+def months_to_target(asset_paths, target):
+    hit = asset_paths >= target
+    first_hit = hit.argmax(axis=1) + 1.0
+    return np.where(hit.any(axis=1), first_hit, np.nan)
+
+
+# ポートフォリオ（複数銘柄）の積立シミュレーション：総資産 (n_paths, n_months) を返す
+@timed("simulate_portfolio")
+def simulate_portfolio(
+    model, weights, n_paths, initial_investment, monthly_contributions,
+    rebalance_months=12, rng=None, chunk_size=1000, dtype=np.float64, control=None
+):
+    """
+    model は (n_paths, n_months, n_assets) を生成するポートフォリオ用リターンモデル。
+    初期投資・積立は目標配分 weights で各銘柄に配分し、rebalance_months ヶ月ごとに目標配分へ戻す
+    （0 ならリバランスなし、1 なら毎月）。メモリを抑えるためパス方向にチャンク分割して計算する。
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    weights = np.asarray(weights, dtype=float)
+    weights = weights / weights.sum()
+    monthly_contributions = np.asarray(monthly_contributions, dtype=float)
+    n_months = len(monthly_contributions)
+
+    totals = np.empty((n_paths, n_months), dtype=dtype)
+    for start, size, child_rng in _path_chunks(n_paths, chunk_size, rng):
+        if control is not None:
+            control.update(start, n_paths)
+        log_returns = model.sample(child_rng, size, n_months, dtype)
+        totals[start:start + size] = _portfolio_paths(log_returns, weights, initial_investment, monthly_contributions, rebalance_months)
+    return totals
+
+
+# 1チャンク分のポートフォリオ資産推移（全パス・全銘柄を一括で更新）
+def _portfolio_paths(log_returns, weights, initial_investment, monthly_contributions, rebalance_months):
+    growth = np.exp(log_returns)  # (n_paths, n_months, n_assets)
+    if rebalance_months == 1:
+        # 毎月リバランスならポートフォリオ全体の月次リターンに縮約できる
+        portfolio_log_returns = np.log(growth @ weights)
+        return simulate_accumulation(portfolio_log_returns, initial_investment, monthly_contributions)
+
+    n_paths, n_months, _ = growth.shape
+    totals = np.empty((n_paths, n_months))
+    # 初月は simulate_accumulation と同じく初期投資額＋初月積立額
+    holdings = np.outer(np.full(n_paths, initial_investment + monthly_contributions[0]), weights)
+    totals[:, 0] = holdings.sum(axis=1)
+    for t in range(1, n_months):
+        holdings *= growth[:, t, :]
+        holdings += monthly_contributions[t] * weights
+        if rebalance_months and t % rebalance_months == 0:
+            holdings = holdings.sum(axis=1, keepdims=True) * weights
+        totals[:, t] = holdings.sum(axis=1)
+    return totals
+
+
+WITHDRAWAL_COMPACT_FRACTION = 0.25  # 計算中の試行のうち破綻した試行がこの割合を超えたら詰める
+
+
+# 取り崩しシミュレーション：log_returns (n_paths, n_months) から各月の状態を計算
+@timed("simulate_withdrawal")
+def simulate_withdrawal(
+    log_returns, initial_assets, initial_savings, monthly_need,
+    withdrawal_rate, min_savings_ratio, max_savings_ratio,
+    inflation_rate=0.0, adjust_need_for_inflation=True,
+    option1_1="1-1-1",
+    option1_2="1-2-1",
+    option2_1="2-1-1",
+    option2_2="2-2-1",
+    control=None
+):
+    """
+    各率は%指定（ページの入力値そのまま）。initial_assets・initial_savings は試行ごとの配列 (n_paths,) でもよい。
+    戻り値は "Assets", "Savings", "Total", "Need", "Used" をキーとする (n_paths, n_months) 配列と、
+    "ruin_month"（総資産が0以下になった月、0始まり。尽きなければ n_months）の辞書。
+    総資産が0以下になった月までを記録し、それ以降の月は NaN とする。
+    破綻した試行は計算対象（active）から外す。外すときの並べ替えを減らすため、破綻した試行が
+    WITHDRAWAL_COMPACT_FRACTION 以上たまったときにまとめて詰める（それまでは NaN で記録するだけ）。
+    """
+    log_returns = np.asarray(log_returns)
+    n_paths, n_months = log_returns.shape
+    growth = np.exp(log_returns)
+
+    active = slice(None)  # 計算中の試行（最初に詰めるまでは全試行、以降は試行の番号の配列）
+    n_active = n_paths
+    assets = np.broadcast_to(np.asarray(initial_assets, dtype=float), (n_paths,)).copy()
+    savings = np.broadcast_to(np.asarray(initial_savings, dtype=float), (n_paths,)).copy()
+    total = assets + savings
+    need = float(monthly_need)
+    alive = np.ones(n_paths, dtype=bool)
+    ruin_month = np.full(n_paths, n_months)
+
+    keys = ["Assets", "Savings", "Total", "Need", "Used"]
+    result = {k: np.full((n_paths, n_months), np.nan) for k in keys}
+    for m in range(n_months):
+        if control is not None and m % PROGRESS_EVERY_MONTHS == 0:
+            control.update(m, n_months)
+        # 破綻した試行がたまったら詰める
+        n_ruined = n_active - int(alive.sum())
+        if n_ruined and n_ruined >= WITHDRAWAL_COMPACT_FRACTION * n_active:
+            active = np.arange(n_paths)[active][alive]
+            assets, savings, total = assets[alive], savings[alive], total[alive]
+            n_active = len(active)
+            alive = np.ones(n_active, dtype=bool)
+            if n_active == 0:
+                break
+        # ランダムリターン
+        assets = assets * growth[active, m]
+        withdrawal = assets * (withdrawal_rate / 100)
+
+        min_s = total * (min_savings_ratio / 100)
+        max_s = total * (max_savings_ratio / 100)
+
+        used, savings = withdrawal_strategy_vectorized(
+            withdrawal, need, savings, max_s, min_s,
+            option1_1, option1_2, option2_1, option2_2
+        )
+
+        assets = assets - used
+        total = assets + savings
+
+        for k, v in zip(keys, [assets, savings, total, need, used]):
+            result[k][active, m] = np.where(alive, v, np.nan)
+
+        # 翌月
+        if adjust_need_for_inflation:
+            need *= (1 + inflation_rate / 100 / 12)
+        ruined = alive & ~(total > 0)
+        if ruined.any():
+            ruin_month[np.arange(n_paths)[active][ruined]] = m
+            alive &= ~ruined
+    result["ruin_month"] = ruin_month
+    return result
+
+
+# 積立から取り崩しまでを同じリターン列で続けて計算（積立の最終資産が、試行ごとにそのまま取り崩しの初期資産になる）
+@timed("simulate_lifecycle")
+def simulate_lifecycle(log_returns, initial_investment, monthly_contributions, withdrawal_kwargs, control=None):
+    """
+    log_returns は (n_paths, 積立月数 + 取り崩し月数)。withdrawal_kwargs は simulate_withdrawal の引数（initial_assets を除く）。
+    生活費 monthly_need は現在の金額で指定し、adjust_need_for_inflation なら積立期間のインフレも反映してから取り崩しを始める。
+    戻り値は simulate_withdrawal の結果に "Accumulation"（積立期間の資産 (n_paths, 積立月数)）を加えた辞書。
+    """
+    n_accumulation = len(monthly_contributions)
+    accumulation = simulate_accumulation(log_returns[:, :n_accumulation], initial_investment, monthly_contributions)
+    withdrawal_kwargs = dict(withdrawal_kwargs)
+    if withdrawal_kwargs.get("adjust_need_for_inflation", True):
+        growth = 1 + withdrawal_kwargs.get("inflation_rate", 0.0) / 100 / 12
+        withdrawal_kwargs["monthly_need"] = withdrawal_kwargs["monthly_need"] * growth ** n_accumulation
+    result = simulate_withdrawal(log_returns[:, n_accumulation:], accumulation[:, -1], control=control, **withdrawal_kwargs)
+    result["Accumulation"] = accumulation
+    return result
+
+
+# -------------------------
+# --- パスのリスク指標（パスを生成した計算の中で、ブロックごとに度数へ足し込む） ---
+# -------------------------
+RISK_WINDOW_MONTHS = 12                        # 最悪の騰落率を測る期間（月）
+RISK_METRICS = ["max_drawdown", "underwater_months", "worst_window_return"]
+DRAWDOWN_EDGES = np.linspace(0, 1, 201)        # 最大ドローダウンの度数の区切り（0.5%刻み）
+WINDOW_RETURN_EDGES = np.linspace(-1, 1, 401)  # 期間騰落率の度数の区切り（0.5%刻み、範囲外は両端に数える）
+
+
+# パスごとのリスク指標（最大ドローダウン・高値を下回っていた最長の月数・window ヶ月の最悪の騰落率）
+def path_risk_metrics(values, log=False, window=RISK_WINDOW_MONTHS):
+    """
+    values は (n_paths, n_months) の資産額（log=True なら対数株価）。戻り値は RISK_METRICS をキーとする (n_paths,) 配列の辞書。
+    高値は累積最大値（np.maximum.accumulate）、騰落率は window ヶ月前との比（対数株価なら対数リターンの区間和）で求める。
+    資産額の NaN（破綻後）と0以下は資産0として扱う。期間が window 以下なら騰落率は NaN。
+    """
+    values = np.asarray(values)
+    n_paths, n_months = values.shape
+    if log:
+        peak = np.maximum.accumulate(values, axis=1)
+        drawdown = -np.expm1(values - peak)
+        window_return = np.expm1(values[:, window:] - values[:, :-window]) if n_months > window else None
+    else:
+        values = np.fmax(values, 0)
+        peak = np.maximum.accumulate(values, axis=1)
+        ratio = np.divide(values, peak, out=np.ones_like(values), where=peak > 0)
+        drawdown = 1 - ratio
+        window_return = None
+        if n_months > window:
+            previous = values[:, :-window]
+            window_return = np.divide(values[:, window:], previous, out=np.full_like(previous, np.nan), where=previous > 0) - 1
+    # 高値を下回っている月の、直前の高値の月からの経過月数
+    months = np.arange(n_months)
+    last_peak = np.maximum.accumulate(np.where(drawdown > 0, -1, months), axis=1)
+    return {
+        "max_drawdown": drawdown.max(axis=1),
+        "underwater_months": (months - last_peak).max(axis=1),
+        "worst_window_return": np.fmin.reduce(window_return, axis=1) if window_return is not None else np.full(n_paths, np.nan),
+    }
+
+
+# リスク指標の集計状態（指標ごとの度数。ブロックの順によらず足すだけで併合できる）
+def _risk_state(n_months):
+    return {
+        "max_drawdown_counts": np.zeros(len(DRAWDOWN_EDGES) - 1, dtype=np.int64),
+        "underwater_months_counts": np.zeros(n_months, dtype=np.int64),
+        "worst_window_return_counts": np.zeros(len(WINDOW_RETURN_EDGES) - 1, dtype=np.int64),
+    }
+
+
+def _add_risk_block(state, values, log=False):
+    metrics = path_risk_metrics(values, log)
+    for name, edges in (("max_drawdown", DRAWDOWN_EDGES), ("worst_window_return", WINDOW_RETURN_EDGES)):
+        x = metrics[name][~np.isnan(metrics[name])]
+        state[f"{name}_counts"] += np.histogram(np.clip(x, edges[0], edges[-1]), edges)[0]
+    state["underwater_months_counts"] += np.bincount(metrics["underwater_months"], minlength=len(state["underwater_months_counts"]))
+    return state
+
+
+# 集計状態から、指標ごとの度数・区切り・パーセンタイル（BAND_PERCENTILES、値のない指標は NaN）
+def _risk_result(state):
+    result = {}
+    for name in RISK_METRICS:
+        counts = state[f"{name}_counts"]
+        if name == "underwater_months":
+            edges = np.arange(len(counts) + 1)
+            values = np.repeat(np.arange(len(counts)), counts)
+        else:
+            edges = DRAWDOWN_EDGES if name == "max_drawdown" else WINDOW_RETURN_EDGES
+            values = np.repeat((edges[:-1] + edges[1:]) / 2, counts)
+        result[f"{name}_counts"] = counts
+        result[f"{name}_edges"] = edges
+        result[f"{name}_percentiles"] = np.percentile(values, BAND_PERCENTILES) if len(values) else np.full(len(BAND_PERCENTILES), np.nan)
+    return result
+
+
+
+# 要約からリスク指標ごとのパーセンタイルだけを取り出す（セッションに保存する分）
+def risk_percentiles(summary):
+    return {name: summary[f"{name}_percentiles"] for name in RISK_METRICS}
+
+
+# リスク指標のパーセンタイルを表示用の表に（行: 指標、列: パーセンタイル）
+def risk_table(risk):
+    labels = {
+        "max_drawdown": "最大ドローダウン",
+        "underwater_months": "高値を下回っていた最長期間",
+        "worst_window_return": f"最悪の{RISK_WINDOW_MONTHS}ヶ月騰落率",
+    }
+    rows = {}
+    for name, label in labels.items():
+        if name == "underwater_months":
+            rows[label] = [f"{v:.0f} ヶ月" if np.isfinite(v) else "-" for v in risk[name]]
+        else:
+            rows[label] = [f"{v*100:.1f}%" if np.isfinite(v) else "-" for v in risk[name]]
+    return pd.DataFrame.from_dict(rows, orient="index", columns=[f"{q:g}%tile" for q in BAND_PERCENTILES])
+
+# -------------------------
+# --- ヒストリカル・ローリング検証 ---
+# -------------------------
+# 実績の対数リターンから、全開始月の重なり合うウィンドウ (n_windows, n_months) を作成
+def historical_return_windows(monthly_df, n_months):
+    log_returns = monthly_df['Log_Return'].values
+    if n_months <= 0 or len(log_returns) < n_months:
+        return np.empty((0, max(n_months, 0))), monthly_df.index[:0]
+    windows = sliding_window_view(log_returns, n_months)
+    start_dates = monthly_df.index[:len(windows)]
+    return windows, start_dates
+
+
+# 全開始月で積立を実行した場合の結果（目標到達率と最悪の開始月）
+@timed("backtest_accumulation")
+def backtest_accumulation(monthly_df, initial_investment, monthly_contributions, target_amount):
+    n_months = len(monthly_contributions)
+    windows, start_dates = historical_return_windows(monthly_df, n_months)
+    if len(windows) == 0:
+        return None
+    asset_paths = simulate_accumulation(windows, initial_investment, monthly_contributions)
+    final_assets = asset_paths[:, -1]
+    success = final_assets >= target_amount
+    worst = int(np.argmin(final_assets))
+    return {
+        "start_dates": start_dates,
+        "final": final_assets,
+        "success": success,
+        "success_rate": success.mean(),
+        "worst_start": start_dates[worst],
+        "worst_path": asset_paths[worst],
+    }
+
+
+# 全開始月で取り崩しを実行した場合の結果（資産が尽きなかった割合と最悪の開始月）
+@timed("backtest_withdrawal")
+def backtest_withdrawal(monthly_df, n_months, **withdrawal_kwargs):
+    windows, start_dates = historical_return_windows(monthly_df, n_months)
+    if len(windows) == 0:
+        return None
+    result = simulate_withdrawal(windows, **withdrawal_kwargs)
+    total = result["Total"]
+    # 破綻月（破綻しなければ期間末）と最終総資産
+    ruin_month = result["ruin_month"]
+    success = ruin_month == n_months
+    last_month = np.where(success, n_months - 1, ruin_month)
+    final_total = total[np.arange(len(total)), last_month]
+    # 早く破綻した順 → 最終総資産が少ない順で最悪の開始月を決める
+    worst = int(np.lexsort((final_total, ruin_month))[0])
+    return {
+        "start_dates": start_dates,
+        "final": final_total,
+        "ruin_month": ruin_month,
+        "success": success,
+        "success_rate": success.mean(),
+        "worst_start": start_dates[worst],
+        "worst_ruin_month": int(ruin_month[worst]),
+        "worst_final": final_total[worst],
+        "worst_path": total[worst],
+    }
+
+
+
+# -------------------------
+# --- シナリオ結果キャッシュ（全セッション共有） ---
+# -------------------------
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "mc_result_cache"))
+RESULT_CACHE_MAX_ITEMS = 128             # メモリに保持する結果の数（LRU）
+RESULT_CACHE_MAX_DISK_BYTES = 512 * 2**20  # ディスク（.npz）の上限、超えたら古い順に削除
+RESULT_CACHE_VERSION = 6                   # エンジンや要約の中身を変えたら上げる（古いキャッシュを無効化）
+
+
+# キャッシュキー用に入力を正規化（配列は内容のハッシュ、モデルは cache_key）
+def _canonical(value):
+    if isinstance(value, ReturnModel):
+        return value.cache_key()
+    if isinstance(value, (pd.Series, pd.Index)):
+        value = np.asarray(value)
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind == "M":
+            value = value.astype("datetime64[ns]").astype(np.int64)
+        return {"digest": _array_digest(value), "shape": list(value.shape), "dtype": str(value.dtype)}
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in sorted(value.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (datetime, pd.Timestamp)) or hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+# シナリオ（データ・モデル・エンジン設定・入力）の正規化ハッシュ
+def scenario_key(kind, **inputs):
+    payload = json.dumps({"version": RESULT_CACHE_VERSION, "kind": kind, "inputs": _canonical(inputs)}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# シナリオのキーから決まる乱数生成器（同じシナリオは常に同じ結果になる、seed を変えると別の乱数列になる）
+def scenario_rng(key):
+    return np.random.default_rng(int(key[:16], 16))
+
+
+# 集計済みの結果（配列の辞書）をメモリ（LRU）とディスク（.npz）に保持するキャッシュ
+class ResultCache:
+    def __init__(self, directory=RESULT_CACHE_DIR, max_items=RESULT_CACHE_MAX_ITEMS, max_disk_bytes=RESULT_CACHE_MAX_DISK_BYTES):
+        self.directory = directory
+        self.max_items = max_items
+        self.max_disk_bytes = max_disk_bytes
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._items[key] = result
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                result = {k: data[k] for k in data.files}
+        except (OSError, ValueError):
+            return None  # 壊れたファイルは無視して再計算する
+        self._remember(key, result)
+        return result
+
+    def put(self, key, result):
+        result = {k: np.asarray(v) for k, v in result.items()}
+        self._remember(key, result)
+        # ディスクにも書き出す（一時ファイル経由で置き換え、他プロセスと共有できる）
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = self._path(key) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **result)
+            os.replace(tmp_path, self._path(key))
+            self._prune_disk()
+        except OSError:
+            pass  # ディスクに書けなくてもメモリ上のキャッシュは使える
+        return result
+
+    def _prune_disk(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+RESULT_CACHE = ResultCache()
+
+
+# キャッシュがあれば返し、なければ compute(rng) で計算して保存
+def cached_run(kind, compute, **inputs):
+    with span(f"scenario:{kind}") as s:
+        key = scenario_key(kind, **inputs)
+        result = RESULT_CACHE.get(key)
+        s.set(cache="hit" if result is not None else "miss")
+        if result is None:
+            result = RESULT_CACHE.put(key, compute(scenario_rng(key)))
+    return result
+
+
+# -------------------------
+# --- パスを追加できる集計（ブロック単位の乱数列と併合可能な集計状態） ---
+# -------------------------
+PATH_BLOCK_SIZE = 500            # 乱数列を割り当てるパスのまとまり（追加実行もこの単位で乱数列を引き継ぐ）
+SKETCH_RELATIVE_ACCURACY = 0.005  # 分位点スケッチの相対誤差（0.5%）
+SKETCH_MIN_VALUE = 1e-4           # 絶対値がこれより小さい値は 0 として数える（万円単位でも1円）
+
+
+# 月ごとの値の分布を対数幅のバケットの度数で保持する分位点スケッチ（度数を足すだけなので、足す順序によらず同じ状態になる）
+class PathSketch:
+    gamma = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+    log_gamma = np.log(gamma)
+
+    def __init__(self, n_months):
+        self.n_months = n_months
+        self.zero = np.zeros(n_months, dtype=np.int64)
+        # 符号ごとに (先頭バケットの番号, 度数 (n_months, バケット数))
+        self.stores = {"pos": (0, np.zeros((n_months, 0), dtype=np.int32)), "neg": (0, np.zeros((n_months, 0), dtype=np.int32))}
+
+    # (n_paths, n_months) の値を追加（NaN は数えない）
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        months = np.broadcast_to(np.arange(self.n_months), values.shape)
+        magnitude = np.abs(values)
+        finite = np.isfinite(values)
+        self.zero += (finite & (magnitude < SKETCH_MIN_VALUE)).sum(axis=0)
+        large = finite & (magnitude >= SKETCH_MIN_VALUE)
+        for sign, mask in (("pos", large & (values > 0)), ("neg", large & (values < 0))):
+            if mask.any():
+                index = np.ceil(np.log(magnitude[mask]) / self.log_gamma).astype(np.int64)
+                self._add_counts(sign, months[mask], index)
+
+    def _add_counts(self, sign, months, index):
+        offset, counts = self._widen(sign, index.min(), index.max())
+        width = counts.shape[1]
+        counts += np.bincount(months * width + (index - offset), minlength=self.n_months * width).reshape(self.n_months, width).astype(np.int32)
+
+    # バケットの範囲を lo..hi を含むように広げる
+    def _widen(self, sign, lo, hi):
+        offset, counts = self.stores[sign]
+        if counts.shape[1]:
+            lo, hi = min(lo, offset), max(hi, offset + counts.shape[1] - 1)
+        if counts.shape[1] != hi - lo + 1:
+            widened = np.zeros((self.n_months, hi - lo + 1), dtype=np.int32)
+            widened[:, offset - lo:offset - lo + counts.shape[1]] = counts
+            self.stores[sign] = (lo, widened)
+        return self.stores[sign]
+
+    # 月ごとの度数（NaN を除く）
+    def counts(self):
+        return self.zero + sum(counts.sum(axis=1) for _, counts in self.stores.values())
+
+    # 月ごとのパーセンタイル (len(q), n_months)。np.percentile と同じく順位の間は線形補間、値のない月は NaN
+    def percentiles(self, q):
+        neg_offset, neg = self.stores["neg"]
+        pos_offset, pos = self.stores["pos"]
+        # 小さい値から順に（負の値は絶対値の大きい順）並べたバケットの度数と代表値
+        counts = np.concatenate([neg[:, ::-1], self.zero[:, None], pos], axis=1)
+        values = np.concatenate([-self._bucket_values(neg_offset, neg.shape[1])[::-1], [0.0], self._bucket_values(pos_offset, pos.shape[1])])
+        cumulative = np.cumsum(counts, axis=1)
+        n = cumulative[:, -1]
+        valid = n > 0
+        cumulative, n = cumulative[valid], n[valid]
+        out = np.full((len(q), self.n_months), np.nan)
+        for i, p in enumerate(q):
+            rank = p / 100 * (n - 1)
+            lower = np.floor(rank)
+            v_lower = values[(cumulative > lower[:, None]).argmax(axis=1)]
+            v_upper = values[(cumulative > np.minimum(lower + 1, n - 1)[:, None]).argmax(axis=1)]
+            out[i, valid] = v_lower + (rank - lower) * (v_upper - v_lower)
+        return out
+
+    def _bucket_values(self, offset, width):
+        return 2 * self.gamma ** np.arange(offset, offset + width, dtype=float) / (self.gamma + 1)
+
+    def to_arrays(self, name):
+        arrays = {f"{name}.zero": self.zero}
+        for sign, (offset, counts) in self.stores.items():
+            arrays[f"{name}.{sign}"] = counts
+            arrays[f"{name}.{sign}_offset"] = np.asarray(offset)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, name):
+        sketch = cls(len(arrays[f"{name}.zero"]))
+        sketch.zero = np.array(arrays[f"{name}.zero"])
+        for sign in sketch.stores:
+            sketch.stores[sign] = (int(arrays[f"{name}.{sign}_offset"]), np.array(arrays[f"{name}.{sign}"]))
+        return sketch
+
+
+# 集計状態（配列と PathSketch の辞書）を保存用の配列の辞書に変換
+def _state_arrays(state):
+    arrays = {}
+    for name, value in state.items():
+        arrays.update(value.to_arrays(name) if isinstance(value, PathSketch) else {name: np.asarray(value)})
+    return arrays
+
+
+# 保存した配列から集計状態を復元（template は空の集計状態、値はコピーする）
+def _state_from_arrays(template, arrays):
+    return {
+        name: PathSketch.from_arrays(arrays, name) if isinstance(value, PathSketch) else np.array(arrays[name])
+        for name, value in template.items()
+    }
+
+
+# パス数を除いたシナリオの乱数列のキー
+def _stream_key(kind, block_size, inputs):
+    return scenario_key(f"{kind}:stream", block_size=block_size, **inputs)
+
+
+# 乱数列のキーから、ブロック start 番目から count 個分の独立な乱数生成器（何ブロック目から作っても同じ列になる）
+def _block_rngs(stream_key, start, count):
+    seed_seq = np.random.SeedSequence(int(stream_key[:16], 16), n_children_spawned=start)
+    return [np.random.default_rng(child) for child in seed_seq.spawn(count)]
+
+
+# リターン列のキー。モデル・月数・seed・dtype・ブロックの本数が同じなら、戦略・積立額・配分が違っても同じリターン列を使う（共通乱数）
+def returns_key(model, n_months, seed, dtype, block_size):
+    return scenario_key("returns", model=model, n_months=n_months, seed=seed, dtype=np.dtype(dtype).name, block_size=block_size)
+
+
+# ブロック block のリターン。共有メモリに同じリターン列があれば、生成せずにその行を使う（コピーしない）
+def block_returns(key, block, rng, model, size, n_months, dtype):
+    shared = get_shared_returns(key)
+    if shared is not None and (block + 1) * size <= len(shared):
+        return shared[block * size:(block + 1) * size]
+    return sample_returns(model, size, n_months, rng, dtype)
+
+
+# リターン列の先頭 n_paths 本（ブロック単位に切り上げ）を1つの行列として生成（共有メモリに置いて複数の要約で使う）
+@timed("stream_returns")
+def stream_returns(key, model, n_paths, n_months, dtype, block_size):
+    blocks = [sample_returns(model, block_size, n_months, rng, dtype) for rng in _block_rngs(key, 0, -(-n_paths // block_size))]
+    return np.concatenate(blocks)
+
+
+# パスをブロックごとに生成して集計状態に足し込む（同じシナリオでパス数を増やした実行は、追加分のブロックだけを計算する）
+@timed("stream_paths")
+def stream_paths(kind, n_paths, block_size, stream, new_state, add_block, control=None):
+    """
+    ブロック i はリターン列のキー（returns_key）から派生した i 番目の乱数列で block_size 本を生成する。
+    完了したブロックまでの集計状態はシナリオ（パス数を除く）ごとに結果キャッシュへ保存し、次に同じシナリオをより多いパス数で
+    実行したときは保存済みの状態に続きのブロックだけを足す。度数は整数、和はブロック順に足すので、1回で実行した場合と同じ結果になる。
+    端数のパスは次のブロックを block_size 本生成して先頭だけ使い、保存する状態には含めない。
+    stream は {"inputs": シナリオ, "returns_key": リターン列のキー, "simulate_block": simulate_block(rng, size, block)}、
+    add_block(state, block, rows) はブロックの計算結果の先頭 rows 本を state に足す。
+    """
+    stream_key = _stream_key(kind, block_size, stream["inputs"])
+    simulate_block = stream["simulate_block"]
+    n_blocks, n_tail = divmod(n_paths, block_size)
+    template = new_state()
+    saved = RESULT_CACHE.get(stream_key)
+    if saved is not None and int(saved["n_blocks"]) <= n_blocks:
+        state = _state_from_arrays(template, saved)
+    else:
+        state = template
+    start_block = int(state["n_blocks"])
+    rngs = _block_rngs(stream["returns_key"], start_block, n_blocks - start_block + (1 if n_tail else 0))
+    n_new = len(rngs)
+
+    def save():
+        current = RESULT_CACHE.get(stream_key)
+        if current is None or int(current["n_blocks"]) < int(state["n_blocks"]):
+            RESULT_CACHE.put(stream_key, _state_arrays(state))
+
+    try:
+        for i, rng in enumerate(rngs[:n_blocks - start_block]):
+            if control is not None:
+                control.update(i, n_new)
+            add_block(state, simulate_block(rng, block_size, start_block + i), block_size)
+            state["n_blocks"] = state["n_blocks"] + 1
+    except RunCancelled:
+        save()  # 中断しても完了したブロックは次の実行で使う
+        raise
+    save()
+    if n_tail:
+        if control is not None:
+            control.update(n_new - 1, n_new)
+        state = _state_from_arrays(template, _state_arrays(state))
+        add_block(state, simulate_block(rngs[-1], block_size, n_blocks), n_tail)
+    return state
+
+
+# 和と二乗和から平均の標準誤差
+def _standard_error(total, total_sq, n):
+    if n < 2:
+        return np.nan
+    variance = max(total_sq / n - (total / n) ** 2, 0.0) * n / (n - 1)
+    return np.sqrt(variance / n)
+
+
+# -------------------------
+# --- シナリオ集計（キャッシュ付き、グラフ表示に必要な要約だけを返す） ---
+# -------------------------
+BAND_PERCENTILES = [2.5, 50, 97.5]
+
+
+# 対数株価シミュレーションのパーセンタイル帯 (3, T) と、株価パスのリスク指標の分布（_risk_result 参照）
+def price_path_bands(monthly_df, model, n_sims=5000, seed=None):
+    def compute(rng):
+        log_price_paths = monte_carlo_simulation_log(monthly_df, model, n_sims=n_sims, rng=rng)
+        with span("aggregate"):
+            risk = _risk_result(_add_risk_block(_risk_state(log_price_paths.shape[1]), log_price_paths, log=True))
+            return {"percentiles_log": np.percentile(log_price_paths, BAND_PERCENTILES, axis=0), **risk}
+    return cached_run(
+        "price_path_bands", compute,
+        close=monthly_df['Close'].values, model=model, n_sims=n_sims, seed=seed,
+    )
+
+
+# 積立シミュレーションの要約（資産のパーセンタイル帯・目標到達までの年数の分布・資産パスのリスク指標の分布）
+def accumulation_summary(model, n_sims, initial_investment, monthly_contributions, target_amount, n_bins=60, seed=None, chunk_size=None, dtype=np.float64, control=None):
+    """
+    試行は chunk_size 本（既定 PATH_BLOCK_SIZE）ずつ生成して集計状態に足すので、メモリは試行回数によらない（stream_paths 参照）。
+    同じシナリオで n_sims だけを増やすと、前回までの集計に追加分の試行だけを計算して足す。
+    control（RunControl）を渡すと計算中に進捗を通知し、中断されたら RunCancelled を送出する（結果はキャッシュしない）。
+    """
+    monthly_contributions = np.asarray(monthly_contributions, dtype=float)
+    n_months = len(monthly_contributions)
+    block_size = chunk_size or PATH_BLOCK_SIZE
+    stream = _accumulation_stream(model, initial_investment, monthly_contributions, target_amount, seed, dtype, block_size)
+
+    def compute(rng):
+        state = stream_paths(
+            "accumulation", n_sims, block_size, stream, lambda: _accumulation_state(n_months),
+            lambda state, paths, rows: _add_accumulation_block(state, paths[:rows], target_amount), control,
+        )
+        return _accumulation_result(state, n_sims, n_bins)
+    return cached_run("accumulation", compute, n_sims=n_sims, n_bins=n_bins, block_size=block_size, **stream["inputs"])
+
+
+# 積立のシナリオとブロックの計算（要約とパスの保存で同じリターン列を使う）
+def _accumulation_stream(model, initial_investment, monthly_contributions, target_amount, seed, dtype, block_size):
+    n_months = len(monthly_contributions)
+    key = returns_key(model, n_months, seed, dtype, block_size)
+
+    def simulate_block(rng, size, block):
+        log_returns = block_returns(key, block, rng, model, size, n_months, dtype)
+        return simulate_accumulation(log_returns, initial_investment, monthly_contributions)
+    inputs = dict(
+        model=model, initial_investment=initial_investment, monthly_contributions=monthly_contributions,
+        target_amount=target_amount, seed=seed, dtype=np.dtype(dtype).name,
+    )
+    return {"inputs": inputs, "returns_key": key, "simulate_block": simulate_block}
+
+
+# 積立系の集計状態（資産のスケッチ・目標到達月の度数・最終資産の和と二乗和）
+def _accumulation_state(n_months):
+    return {
+        "n_blocks": np.array(0),
+        "paths": PathSketch(n_months),
+        "hit_months": np.zeros(n_months + 1, dtype=np.int64),
+        "final_sum": np.array(0.0),
+        "final_sum_sq": np.array(0.0),
+        **_risk_state(n_months),
+    }
+
+
+def _add_accumulation_block(state, asset_paths, target_amount):
+    state["paths"].add(asset_paths)
+    _add_risk_block(state, asset_paths)
+    hit_months = months_to_target(asset_paths, target_amount)
+    state["hit_months"] += np.bincount(hit_months[~np.isnan(hit_months)].astype(np.int64), minlength=len(state["hit_months"]))
+    final = asset_paths[:, -1].astype(float)
+    state["final_sum"] = state["final_sum"] + final.sum()
+    state["final_sum_sq"] = state["final_sum_sq"] + (final ** 2).sum()
+
+
+# 集計状態から、表示用の要約を作成
+@timed("aggregate")
+def _accumulation_result(state, n_sims, n_bins):
+    hit_months = state["hit_months"]
+    years_to_target = np.repeat(np.arange(len(hit_months)) / 12, hit_months)
+    if len(years_to_target) > 0:
+        percentiles_time = np.percentile(years_to_target, BAND_PERCENTILES)
+        hist_counts, hist_edges = np.histogram(years_to_target, bins=n_bins)
+    else:
+        percentiles_time = np.full(len(BAND_PERCENTILES), np.nan)
+        hist_counts, hist_edges = np.zeros(0, dtype=int), np.zeros(0)
+    percentiles = state["paths"].percentiles(BAND_PERCENTILES)
+    hit_rate = len(years_to_target) / n_sims
+    return {
+        "percentiles": percentiles,
+        "final_percentiles": percentiles[:, -1],
+        "percentiles_time": percentiles_time,
+        "hit_rate": hit_rate,
+        "hit_rate_se": np.sqrt(hit_rate * (1 - hit_rate) / n_sims),
+        "final_mean": float(state["final_sum"]) / n_sims,
+        "final_mean_se": _standard_error(float(state["final_sum"]), float(state["final_sum_sq"]), n_sims),
+        "n_sims": n_sims,
+        "hist_counts": hist_counts,
+        "hist_edges": hist_edges,
+        **_risk_result(state),
+    }
+
+
+# ポートフォリオ積立シミュレーションの要約（試行回数の追加は accumulation_summary と同じ）
+def portfolio_summary(model, weights, n_sims, initial_investment, monthly_contributions, target_amount, rebalance_months=12, n_bins=60, seed=None, chunk_size=None, dtype=np.float64, control=None):
+    weights = np.asarray(weights, dtype=float)
+    monthly_contributions = np.asarray(monthly_contributions, dtype=float)
+    n_months = len(monthly_contributions)
+    block_size = chunk_size or PATH_BLOCK_SIZE
+    key = returns_key(model, n_months, seed, dtype, block_size)
+
+    def simulate_block(rng, size, block):
+        log_returns = block_returns(key, block, rng, model, size, n_months, dtype)
+        return _portfolio_paths(log_returns, weights / weights.sum(), initial_investment, monthly_contributions, rebalance_months)
+    inputs = dict(
+        model=model, weights=weights, initial_investment=initial_investment, monthly_contributions=monthly_contributions,
+        target_amount=target_amount, rebalance_months=rebalance_months, seed=seed, dtype=np.dtype(dtype).name,
+    )
+    stream = {"inputs": inputs, "returns_key": key, "simulate_block": simulate_block}
+
+    def compute(rng):
+        state = stream_paths(
+            "portfolio", n_sims, block_size, stream, lambda: _accumulation_state(n_months),
+            lambda state, paths, rows: _add_accumulation_block(state, paths[:rows], target_amount), control,
+        )
+        return _accumulation_result(state, n_sims, n_bins)
+    return cached_run("portfolio", compute, n_sims=n_sims, n_bins=n_bins, block_size=block_size, **inputs)
+
+
+WITHDRAWAL_KEYS = ["Assets", "Savings", "Total", "Need", "Used"]
+
+
+# 取り崩しのシナリオとブロックの計算（要約とパスの保存で同じリターン列を使う）
+def _withdrawal_stream(model, n_months, withdrawal_kwargs, seed, dtype, block_size):
+    key = returns_key(model, n_months, seed, dtype, block_size)
+
+    def simulate_block(rng, size, block):
+        return simulate_withdrawal(block_returns(key, block, rng, model, size, n_months, dtype), **withdrawal_kwargs)
+    inputs = dict(model=model, n_months=n_months, withdrawal_kwargs=withdrawal_kwargs, seed=seed, dtype=np.dtype(dtype).name)
+    return {"inputs": inputs, "returns_key": key, "simulate_block": simulate_block}
+
+
+# 取り崩しシミュレーションの要約（各項目の月別パーセンタイル帯（破綻後は除外）・生存曲線・最後まで尽きなかった試行だけの総資産の帯・成功率）
+def withdrawal_summary(model, n_trials, n_months, withdrawal_kwargs, seed=None, chunk_size=None, dtype=np.float64, control=None):
+    """
+    試行は chunk_size 本（既定 PATH_BLOCK_SIZE）ずつ計算して集計状態に足す（stream_paths 参照）。
+    同じシナリオで n_trials だけを増やすと、前回までの集計に追加分の試行だけを計算して足す。
+    control（RunControl）を渡すと計算中に進捗を通知し、中断されたら RunCancelled を送出する（結果はキャッシュしない）。
+    "survival" は各月末に総資産が残っている試行の割合 (n_months,)、"Total_survivors" は最後まで尽きなかった試行だけの
+    総資産のパーセンタイル帯（該当する試行がなければ NaN）。総資産のリスク指標の分布（_risk_result）も含め、同じ1回の計算で集計する。
+    """
+    block_size = chunk_size or PATH_BLOCK_SIZE
+    stream = _withdrawal_stream(model, n_months, withdrawal_kwargs, seed, dtype, block_size)
+
+    def new_state():
+        return {
+            "n_blocks": np.array(0),
+            "ruin_months": np.zeros(n_months + 1, dtype=np.int64),  # 破綻した月の度数（最後の要素は尽きなかった試行）
+            "Total_survivors": PathSketch(n_months),
+            **{k: PathSketch(n_months) for k in WITHDRAWAL_KEYS},
+            **_risk_state(n_months),
+        }
+
+    def add_block(state, result, rows):
+        for k in WITHDRAWAL_KEYS:
+            state[k].add(result[k][:rows])
+        ruin_month = result["ruin_month"][:rows]
+        state["ruin_months"] += np.bincount(ruin_month, minlength=n_months + 1)
+        state["Total_survivors"].add(result["Total"][:rows][ruin_month == n_months])
+        _add_risk_block(state, result["Total"][:rows])
+
+    def compute(rng):
+        state = stream_paths("withdrawal", n_trials, block_size, stream, new_state, add_block, control)
+        with span("aggregate"):
+            # 全試行が破綻した後の月は集計しない
+            n_valid = int((state["Total"].counts() > 0).sum())
+            bands = {k: state[k].percentiles(BAND_PERCENTILES)[:, :n_valid] for k in WITHDRAWAL_KEYS}
+            bands["Total_survivors"] = state["Total_survivors"].percentiles(BAND_PERCENTILES)
+        bands["survival"] = 1 - np.cumsum(state["ruin_months"][:-1]) / n_trials
+        bands.update(_risk_result(state))
+        success_rate = int(state["ruin_months"][-1]) / n_trials
+        bands["success_rate"] = success_rate
+        bands["success_rate_se"] = np.sqrt(success_rate * (1 - success_rate) / n_trials)
+        bands["n_sims"] = n_trials
+        return bands
+    return cached_run("withdrawal", compute, n_trials=n_trials, block_size=block_size, **stream["inputs"])
+
+
+LIFECYCLE_MULTIPLE_EDGES = [0, 0.5, 1, 1.5, 2, 3, 5]  # 退職時資産を元本（初期投資＋積立総額）の何倍かで区分する下限（最後は上限なし）
+
+
+# 積立から取り崩しまでを通した要約（総資産の帯・退職時資産の分布・生存曲線・退職時資産の区分ごとの成功率）
+def lifecycle_summary(model, n_trials, initial_investment, monthly_contributions, withdrawal_kwargs, withdrawal_months, seed=None, chunk_size=None, dtype=np.float64, control=None):
+    """
+    積立と取り崩しを同じリターン列で1回に計算する（simulate_lifecycle）。金額の単位は呼び出し側に合わせる（ページでは万円）。
+    試行の追加・中断・キャッシュは withdrawal_summary と同じ。
+    "percentiles" は積立期間の資産と取り崩し期間の総資産（株式＋貯金）をつないだ帯、"success_rate" は最後まで総資産が尽きない確率。
+    "success_by_retirement" は退職時資産を元本の倍率（LIFECYCLE_MULTIPLE_EDGES）で区分したときの区分ごとの成功率（該当なしは NaN）。
+    """
+    monthly_contributions = np.asarray(monthly_contributions, dtype=float)
+    n_accumulation = len(monthly_contributions)
+    n_months = n_accumulation + withdrawal_months
+    block_size = chunk_size or PATH_BLOCK_SIZE
+    key = returns_key(model, n_months, seed, dtype, block_size)
+
+    def simulate_block(rng, size, block):
+        log_returns = block_returns(key, block, rng, model, size, n_months, dtype)
+        return simulate_lifecycle(log_returns, initial_investment, monthly_contributions, withdrawal_kwargs)
+    inputs = dict(
+        model=model, initial_investment=initial_investment, monthly_contributions=monthly_contributions,
+        withdrawal_kwargs=withdrawal_kwargs, withdrawal_months=withdrawal_months, seed=seed, dtype=np.dtype(dtype).name,
+    )
+    stream = {"inputs": inputs, "returns_key": key, "simulate_block": simulate_block}
+    edges = (initial_investment + monthly_contributions.sum()) * np.asarray(LIFECYCLE_MULTIPLE_EDGES, dtype=float)
+
+    def new_state():
+        return {
+            "n_blocks": np.array(0),
+            "Total": PathSketch(n_months),
+            "Used": PathSketch(withdrawal_months),
+            "retirement": PathSketch(1),
+            "ruin_months": np.zeros(withdrawal_months + 1, dtype=np.int64),  # 破綻した月の度数（最後の要素は尽きなかった試行）
+            "retirement_counts": np.zeros(len(edges), dtype=np.int64),
+            "retirement_success": np.zeros(len(edges), dtype=np.int64),
+        }
+
+    def add_block(state, result, rows):
+        accumulation = result["Accumulation"][:rows]
+        state["Total"].add(np.concatenate([accumulation, result["Total"][:rows]], axis=1))
+        state["Used"].add(result["Used"][:rows])
+        retirement = accumulation[:, -1]
+        state["retirement"].add(retirement[:, None])
+        ruin_month = result["ruin_month"][:rows]
+        state["ruin_months"] += np.bincount(ruin_month, minlength=withdrawal_months + 1)
+        # 退職時資産の区分ごとの試行数と、そのうち最後まで尽きなかった試行数（退職時資産と成否の同時分布）
+        bins = np.clip(np.searchsorted(edges, retirement, side="right") - 1, 0, len(edges) - 1)
+        state["retirement_counts"] += np.bincount(bins, minlength=len(edges))
+        state["retirement_success"] += np.bincount(bins[ruin_month == withdrawal_months], minlength=len(edges))
+
+    def compute(rng):
+        state = stream_paths("lifecycle", n_trials, block_size, stream, new_state, add_block, control)
+        with span("aggregate"):
+            percentiles = state["Total"].percentiles(BAND_PERCENTILES)
+            used = state["Used"].percentiles(BAND_PERCENTILES)
+            retirement = state["retirement"].percentiles(BAND_PERCENTILES)[:, 0]
+        counts = state["retirement_counts"]
+        success_rate = int(state["ruin_months"][-1]) / n_trials
+        return {
+            "percentiles": percentiles,
+            "Used": used,
+            "retirement_percentiles": retirement,
+            "survival": 1 - np.cumsum(state["ruin_months"][:-1]) / n_trials,
+            "success_rate": success_rate,
+            "success_rate_se": np.sqrt(success_rate * (1 - success_rate) / n_trials),
+            "retirement_edges": edges,
+            "retirement_counts": counts,
+            "success_by_retirement": np.divide(state["retirement_success"], counts, out=np.full(len(counts), np.nan), where=counts > 0),
+            "n_accumulation_months": n_accumulation,
+            "n_sims": n_trials,
+        }
+    return cached_run("lifecycle", compute, n_trials=n_trials, block_size=block_size, **inputs)
+
+
+# -------------------------
+# --- パス行列の保存（np.memmap、個別の試行の確認・条件付きの集計用） ---
+# -------------------------
+PATH_STORE_DIR = os.getenv("PATH_STORE_DIR", os.path.join(tempfile.gettempdir(), "mc_path_store"))
+PATH_STORE_TTL_SECONDS = 24 * 3600  # 片付けられずに残ったストア（異常終了など）を削除するまでの時間
+PATH_STORE_CHUNK_ROWS = 20000       # 読み出し時に一度にメモリへ載せるパス数
+
+
+# 項目ごとの (n_paths, n_months) 行列をファイル上（np.memmap）に保持し、パスごとの要約（index）をメモリに持つ
+class PathStore:
+    """
+    読み出しは chunks() で行（パス）方向に分割して行うので、全パスをメモリに載せずに集計できる。
+    close() するか、参照がなくなる（セッション終了で session_state が破棄される）とディレクトリごと削除する。
+    """
+
+    def __init__(self, n_paths, n_months, series, dtype=np.float32, directory=PATH_STORE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        _sweep_path_stores(directory)
+        self.directory = tempfile.mkdtemp(prefix="paths_", dir=directory)
+        self.n_paths = n_paths
+        self.n_months = n_months
+        self.series = list(series)
+        self.arrays = {
+            name: np.memmap(os.path.join(self.directory, f"{name}.dat"), dtype=dtype, mode="w+", shape=(n_paths, n_months))
+            for name in self.series
+        }
+        self.index = {}  # 列名 -> (n_paths,) 配列
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, ignore_errors=True)
+
+    # start 行目からブロック（項目 -> (rows, n_months)）とパスごとの要約（列名 -> (rows,)）を書き込む
+    def write(self, start, block, index):
+        for name in self.series:
+            rows = len(block[name])
+            self.arrays[name][start:start + rows] = block[name]
+        for name, values in index.items():
+            if name not in self.index:
+                self.index[name] = np.zeros(self.n_paths, dtype=np.asarray(values).dtype)
+            self.index[name][start:start + len(values)] = values
+
+    def flush(self):
+        for array in self.arrays.values():
+            array.flush()
+
+    # (開始行, 項目 -> 行列) を順に返す。rows（真偽値の配列）を渡すと該当するパスだけ
+    def chunks(self, rows=None, chunk_rows=PATH_STORE_CHUNK_ROWS, series=None):
+        series = self.series if series is None else series
+        for start in range(0, self.n_paths, chunk_rows):
+            stop = min(start + chunk_rows, self.n_paths)
+            selected = None if rows is None else rows[start:stop]
+            if selected is not None and not selected.any():
+                continue
+            yield start, {name: np.asarray(self.arrays[name][start:stop] if selected is None else self.arrays[name][start:stop][selected]) for name in series}
+
+    # predicate(項目 -> 行列) が真になるパス（真偽値の配列）。例: 10年目に目標未達のパス
+    def where(self, predicate, series=None):
+        mask = np.zeros(self.n_paths, dtype=bool)
+        for start, chunk in self.chunks(series=series):
+            mask[start:start + len(next(iter(chunk.values())))] = predicate(chunk)
+        return mask
+
+    # 項目の月別パーセンタイル帯（rows で条件を付けられる、分位点スケッチで集計）
+    def bands(self, name, q=BAND_PERCENTILES, rows=None):
+        sketch = PathSketch(self.n_months)
+        for _, chunk in self.chunks(rows, series=[name]):
+            sketch.add(chunk[name])
+        return sketch.percentiles(q)
+
+    # 指定したパスの推移 (len(ids), n_months)
+    def paths(self, name, ids):
+        return np.asarray(self.arrays[name][np.sort(np.atleast_1d(ids))])
+
+    # メモリ上に持っているバイト数（推移はファイルに置くので、パスごとの要約だけ）
+    def memory_bytes(self):
+        return sum(values.nbytes for values in self.index.values())
+
+    def close(self):
+        self.arrays = {}
+        self._finalizer()
+
+
+# 残ったままの古いストアを削除
+def _sweep_path_stores(directory):
+    now = time.time()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if name.startswith("paths_") and now - os.path.getmtime(path) > PATH_STORE_TTL_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+# 要約と同じ乱数列でパスを生成して PathStore に書き出す（summarize(ブロック) はパスごとの要約の辞書）
+def _fill_path_store(store, block_size, stream, summarize, control=None):
+    n_blocks = -(-store.n_paths // block_size)
+    try:
+        for i, rng in enumerate(_block_rngs(stream["returns_key"], 0, n_blocks)):
+            if control is not None:
+                control.update(i, n_blocks)
+            start = i * block_size
+            rows = min(block_size, store.n_paths - start)
+            block = stream["simulate_block"](rng, block_size, i)
+            block = {k: v[:rows] for k, v in block.items()} if isinstance(block, dict) else {store.series[0]: block[:rows]}
+            store.write(start, block, summarize(block))
+    except BaseException:
+        store.close()
+        raise
+    store.flush()
+    return store
+
+
+# 積立シミュレーションの全パスを保存（accumulation_summary と同じ入力なら同じパス）
+@timed("accumulation_path_store")
+def accumulation_path_store(model, n_sims, initial_investment, monthly_contributions, target_amount, seed=None, chunk_size=None, dtype=np.float64, control=None):
+    monthly_contributions = np.asarray(monthly_contributions, dtype=float)
+    block_size = chunk_size or PATH_BLOCK_SIZE
+    stream = _accumulation_stream(model, initial_investment, monthly_contributions, target_amount, seed, dtype, block_size)
+
+    def summarize(block):
+        hit_month = months_to_target(block["Total"], target_amount)
+        return {"hit_month": np.nan_to_num(hit_month, nan=-1).astype(np.int32), "final": block["Total"][:, -1].astype(float)}
+    store = PathStore(n_sims, len(monthly_contributions), ["Total"])
+    return _fill_path_store(store, block_size, stream, summarize, control)
+
+
+# 取り崩しシミュレーションの全パスを保存（withdrawal_summary と同じ入力なら同じパス）
+@timed("withdrawal_path_store")
+def withdrawal_path_store(model, n_trials, n_months, withdrawal_kwargs, seed=None, chunk_size=None, dtype=np.float64, control=None):
+    block_size = chunk_size or PATH_BLOCK_SIZE
+    stream = _withdrawal_stream(model, n_months, withdrawal_kwargs, seed, dtype, block_size)
+
+    def summarize(block):
+        total = np.nan_to_num(block["Total"], nan=0.0)
+        return {
+            "ruin_month": np.where(block["ruin_month"] < n_months, block["ruin_month"], -1).astype(np.int32),  # 0始まり、尽きなければ -1
+            "final": total[:, -1],
+            "min_total": total.min(axis=1),
+        }
+    store = PathStore(n_trials, n_months, WITHDRAWAL_KEYS)
+    return _fill_path_store(store, block_size, stream, summarize, control)
+
+
+# -------------------------
+# --- セッションごとの結果の保存（メモリ予算つき） ---
+# -------------------------
+SESSION_RESULTS_BUDGET = int(os.getenv("SESSION_RESULTS_BUDGET", str(4 * 2**20)))  # 1セッションが保存する結果の上限（バイト）
+_SESSION_RESULTS = weakref.WeakSet()  # 生きている全セッションの保存先（サーバー全体の使用量の集計用）
+
+
+# 結果を保存用に小さくする（float64 の配列は単精度、整数の配列は値が収まる最小の型に。辞書は中身ごと）
+def compact_result(value):
+    if isinstance(value, dict):
+        return {k: compact_result(v) for k, v in value.items()}
+    if isinstance(value, np.ndarray) and not isinstance(value, np.memmap) and value.size:
+        if value.dtype == np.float64:
+            return value.astype(np.float32)
+        if value.dtype.kind in "iu":
+            return value.astype(np.result_type(np.min_scalar_type(value.min()), np.min_scalar_type(value.max())))
+    return value
+
+
+# 結果がメモリ上で使うおおよそのバイト数
+def result_nbytes(value):
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(result_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(result_nbytes(v) for v in value)
+    if isinstance(value, np.ndarray):
+        return 0 if isinstance(value, np.memmap) else value.nbytes
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if hasattr(value, "memory_bytes"):
+        return value.memory_bytes()
+    return sys.getsizeof(value)
+
+
+# セッションの結果の保存先（st.session_state に1つ置く）
+class SessionResults:
+    """
+    put() で保存するときに compact_result で小さくし、合計が budget を超えたら最も長く使われていない結果から捨てる
+    （close() を持つもの（PathStore など）は閉じる）。グラフは保存せず、表示のたびに保存した配列から作り直す。
+    """
+
+    def __init__(self, budget=None):
+        self.budget = SESSION_RESULTS_BUDGET if budget is None else budget
+        self.evicted = []  # 予算のために捨てた結果の名前
+        self._entries = OrderedDict()  # 名前 -> [値, バイト数]
+        self._lock = threading.Lock()
+        _SESSION_RESULTS.add(self)
+
+    def put(self, name, value, compact=True):
+        if compact:
+            value = compact_result(value)
+        entry = [value, result_nbytes(value)]
+        with self._lock:
+            replaced = self._entries.pop(name, None)
+            self._entries[name] = entry
+            evicted = []
+            while self.nbytes > self.budget and len(self._entries) > 1:
+                evicted.append(self._entries.popitem(last=False))
+            self.evicted = [n for n in self.evicted if n != name] + [n for n, _ in evicted]
+        if replaced is not None and replaced[0] is not value:
+            _close_result(replaced[0])
+        for _, (old, _) in evicted:
+            _close_result(old)
+        if PERF_LOG:
+            PERF_LOGGER.info(json.dumps({
+                "event": "session_results", "put": name, "bytes": self.nbytes, "budget": self.budget,
+                "evicted": [n for n, _ in evicted], "all_sessions_bytes": session_results_bytes(),
+            }, ensure_ascii=False))
+        return value
+
+    def get(self, name, default=None):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return default
+            self._entries.move_to_end(name)
+            return entry[0]
+
+    # name の結果が同じ入力（"input_key"）から計算されたものか（「試行を追加」できるか）
+    def matches_input(self, name, input_key):
+        with self._lock:
+            entry = self._entries.get(name)
+        return entry is not None and isinstance(entry[0], dict) and entry[0].get("input_key") == input_key
+
+    # 結果を捨てる（close() を持つものは閉じる）
+    def discard(self, name):
+        with self._lock:
+            entry = self._entries.pop(name, None)
+        if entry is not None:
+            _close_result(entry[0])
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    @property
+    def nbytes(self):
+        return sum(nbytes for _, nbytes in self._entries.values())
+
+    # 名前 -> バイト数（古い順）
+    def usage(self):
+        with self._lock:
+            return {name: nbytes for name, (_, nbytes) in self._entries.items()}
+
+
+def _close_result(value):
+    if hasattr(value, "close"):
+        value.close()
+
+
+# セッションの結果の保存先（なければ作る）
+def session_results(state):
+    if "_session_results" not in state:
+        state["_session_results"] = SessionResults()
+    return state["_session_results"]
+
+
+# 生きている全セッションが保存している結果の合計バイト数
+def session_results_bytes():
+    return sum(results.nbytes for results in list(_SESSION_RESULTS))
+
+
+# -------------------------
+# --- ページのパフォーマンス欄（profiling の計測結果の表示） ---
+# -------------------------
+# ページの「パフォーマンス」欄を表示するか
+def performance_panel_enabled():
+    import streamlit as st
+    return PERF_PANEL or st.query_params.get("perf") == "1"
+
+
+# 計測を終了し、有効ならページ末尾にステージごとの処理時間を表示
+def render_performance(profiler):
+    profiler.stop()
+    if not performance_panel_enabled():
+        return
+    import streamlit as st
+    with st.expander("パフォーマンス（ステージごとの処理時間）"):
+        table = profiler.table()
+        top = table[~table["name"].str.startswith(" ")]
+        st.caption(f"計測したステージ: {len(table)} / 最上位ステージの合計: {top['wall_ms'].sum():,.0f} ms")
+        results = session_results(st.session_state)
+        st.caption(
+            f"このセッションが保存している結果: {results.nbytes / 2**20:,.2f} MB / 予算 {results.budget / 2**20:,.0f} MB"
+            f"（{', '.join(f'{k} {v / 2**10:,.0f} KB' for k, v in results.usage().items()) or 'なし'}）、"
+            f"全セッションの合計: {session_results_bytes() / 2**20:,.1f} MB"
+        )
+        st.dataframe(table, use_container_width=True, hide_index=True)
+        st.download_button(
+            "Chrome トレース（JSON）をダウンロード",
+            json.dumps(profiler.chrome_trace(), ensure_ascii=False, default=str),
+            file_name=f"trace_{datetime.now():%Y%m%d_%H%M%S}.json",
+            mime="application/json",
+        )
+
+
+# -------------------------
+# --- 実行コストの見積もりと予算 ---
+# -------------------------
+# エンジンごとのコスト係数（パス×月 1つあたりの秒数・float64 の1ブロックの作業領域のバイト数、
+# 月あたりの集計状態（分位点スケッチ）のバイト数）。benchmark.py --calibrate の結果（COST_MODEL_PATH）があればそちらを使う
+DEFAULT_COST_MODEL = {
+    "accumulation": {"overhead_s": 0.0, "s_per_pm": 1.0e-7, "bytes_per_pm": 48.0, "state_bytes_per_month": 1.2e4},
+    "withdrawal": {"overhead_s": 0.01, "s_per_pm": 3.6e-7, "bytes_per_pm": 75.0, "state_bytes_per_month": 3.2e4},
+    "portfolio": {"overhead_s": 0.0, "s_per_pm": 6.5e-8, "bytes_per_pm": 24.0, "state_bytes_per_month": 8e3},  # 月数×銘柄数で数える
+    "lifecycle": {"overhead_s": 0.01, "s_per_pm": 1.7e-7, "bytes_per_pm": 75.0, "state_bytes_per_month": 6e3},  # 積立＋取り崩しの月数で数える
+}
+COST_MODEL_PATH = os.getenv("COST_MODEL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cost_model.json"))
+SESSION_MEMORY_BUDGET_MB = float(os.getenv("SESSION_MEMORY_BUDGET_MB", "512"))  # 1回の実行で使ってよいメモリ
+SESSION_TIME_BUDGET_S = float(os.getenv("SESSION_TIME_BUDGET_S", "60"))         # 1回の実行で待ってよい時間
+MIN_CHUNK_SIZE = int(os.getenv("MIN_CHUNK_SIZE", "50"))                         # 予算に合わせてブロックを小さくするときの下限（試行数）
+
+
+# コスト係数を読み込む（校正ファイルがなければ既定値）
+def load_cost_model(path=COST_MODEL_PATH):
+    model = {k: dict(v) for k, v in DEFAULT_COST_MODEL.items()}
+    try:
+        with open(path, encoding="utf-8") as f:
+            for engine, coef in json.load(f).items():
+                model.setdefault(engine, {}).update(coef)
+    except (OSError, ValueError):
+        pass
+    return model
+
+
+COST_MODEL = load_cost_model()
+
+
+# 実行時間（秒）とピークメモリ（バイト）の見積もり
+def estimate_run(engine, n_paths, n_months, dtype=np.float64, chunk_size=None, n_assets=1):
+    coef = COST_MODEL[engine]
+    itemsize = np.dtype(dtype).itemsize
+    width = n_months * (n_assets if engine == "portfolio" else 1)
+    # 試行はブロック単位（端数も1ブロック分）で計算するので、作業領域は1ブロック分（dtype に比例）と月数に比例する集計状態だけ
+    rows = chunk_size or PATH_BLOCK_SIZE
+    seconds = coef["overhead_s"] + coef["s_per_pm"] * -(-n_paths // rows) * rows * width
+    peak = coef["bytes_per_pm"] * itemsize / 8 * rows * width + coef["state_bytes_per_month"] * n_months
+    return {"seconds": seconds, "peak_bytes": peak}
+
+
+# メモリ予算に収まる最大のブロック（PATH_BLOCK_SIZE 以下、MIN_CHUNK_SIZE 未満になるなら None）
+def _chunk_size_for_budget(engine, n_months, dtype, n_assets, memory_budget):
+    one = estimate_run(engine, 1, n_months, dtype, 1, n_assets)["peak_bytes"]
+    two = estimate_run(engine, 2, n_months, dtype, 2, n_assets)["peak_bytes"]
+    per_row, fixed = two - one, 2 * one - two
+    rows = int((memory_budget - fixed) // per_row) if per_row > 0 else PATH_BLOCK_SIZE
+    return min(rows, PATH_BLOCK_SIZE) if rows >= MIN_CHUNK_SIZE else None
+
+
+# 予算内に収まる実行方法を選ぶ（float64 → ブロックを小さくする → float32（＋小さいブロック） → 実行しない）
+# ブロックを小さくすると試行の乱数列の割り当てが変わるので、結果は既定のブロックでの実行とは別のキャッシュになる
+def plan_run(engine, n_paths, n_months, n_assets=1, memory_budget_mb=None, time_budget_s=None):
+    memory_budget = (SESSION_MEMORY_BUDGET_MB if memory_budget_mb is None else memory_budget_mb) * 2**20
+    time_budget = SESSION_TIME_BUDGET_S if time_budget_s is None else time_budget_s
+    for mode, dtype in [("full", np.float64), ("float32", np.float32)]:
+        chunk_size = None
+        estimate = estimate_run(engine, n_paths, n_months, dtype, None, n_assets)
+        if estimate["peak_bytes"] <= memory_budget:
+            break
+        chunk_size = _chunk_size_for_budget(engine, n_months, dtype, n_assets, memory_budget)
+        if chunk_size is not None:
+            mode = "chunked" if mode == "full" else mode
+            estimate = estimate_run(engine, n_paths, n_months, dtype, chunk_size, n_assets)
+            break
+    return _check_budget({"mode": mode, "chunk_size": chunk_size, "dtype": dtype, **estimate, "reason": ""}, memory_budget, time_budget)
+
+
+# 「試行を追加」の見積もり。前回と同じブロック・dtype でないと保存済みの集計に続けられない（乱数列が変わる）ので、
+# 前回の計画のまま予算に収まるかだけを確かめる（収まらなければ "refuse"）
+def plan_added_run(engine, previous_plan, n_paths, n_months, n_assets=1, memory_budget_mb=None, time_budget_s=None):
+    memory_budget = (SESSION_MEMORY_BUDGET_MB if memory_budget_mb is None else memory_budget_mb) * 2**20
+    time_budget = SESSION_TIME_BUDGET_S if time_budget_s is None else time_budget_s
+    chunk_size, dtype = previous_plan["chunk_size"], previous_plan["dtype"]
+    estimate = estimate_run(engine, n_paths, n_months, dtype, chunk_size, n_assets)
+    return _check_budget({"mode": previous_plan["mode"], "chunk_size": chunk_size, "dtype": dtype, **estimate, "reason": ""},
+                         memory_budget, time_budget)
+
+
+def _check_budget(plan, memory_budget, time_budget):
+    if plan["peak_bytes"] > memory_budget:
+        plan["mode"] = "refuse"
+        plan["reason"] = f"必要メモリ約 {plan['peak_bytes']/2**20:,.0f}MB が上限 {memory_budget/2**20:,.0f}MB を超えます"
+    elif plan["seconds"] > time_budget:
+        plan["mode"] = "refuse"
+        plan["reason"] = f"見込み時間 約 {plan['seconds']:,.0f} 秒が上限 {time_budget:,.0f} 秒を超えます"
+    return plan
+
+
+# 実行前に表示する見積もりの説明
+def describe_plan(plan):
+    text = f"見込み: 約 {plan['seconds']:.1f} 秒 / メモリ 約 {plan['peak_bytes']/2**20:,.0f} MB"
+    if plan["mode"] == "chunked":
+        text += f"（メモリ節約のため {plan['chunk_size']:,} 試行ずつ計算します）"
+    elif plan["mode"] == "float32":
+        text += "（メモリ節約のため単精度"
+        text += f"・{plan['chunk_size']:,} 試行ずつで計算します）" if plan["chunk_size"] else "で計算します）"
+    elif plan["mode"] == "refuse":
+        text += f"。{plan['reason']}。期間か試行回数を減らしてください"
+    return text
+
+
+# -------------------------
+# --- グラフ（ブラウザに送るデータを軽くする） ---
+# -------------------------
+CHART_MAX_POINTS = int(os.getenv("CHART_MAX_POINTS", "150"))       # 1系列あたりの最大点数（0 なら間引かない）
+CHART_WEBGL_POINTS = int(os.getenv("CHART_WEBGL_POINTS", "1000"))  # これより点数の多い系列は WebGL（scattergl）で描く
+# 軽いテンプレートに残す項目（2次元のグラフで使うものだけ。カラースケールや地図・3D 用の既定値は送らない）
+CHART_TEMPLATE_LAYOUT_KEYS = ("annotationdefaults", "autotypenumbers", "colorway", "font", "hoverlabel", "hovermode",
+                              "paper_bgcolor", "plot_bgcolor", "shapedefaults", "title", "xaxis", "yaxis")
+CHART_TEMPLATE_TRACE_TYPES = ("scatter", "scattergl", "histogram", "bar")
+_CHART_LAYOUTS = OrderedDict()  # キー -> 作成済みのレイアウト（go.Layout）
+_CHART_LAYOUTS_SIZE = 32
+_CHART_LOCK = threading.Lock()
+
+
+# 使う項目だけを残したテンプレート（名前を省略すると現在の既定テンプレート）
+def chart_template(name=None):
+    import plotly.io as pio
+    return _chart_template(name or pio.templates.default)
+
+
+@functools.lru_cache(maxsize=None)
+def _chart_template(name):
+    import plotly.io as pio
+    template = pio.templates[name].to_plotly_json()
+    return {
+        "layout": {k: v for k, v in template.get("layout", {}).items() if k in CHART_TEMPLATE_LAYOUT_KEYS},
+        "data": {k: v for k, v in template.get("data", {}).items() if k in CHART_TEMPLATE_TRACE_TYPES},
+    }
+
+
+# テンプレートを軽いものにした空の図（update_layout(template=...) は既定のテンプレートに足し込むだけなので、作成時に指定する）
+def chart_figure(template=None):
+    import plotly.graph_objects as go
+    return go.Figure(layout={"template": chart_template(template)})
+
+
+# 系列を max_points 点以下に間引く位置（区間ごとの最小・最大と先頭・末尾を残すので、山と谷は消えない）。間引かない場合は None
+# y が2次元 (系列数, 点数) なら、各系列の最小・最大を合わせた共通の位置（合計で max_points 点以下）を返す
+def decimation_index(y, max_points):
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    n = y.shape[1]
+    if not max_points or n <= max_points:
+        return None
+    edges = np.linspace(1, n - 1, max(1, (max_points - 2) // (2 * len(y))) + 1).astype(int)
+    index = [0, n - 1]
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        for row in y:
+            segment = row[lo:hi]
+            if hi > lo and not np.isnan(segment).all():
+                index += [lo + int(np.nanargmin(segment)), lo + int(np.nanargmax(segment))]
+    return np.unique(index)
+
+
+# x 軸の値を送る形に（等間隔なら x0/dx だけ、日付は文字列を短く）
+def _chart_x(x, index):
+    if x is None:
+        return {} if index is None else {"x": index}
+    if isinstance(x, pd.DatetimeIndex) or np.asarray(x).dtype.kind == "M":
+        dates = pd.DatetimeIndex(x)
+        if index is not None:
+            dates = dates[index]
+        month_start = (dates.day == 1).all() and (dates == dates.normalize()).all()
+        return {"x": list(dates.strftime("%Y-%m" if month_start else "%Y-%m-%d"))}
+    x = np.asarray(x)
+    if index is not None:
+        return {"x": x[index].astype(np.float32) if x.dtype.kind == "f" else x[index]}
+    step = np.diff(x)
+    if len(x) > 1 and x.dtype.kind in "iuf" and np.allclose(step, step[0], rtol=1e-9, atol=0):
+        return {"x0": x[0].item(), "dx": step[0].item()}
+    return {"x": x}
+
+
+# 折れ線の trace（dict、go.Figure.add_trace にそのまま渡せる）。長い系列は間引き、値は単精度で送る
+def line_trace(x, y, max_points=None, index=None, **kwargs):
+    """
+    max_points を超える系列は decimation_index で間引く（None なら CHART_MAX_POINTS、0 なら間引かない）。
+    実測値など1点ずつに意味のある系列は max_points=0 で間引かずに送る。
+    fill="tonexty" で塗る帯の上下など同じ位置で描くべき系列は、band_index で求めた共通の index を渡す。
+    間引いた後も CHART_WEBGL_POINTS 点を超える系列は scattergl にする（同じ図で fill="tonexty" を使う系列同士は同じ種類になるよう、点数を揃えること）。
+    """
+    y = np.asarray(y, dtype=float)
+    if index is None:
+        index = decimation_index(y, CHART_MAX_POINTS if max_points is None else max_points)
+    if index is not None:
+        y = y[index]
+    trace_type = "scattergl" if len(y) > CHART_WEBGL_POINTS else "scatter"
+    return {"type": trace_type, "mode": "lines", **_chart_x(x, index), "y": y.astype(np.float32), **kwargs}
+
+
+# パーセンタイル帯など x を共有する系列 (系列数, 点数) に共通の間引き位置（line_trace の index に渡す、間引かない場合は None）
+def band_index(bands, max_points=None):
+    return decimation_index(bands, CHART_MAX_POINTS if max_points is None else max_points)
+
+
+# レイアウト（軸・注釈）を key ごとに1回だけ作って使い回し、trace だけ差し替えた図を返す
+def cached_figure(key, build_layout, traces, template=None):
+    """build_layout() は go.Layout か dict を返す。テンプレートは chart_template(template) に置き換える。"""
+    import plotly.graph_objects as go
+    with _CHART_LOCK:
+        layout = _CHART_LAYOUTS.get(key)
+        if layout is not None:
+            _CHART_LAYOUTS.move_to_end(key)
+    if layout is None:
+        with span("chart_layout"):
+            layout = go.Layout(build_layout())
+            layout.template = chart_template(template)
+        with _CHART_LOCK:
+            _CHART_LAYOUTS[key] = layout
+            if len(_CHART_LAYOUTS) > _CHART_LAYOUTS_SIZE:
+                _CHART_LAYOUTS.popitem(last=False)
+    return go.Figure(data=traces, layout=layout)
+
+
+# -------------------------
+# --- シナリオ定義（バッチ実行・HTTP API 共通） ---
+# -------------------------
+# シナリオの既定値（ページの既定値に合わせる、金額は万円）
+SCENARIO_DEFAULTS = {
+    "ticker": "VOO",
+    "start_date": "2009-09-01",
+    "end_date": None,
+    "return_model": "skewnorm",
+    "mean_block_length": 12,
+    "parameter_uncertainty": False,  # True ならパラメータの推定誤差を反映（skewnorm / normal / regime）
+    "n_sims": 5000,
+    "seed": None,
+    "years": 30,
+    # 積立・ポートフォリオ
+    "initial_investment": 100,
+    "monthly_contribution": 0,
+    "target_amount": 1000,
+    "schedule": None,
+    "rebalance_months": 12,
+    # 取り崩し
+    "initial_assets": 4000,
+    "initial_savings": 400,
+    "monthly_need": 20,
+    "withdrawal_rate": 1.0,
+    "min_savings_ratio": 10,
+    "max_savings_ratio": 30,
+    "inflation_rate": 2.0,
+    "adjust_need_for_inflation": True,
+    "options": {},
+    # ライフサイクル（years 年の積立に続けて retirement_years 年の取り崩し、initial_assets は使わない）
+    "retirement_years": 30,
+}
+SCENARIO_TYPES = ["fit", "bands", "accumulation", "withdrawal", "portfolio", "lifecycle"]
+# 取り崩しの分岐オプションの選択肢（取り崩しページの選択肢と同じ）
+WITHDRAWAL_OPTIONS = {
+    "option1_1": ["1-1-1", "1-1-2"],
+    "option1_2": ["1-2-1", "1-2-2", "1-2-3"],
+    "option2_1": ["2-1-1", "2-1-2", "2-1-3"],
+    "option2_2": ["2-2-1", "2-2-2"],
+}
+
+
+# 整数か（bool は除く）
+def _is_int(value):
+    return isinstance(value, (int, np.integer)) and not isinstance(value, bool)
+
+
+# 既定値を補完したシナリオを返す（不正な値は ValueError）
+def resolve_scenario(spec, defaults=None):
+    scenario = {**SCENARIO_DEFAULTS, **(defaults or {}), **spec}
+    scenario.setdefault("type", "accumulation")
+    if scenario["type"] not in SCENARIO_TYPES:
+        raise ValueError(f"未知のシナリオ種別です: {scenario['type']}")
+    for name in ("n_sims", "years"):
+        if not _is_int(scenario[name]) or scenario[name] <= 0:
+            raise ValueError(f"{name} は正の整数で指定してください: {scenario[name]!r}")
+    if not _is_int(scenario["retirement_years"]) or scenario["retirement_years"] < 0:
+        raise ValueError(f"retirement_years は 0 以上の整数で指定してください: {scenario['retirement_years']!r}")
+    if scenario["seed"] is not None and not _is_int(scenario["seed"]):
+        raise ValueError(f"seed は整数か null で指定してください: {scenario['seed']!r}")
+    options = scenario["options"]
+    if not isinstance(options, dict):
+        raise ValueError(f"options は辞書で指定してください: {options!r}")
+    for key, value in options.items():
+        if key not in WITHDRAWAL_OPTIONS:
+            raise ValueError(f"未知のオプションです: {key}")
+        if value not in WITHDRAWAL_OPTIONS[key]:
+            raise ValueError(f"{key} の値は {WITHDRAWAL_OPTIONS[key]} のいずれかです: {value!r}")
+    if scenario["type"] == "portfolio":
+        tickers = scenario.get("tickers")
+        if not isinstance(tickers, (list, tuple)) or not tickers or not all(isinstance(t, str) and t for t in tickers):
+            raise ValueError(f"portfolio のシナリオには tickers（ティッカーの列）を指定してください: {tickers!r}")
+        if scenario.get("weights") is None:
+            scenario["weights"] = [1.0] * len(tickers)  # 未指定（null）なら均等配分
+    if scenario.get("weights") is not None:
+        try:
+            weights = np.asarray(scenario["weights"], dtype=float)
+        except (TypeError, ValueError):
+            raise ValueError(f"weights は数値の列で指定してください: {scenario['weights']!r}") from None
+        if weights.ndim != 1 or np.any(~np.isfinite(weights)) or np.any(weights < 0) or weights.sum() <= 0:
+            raise ValueError(f"weights は 0 以上（合計は正）の数値で指定してください: {scenario['weights']!r}")
+        if scenario["type"] == "portfolio" and len(weights) != len(scenario["tickers"]):
+            raise ValueError(f"weights の数（{len(weights)}）が tickers の数（{len(scenario['tickers'])}）と一致しません")
+    return scenario
+
+
+# データ期間の終了日（未指定なら今月初め、ページの既定値と同じ）
+def _scenario_end_date(scenario):
+    if scenario["end_date"]:
+        return str(scenario["end_date"])
+    now = datetime.now()
+    return f"{now.year}-{now.month:02d}-01"
+
+
+# 単一銘柄の月次データ取得とリターンモデルの推定
+def fit_scenario_model(scenario):
+    df_monthly = load_monthly_data(scenario["ticker"], str(scenario["start_date"]), _scenario_end_date(scenario))
+    if df_monthly.empty:
+        raise ValueError(f"ティッカー {scenario['ticker']} のデータが取得できませんでした")
+    kind = scenario["return_model"]
+    if kind not in RETURN_MODELS:
+        raise ValueError(f"未知のリターンモデルです: {kind}")
+    params = {"mean_block_length": int(scenario["mean_block_length"])} if kind == "bootstrap" else {}
+    if scenario["parameter_uncertainty"]:
+        return df_monthly, fit_return_model("uncertain", df_monthly['Log_Return'].values, base=kind)
+    return df_monthly, fit_return_model(kind, df_monthly['Log_Return'].values, **params)
+
+
+# ポートフォリオのシナリオのデータを取得し、複数銘柄のリターンモデルを推定
+def fit_portfolio_scenario_model(scenario):
+    tickers = list(scenario["tickers"])
+    log_returns = load_monthly_portfolio_data(tickers, str(scenario["start_date"]), _scenario_end_date(scenario))
+    if log_returns.empty or list(log_returns.columns) != tickers:
+        raise ValueError(f"ティッカー {tickers} のデータが揃いませんでした")
+    kind = scenario["return_model"] if scenario["return_model"] in PORTFOLIO_MODELS else "mvnormal"
+    params = {"mean_block_length": int(scenario["mean_block_length"])} if kind == "joint_bootstrap" else {}
+    return fit_return_model(kind, log_returns.values, **params)
+
+
+# 積立スケジュール（万円、schedule があればそちらを優先）
+def scenario_contributions(scenario, n_months):
+    if scenario["schedule"]:
+        now = datetime.now()
+        rows = [
+            (r["start_year"], r["start_month"], r["end_year"], r["end_month"], r.get("monthly", 0), r.get("january_lump", 0))
+            for r in scenario["schedule"]
+        ]
+        return build_monthly_contributions(
+            rows, scenario.get("plan_start_year", now.year), scenario.get("plan_start_month", now.month), n_months
+        )
+    return np.full(n_months, float(scenario["monthly_contribution"]))
+
+
+# 予算に合わせた実行方法（chunk_size, dtype）。予算を超えるシナリオは ValueError
+def _scenario_plan(engine, n_paths, n_months, n_assets=1):
+    plan = plan_run(engine, n_paths, n_months, n_assets)
+    if plan["mode"] == "refuse":
+        raise ValueError(plan["reason"])
+    return {"chunk_size": plan["chunk_size"], "dtype": plan["dtype"]}
+
+
+# シナリオが使うリターン列（キーと生成に必要な情報）。fit・bands は None
+def scenario_returns(scenario):
+    kind = scenario["type"]
+    if kind not in ("accumulation", "withdrawal", "portfolio", "lifecycle"):
+        return None
+    n_months = int(scenario["years"]) * 12
+    if kind == "lifecycle":
+        n_months += int(scenario["retirement_years"]) * 12
+    n_sims = int(scenario["n_sims"])
+    if kind == "portfolio":
+        model = fit_portfolio_scenario_model(scenario)
+        plan = _scenario_plan(kind, n_sims, n_months, len(scenario["tickers"]))
+    else:
+        model = fit_scenario_model(scenario)[1]
+        plan = _scenario_plan(kind, n_sims, n_months)
+    block_size = plan["chunk_size"] or PATH_BLOCK_SIZE
+    return {
+        "key": returns_key(model, n_months, scenario["seed"], plan["dtype"], block_size),
+        "model": model, "n_paths": n_sims, "n_months": n_months, "dtype": plan["dtype"], "block_size": block_size,
+    }
+
+
+# シナリオを実行して要約を返す（金額は万円で受け取り、積立系の結果は円、取り崩し・ライフサイクルの結果は万円のまま返す）
+def run_scenario_summary(scenario):
+    kind = scenario["type"]
+    n_months = int(scenario["years"]) * 12
+    n_sims = int(scenario["n_sims"])
+
+    if kind == "portfolio":
+        tickers = list(scenario["tickers"])
+        model = fit_portfolio_scenario_model(scenario)
+        return portfolio_summary(
+            model, scenario["weights"], n_sims, scenario["initial_investment"] * 1e4,
+            scenario_contributions(scenario, n_months) * 1e4, scenario["target_amount"] * 1e4,
+            rebalance_months=int(scenario["rebalance_months"]), seed=scenario["seed"],
+            **_scenario_plan("portfolio", n_sims, n_months, len(tickers)),
+        )
+
+    df_monthly, model = fit_scenario_model(scenario)
+    if kind == "fit":
+        returns = df_monthly['Log_Return'].dropna()
+        mean_annual_log, std_annual_log, mean_annual_exp = annualize(returns.mean(), returns.std())
+        var, cvar = calculate_var_cvar(returns.values)
+        return {
+            "model": model.cache_key(),
+            "n_obs": len(returns),
+            "mean_annual_log": float(mean_annual_log),
+            "mean_annual": float(mean_annual_exp),
+            "std_annual": float(std_annual_log),
+            "var_5": float(var),
+            "cvar_5": float(cvar),
+        }
+    if kind == "bands":
+        bands = price_path_bands(df_monthly, model, n_sims=n_sims, seed=scenario["seed"])
+        return {"dates": df_monthly.index.strftime("%Y-%m-%d").tolist(), **bands}
+    if kind == "accumulation":
+        return accumulation_summary(
+            model, n_sims, scenario["initial_investment"] * 1e4,
+            scenario_contributions(scenario, n_months) * 1e4, scenario["target_amount"] * 1e4, seed=scenario["seed"],
+            **_scenario_plan("accumulation", n_sims, n_months),
+        )
+    withdrawal_kwargs = dict(
+        initial_savings=scenario["initial_savings"],
+        monthly_need=scenario["monthly_need"],
+        withdrawal_rate=scenario["withdrawal_rate"],
+        min_savings_ratio=scenario["min_savings_ratio"],
+        max_savings_ratio=scenario["max_savings_ratio"],
+        inflation_rate=scenario["inflation_rate"],
+        adjust_need_for_inflation=scenario["adjust_need_for_inflation"],
+        **scenario["options"],  # 未指定の分岐は simulate_withdrawal の既定値
+    )
+    if kind == "lifecycle":
+        # 積立も取り崩しと同じく万円のまま計算する
+        withdrawal_months = int(scenario["retirement_years"]) * 12
+        return lifecycle_summary(
+            model, n_sims, scenario["initial_investment"], scenario_contributions(scenario, n_months), withdrawal_kwargs,
+            withdrawal_months, seed=scenario["seed"], **_scenario_plan("lifecycle", n_sims, n_months + withdrawal_months),
+        )
+    return withdrawal_summary(
+        model, n_sims, n_months, {"initial_assets": scenario["initial_assets"], **withdrawal_kwargs}, seed=scenario["seed"],
+        **_scenario_plan("withdrawal", n_sims, n_months),
+    )
+
 #月次データに対する分布当てはめ
-def fit_distribution(df_monthly, ticker):
+# fit_skew=False の場合はスキュー付き正規分布の当てはめ（skewnorm.fit）を省略し、skew_params は None を返す
+@timed("fit_distribution")
+def fit_distribution(df_monthly, ticker, fit_skew=True):
+    import plotly.graph_objects as go
+    from scipy.stats import norm, skewnorm
     # -------------------------
     # --- 対数リターンヒストグラム ---
     # -------------------------
     x_values = df_monthly['Log_Return'].values
     n_bin = 30
-    fig = go.Figure()
+    fig = chart_figure("plotly_white")
     # --- 対数リターンのヒストグラム ---
     fig.add_trace(
-        go.Histogram(x=x_values, nbinsx=n_bin, name="月次データのヒストグラム", marker_color='orange', histnorm='probability density'),
+        go.Histogram(x=x_values.astype(np.float32), nbinsx=n_bin, name="月次データのヒストグラム", marker_color='orange', histnorm='probability density'),
     )
 
     # --- 対数リターンの正規分布 ---
@@ -146,47 +2687,50 @@ def fit_distribution(df_monthly, ticker):
     # 統計量算出(年次変換)
     annual_mean_log, annual_std_log, annual_mean_exp = annualize(monthly_mean_log, monthly_std_log)#年次対数リターン、　対数リスク、通常リターン
     # 月次→年次VaR/CVaR
-    annual_samples = np.random.choice(df_monthly['Log_Return'].values, size=(100000,12)).sum(axis=1)
-    var_95, cvar_95 = calculate_var_cvar(annual_samples, alpha=0.05)
+    with span("var_resampling"):
+        annual_samples = np.random.choice(df_monthly['Log_Return'].values, size=(100000,12)).sum(axis=1)
+        var_95, cvar_95 = calculate_var_cvar(annual_samples, alpha=0.05)
     x = np.linspace(x_values.min(), x_values.max(), 200)
     pdf = norm.pdf(x, loc=monthly_mean_log, scale=monthly_std_log)
     fig.add_trace(
-        go.Scatter(x=x, y=pdf, mode='lines', name='正規分布と仮定', line=dict(color='red', width=2)),
+        line_trace(x, pdf, name='正規分布と仮定', line=dict(color='red', width=2)),
     )
 
-    # スキュー付き正規分布のパラメータを推定
-    skew_params = skewnorm.fit(x_values)
-    a, loc, scale = skew_params
-    pdf_skew = skewnorm.pdf(x, *skew_params)
-    # moments='mvsk'で平均(Mean)、分散(Variance)、歪度(Skewness)、尖度(Kurtosis)を返す
-    model_mean_log, model_var_log, model_skew, _ = skewnorm.stats(a, loc=loc, scale=scale, moments='mvsk')
-    model_std_log = np.sqrt(model_var_log)
-    mode_estimate = x[np.argmax(pdf_skew)] #PDF の最大値の位置を取得（理論的ピーク）
-    mode_exp = np.exp(mode_estimate) - 1                  # 月次通常リターンに変換
-    mode_annual_log, _, mode_annual_exp = annualize(mode_estimate, model_std_log)  # 年次換算
-
-
-    # モデル統計量：月次ログリターン → 年次換算（ログ・通常リターン）
-    model_mean_annual_log, model_std_annual_log, model_mean_annual_exp = annualize(model_mean_log, model_std_log)
-    # モデル統計量：年次VaR/CVaRを計算
-    # 注意: skewnorm.rvsを使用してシミュレーションした結果からVaR/CVaRを計算します。
-    # 標本サイズと期間（12ヶ月）を設定
-    N_MC = 100000
-    T_ANNUAL = 12
-    # スキュー付き正規分布から年次リターンサンプルを生成
-    annual_model_samples = skewnorm.rvs(a, loc=loc, scale=scale, size=(N_MC, T_ANNUAL)).sum(axis=1)
-    model_var_95, model_cvar_95 = calculate_var_cvar(annual_model_samples, alpha=0.05)
+    skew_params = None
+    if fit_skew:
+        # スキュー付き正規分布のパラメータを推定（推定結果はキャッシュされ、シミュレーションでも再利用される）
+        skew_params = fit_return_model("skewnorm", x_values).params
+        a, loc, scale = skew_params
+        pdf_skew = skewnorm.pdf(x, *skew_params)
+        # moments='mvsk'で平均(Mean)、分散(Variance)、歪度(Skewness)、尖度(Kurtosis)を返す
+        model_mean_log, model_var_log, model_skew, _ = skewnorm.stats(a, loc=loc, scale=scale, moments='mvsk')
+        model_std_log = np.sqrt(model_var_log)
+        mode_estimate = x[np.argmax(pdf_skew)] #PDF の最大値の位置を取得（理論的ピーク）
+        mode_exp = np.exp(mode_estimate) - 1                  # 月次通常リターンに変換
+        mode_annual_log, _, mode_annual_exp = annualize(mode_estimate, model_std_log)  # 年次換算
 
-    fig.add_trace(
-        go.Scatter(x=x, y=pdf_skew, mode='lines', name=f'スキュー付き正規分布と仮定', line=dict(color='green', width=2, dash='dash')),
-    )
+
+        # モデル統計量：月次ログリターン → 年次換算（ログ・通常リターン）
+        model_mean_annual_log, model_std_annual_log, model_mean_annual_exp = annualize(model_mean_log, model_std_log)
+        # モデル統計量：年次VaR/CVaRを計算
+        # 注意: skewnorm.rvsを使用してシミュレーションした結果からVaR/CVaRを計算します。
+        # 標本サイズと期間（12ヶ月）を設定
+        N_MC = 100000
+        T_ANNUAL = 12
+        # スキュー付き正規分布から年次リターンサンプルを生成
+        with span("var_resampling", model="skewnorm"):
+            annual_model_samples = skewnorm.rvs(a, loc=loc, scale=scale, size=(N_MC, T_ANNUAL)).sum(axis=1)
+            model_var_95, model_cvar_95 = calculate_var_cvar(annual_model_samples, alpha=0.05)
+
+        fig.add_trace(
+            line_trace(x, pdf_skew, name=f'スキュー付き正規分布と仮定', line=dict(color='green', width=2, dash='dash')),
+        )
 
     # レイアウト調整
     fig.update_layout(
         #title_text= ticker + "の月次対数チャートの変化率ヒストグラムと、当てはまりのよい分布を観察",
         xaxis_title="変化率（月次の対数チャートにおいて）",
         yaxis_title="確率密度",
-        template="plotly_white",
         showlegend=True,
         height=400,
     )
@@ -212,7 +2756,7 @@ def fit_distribution(df_monthly, ticker):
 
     
     # 統計量表示
-    summary_table = pd.DataFrame({
+    summary = {
         "指標": ["期待リターン", "最頻値", "リスク(標準偏差)", "歪度(Skewness)", "下振れリスク(VaR95%)", "平均損失(CVaR95%)"],
         
         "月次(正規)": [
@@ -231,16 +2775,17 @@ def fit_distribution(df_monthly, ticker):
             f"{var_95*100:.2f}%", 
             f"{cvar_95*100:.2f}%"
         ],
-        
-        "月次(スキュー付き)": [
+    }
+    if fit_skew:
+        summary["月次(スキュー付き)"] = [
             f"{(np.exp(model_mean_log)-1)*100:.2f}%", # モデル平均を通常リターンに変換
             f"{mode_exp*100:.2f}%",                     # 最頻値
             f"{model_std_log*100:.2f}%", 
             f"{model_skew:.2f}",
             "-", 
             "-"
-        ],
-        "年次(スキュー付き)": [
+        ]
+        summary["年次(スキュー付き)"] = [
             f"{model_mean_annual_exp*100:.2f}%", 
             f"{mode_annual_exp*100:.2f}%",             # 年次最頻値
             f"{model_std_annual_log*100:.2f}%", 
@@ -248,7 +2793,7 @@ def fit_distribution(df_monthly, ticker):
             f"{model_var_95*100:.2f}%", 
             f"{model_cvar_95*100:.2f}%"
         ]
-    })
+    summary_table = pd.DataFrame(summary)
     
 
     return skew_params, fig, summary_table